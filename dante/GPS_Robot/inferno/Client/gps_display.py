@@ -593,7 +593,7 @@ class App(QMainWindow):
         def click_event():
             x = vector.x
             y = vector.y
-            node = grid.nodes[x][y]
+            node = grid.get_node(x, y)
             something_happened = False
             print("My name is " + node.gridPos.x.__str__() + " " + node.gridPos.y.__str__())
             print("My node Type is: " + node.node_type.__str__())
@@ -803,20 +803,26 @@ class App(QMainWindow):
     def save(self):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
-        file_name, _ = QFileDialog.getSaveFileName(self, "Save Grid", "", "All Files (*);;Text Files (*.txt)",
+        file_name, _ = QFileDialog.getSaveFileName(self, "Save Grid", "", "Grid Files (*.grid);;All Files (*)",
                                                    options=options)
         if file_name:
             print(file_name)
-
-        self.grid.save(file_name)
+            self.grid.save(file_name)
 
     # opens a load dialog.
     def load(self):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
-        file_name, _ = QFileDialog.getOpenFileName(self, "Load Grid", "", "All Files (*);;Python Files (*.py)",
+        file_name, _ = QFileDialog.getOpenFileName(self, "Load Grid", "", "Grid Files (*.grid);;All Files (*)",
                                                    options=options)
-        self.grid = Grid.load(file_name)
+        if not file_name:
+            return
+
+        # old text maps are still understood, they are converted as they are read
+        grid = Grid.load(file_name)
+        if grid is None:
+            return
+        self.grid = grid
         self.grid_panel.setParent(None)
         self.grid_panel = None
         self.grid_panel = GridPanel(self, self.grid)
@@ -167,6 +167,19 @@ class AdvancedGoPiGo3:
 
                                
         
+    '''
+    The following methods involve the wheel encoders and the size of the robot.
+    '''
+    def read_encoders(self):
+        return (self.gpg.get_motor_encoder(self.gpg.MOTOR_LEFT),
+                self.gpg.get_motor_encoder(self.gpg.MOTOR_RIGHT))
+
+    def get_wheel_circumference(self):
+        return self.gpg.WHEEL_CIRCUMFERENCE / 1000.0  # meters
+
+    def get_wheel_base(self):
+        return self.gpg.WHEEL_BASE_WIDTH / 1000.0  # meters
+
     '''
     The following methods involve the lights and LEDS on the gpg board.
     '''
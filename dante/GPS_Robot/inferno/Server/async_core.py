@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import serial
+import traceback
+import time
+
+# how often the simulation behaviors are updated, the same as the select timeout of Server.manage_commands
+SIM_PERIOD = .1
+
+# how long to wait before opening the hedge's serial port again after it went away
+HEDGE_RETRY_PERIOD = 1
+
+
+# This class runs the rover's i/o on one asyncio event loop instead of a thread for each part.
+# The hedge's serial port is read as soon as the loop sees bytes on it, and the pose estimator, distance sampler,
+# gps driving loop and client socket are all coroutines on the same loop.  Everything that changes the server's
+# state (client commands, gps callbacks, the simulation) is handed to a single planner thread and awaited as a
+# future, so a long path search never holds up a motor command and the server is still only changed by one thread.
+# The server and its gps have to be made with use_async set so that they do not start threads of their own.
+class AsyncCore:
+    def __init__(self, server):
+        self.server = server
+        self.gps = server.gps
+        self.__planner = ThreadPoolExecutor(max_workers=1)
+        self.__loop = None
+        self.__messages = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__messages = asyncio.Event()
+        self.__messages.set()  # anything queued before the loop started
+        self.server.send_listener = self.__on_message
+
+        # the gps callbacks land on the loop, they are passed to the planner like every other change to the server
+        self.gps.set_obstacle_callback(self.planner_callback(self.server.obstacle_found))
+        self.gps.set_position_callback(self.planner_callback(self.server.rover_position_change))
+        self.gps.set_no_obstacle_callback(self.planner_callback(self.server.on_no_obstacles))
+        self.gps.set_reached_point_callback(self.planner_callback(self.server.destination_reached))
+
+        sampler = self.gps.get_distance_sampler()
+        tasks = [
+            asyncio.ensure_future(self.__read_hedge()),
+            asyncio.ensure_future(self.__repeat(sampler.rate, sampler.sample)),
+            asyncio.ensure_future(self.gps.run_async()),
+            asyncio.ensure_future(self.__send()),
+            asyncio.ensure_future(self.__simulate()),
+        ]
+        estimator = self.gps.get_estimator()
+        if estimator is not None:
+            tasks.append(asyncio.ensure_future(self.__repeat(estimator.rate, estimator.step)))
+
+        # the client hanging up ends everything else
+        try:
+            await self.__receive()
+        finally:
+            self.server.can_run = False
+            self.server.send_listener = None
+            self.gps.stop()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.__planner.shutdown(wait=True)
+
+    # run func on the planner thread, the result can be awaited
+    def plan(self, func, *args):
+        return self.__loop.run_in_executor(self.__planner, func, *args)
+
+    # wrap a callback so calling it only queues it on the planner thread
+    def planner_callback(self, func):
+        def callback(*args):
+            self.__planner.submit(func, *args).add_done_callback(self.__report_error)
+        return callback
+
+    @staticmethod
+    def __report_error(future):
+        if future.exception() is not None:
+            traceback.print_exception(type(future.exception()), future.exception(),
+                                      future.exception().__traceback__)
+
+    # the server calls this from any thread whenever it queues a message for the client
+    def __on_message(self):
+        self.__loop.call_soon_threadsafe(self.__messages.set)
+
+    # read the hedge whenever the loop sees bytes on its port, opening the port again if it goes away
+    async def __read_hedge(self):
+        hedge = self.gps.get_hedge()
+        while self.server.can_run:
+            try:
+                fd = hedge.open_port()
+            except (OSError, serial.SerialException):
+                await asyncio.sleep(HEDGE_RETRY_PERIOD)
+                continue
+
+            lost = asyncio.Event()
+
+            def on_readable():
+                if not hedge.read_available():
+                    self.__loop.remove_reader(fd)
+                    lost.set()
+
+            self.__loop.add_reader(fd, on_readable)
+            try:
+                await lost.wait()
+            finally:
+                self.__loop.remove_reader(fd)
+            await asyncio.sleep(HEDGE_RETRY_PERIOD)
+
+    # call step rate times a second, late ticks are dropped rather than run back to back
+    async def __repeat(self, rate, step):
+        period = 1.0 / rate
+        next_tick = time.time()
+        while self.server.can_run:
+            step()
+            next_tick += period
+            delay = next_tick - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                next_tick = time.time()
+                await asyncio.sleep(0)
+
+    # commands from the client, each one is parsed on the planner thread
+    async def __receive(self):
+        conn = self.server.conn
+        conn.setblocking(False)
+        while self.server.can_run:
+            data = await self.__loop.sock_recv(conn, 1024)
+            if len(data) == 0:
+                print("client disconnected")
+                return
+            await self.plan(self.server.parse_data, data.decode('utf-8').split())
+
+    # send everything the server has queued for the client, as soon as it is queued
+    async def __send(self):
+        conn = self.server.conn
+        while self.server.can_run:
+            await self.__messages.wait()
+            self.__messages.clear()
+            while not self.server.send_queue.empty():
+                data = self.server.send_queue.get_nowait()
+                if not self.server.is_simulating():
+                    await self.__loop.sock_sendall(conn, str.encode(data))
+
+    async def __simulate(self):
+        while self.server.can_run:
+            if self.server.is_simulating():
+                await self.plan(self.server.update_sim_behavior)
+            await asyncio.sleep(SIM_PERIOD)
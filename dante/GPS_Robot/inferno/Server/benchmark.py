@@ -0,0 +1,331 @@
+from grid import Grid, OBSTACLE, OPEN_SPACE, A_STAR, JPS
+import numpy as np
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+# map sizes in cells, the first one is the size of the real field
+SIZES = [(20, 28), (100, 100), (250, 250), (500, 500), (1000, 1000)]
+MAP_KINDS = ["open", "random", "maze", "rooms"]
+ALGORITHMS = [A_STAR, JPS]
+
+# how much slower (or how many more expansions) a run may be than the baseline before it counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# timings closer than this to the baseline are noise, whatever the tolerance says
+NOISE_FLOOR_MS = 1.0
+NOISE_FLOOR_US = 10.0
+
+
+# This script benchmarks the inferno grid headless.  Every map is generated from a seed so runs can be compared,
+# results can be written out as a json baseline and later runs checked against it.
+#   python benchmark.py --save baseline.json
+#   python benchmark.py --compare baseline.json
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Grid pathfinding and border upkeep.")
+    parser.add_argument("--sizes", nargs="*", default=None, help="map sizes as XxY, every size by default")
+    parser.add_argument("--kinds", nargs="*", default=MAP_KINDS, choices=MAP_KINDS, help="map kinds to run")
+    parser.add_argument("--queries", type=int, default=20, help="path queries per map")
+    parser.add_argument("--repeat", type=int, default=3, help="times every query is run, the fastest one counts")
+    parser.add_argument("--rounds", type=int, default=3, help="times every map is run, the median timings count")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the maps and queries")
+    parser.add_argument("--border", type=int, default=1, help="border thickness of the grids")
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--compare", help="compare the results against this json baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed slowdown, 0.25 is 25%%")
+    args = parser.parse_args()
+
+    sizes = SIZES if args.sizes is None else [tuple(int(v) for v in size.split("x")) for size in args.sizes]
+    results = {
+        "meta": {"python": platform.python_version(), "numpy": np.__version__, "seed": args.seed,
+                 "queries": args.queries, "repeat": args.repeat, "rounds": args.rounds, "border": args.border},
+        "maps": {}
+    }
+    for size_x, size_y in sizes:
+        for kind in args.kinds:
+            name = kind + "-" + str(size_x) + "x" + str(size_y)
+            print("running", name)
+            rounds = [run_map(kind, size_x, size_y, args.border, args.queries, args.repeat, args.seed)
+                      for _ in range(max(1, args.rounds))]
+            results["maps"][name] = median_result(rounds)
+            print_map(name, results["maps"][name])
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print("baseline written to", args.save)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        if args.rounds < 3 or baseline["meta"].get("rounds", 1) < 3:
+            print("WARNING fewer than 3 rounds, there is little spread to tell noise from a slowdown")
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("no regressions against", args.compare)
+
+
+# the median of every timing over several rounds of the same map, the counts are the same in every round.
+# The fastest and slowest round of each timing are kept with it as "<key>_range", how much it moves from run to run.
+def median_result(rounds):
+    result = dict(rounds[0])
+    for key in ("remake_borders_ms", "set_node_us"):
+        result[key], result[key + "_range"] = spread([run[key] for run in rounds])
+    for algorithm in ALGORITHMS:
+        result[algorithm] = dict(rounds[0][algorithm])
+        for key in ("p50_ms", "p90_ms", "p99_ms", "max_ms"):
+            result[algorithm][key], result[algorithm][key + "_range"] = \
+                spread([run[algorithm][key] for run in rounds])
+    return result
+
+
+def spread(values):
+    return float(np.median(values)), [float(min(values)), float(max(values))]
+
+
+# build one map and time everything on it
+def run_map(kind, size_x, size_y, border, queries, repeat, seed):
+    rng = random.Random(seed * 1000003 + size_x * 1009 + size_y + MAP_KINDS.index(kind))
+    obstacles = make_map(kind, size_x, size_y, border, rng)
+
+    grid = Grid(size_x / 10.0, size_y / 10.0, size_x, size_y, border_thickness=border)
+    grid.node_types[obstacles] = OBSTACLE
+    start_time = time.perf_counter()
+    grid.remake_borders()
+    result = {"remake_borders_ms": (time.perf_counter() - start_time) * 1000}
+    result["set_node_us"] = time_set_node(grid, rng, repeat)
+
+    # queries only go between open cells, the same ones for every algorithm
+    open_cells = np.flatnonzero(grid.flat_types == OPEN_SPACE)
+    pairs = []
+    if len(open_cells) > 1:
+        for _ in range(queries):
+            start, end = rng.sample(range(len(open_cells)), 2)
+            pairs.append((int(open_cells[start]), int(open_cells[end])))
+
+    for algorithm in ALGORITHMS:
+        result[algorithm] = run_queries(grid, pairs, algorithm, repeat)
+        result[algorithm]["peak_kb"] = measure_peak(obstacles, border, pairs, algorithm)
+    return result
+
+
+# build a grid with its borders from an obstacle map, the same way run_map does
+def make_grid(obstacles, border):
+    size_x, size_y = obstacles.shape
+    grid = Grid(size_x / 10.0, size_y / 10.0, size_x, size_y, border_thickness=border)
+    grid.node_types[obstacles] = OBSTACLE
+    grid.remake_borders()
+    return grid
+
+
+# the most memory a fresh grid and one query on it take, the search scratch included.  Memory is measured on its
+# own, tracing slows everything down too much to time it at the same time.
+def measure_peak(obstacles, border, pairs, algorithm):
+    if len(pairs) == 0:
+        return 0.0
+    tracemalloc.start()
+    try:
+        grid = make_grid(obstacles, border)
+        grid.find_path(grid.get_node_from_index(pairs[0][0]), grid.get_node_from_index(pairs[0][1]),
+                       algorithm=algorithm)
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+# obstacle map for a kind of map, a bool array indexed [x, y]
+def make_map(kind, size_x, size_y, border, rng):
+    obstacles = np.zeros((size_x, size_y), dtype=bool)
+    if kind == "random":
+        state = np.random.RandomState(rng.randrange(2 ** 31))
+        obstacles = state.random_sample((size_x, size_y)) < 0.05
+    elif kind == "maze":
+        obstacles = make_maze(size_x, size_y, 2 * border + 2, rng)
+    elif kind == "rooms":
+        obstacles = make_rooms(size_x, size_y, border, rng)
+    return obstacles
+
+
+# a perfect maze carved by a depth first walk.  Walls are one cell thick and the passages are wide enough to still
+# have open space in the middle once the borders are grown.
+def make_maze(size_x, size_y, pitch, rng):
+    cells_x = max(1, (size_x - 1) // pitch)
+    cells_y = max(1, (size_y - 1) // pitch)
+    obstacles = np.ones((size_x, size_y), dtype=bool)
+    visited = np.zeros((cells_x, cells_y), dtype=bool)
+
+    def carve(cx, cy):
+        x = cx * pitch + 1
+        y = cy * pitch + 1
+        obstacles[x:x + pitch - 1, y:y + pitch - 1] = False
+
+    visited[0, 0] = True
+    carve(0, 0)
+    stack = [(0, 0)]
+    while len(stack) > 0:
+        cx, cy = stack[-1]
+        neighbors = [(cx + dx, cy + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                     if 0 <= cx + dx < cells_x and 0 <= cy + dy < cells_y and not visited[cx + dx, cy + dy]]
+        if len(neighbors) == 0:
+            stack.pop()
+            continue
+
+        nx, ny = rng.choice(neighbors)
+        visited[nx, ny] = True
+        carve(nx, ny)
+
+        # knock down the wall between the two cells
+        x0 = min(cx, nx) * pitch + 1
+        y0 = min(cy, ny) * pitch + 1
+        if nx != cx:
+            obstacles[x0:x0 + 2 * pitch - 1, y0:y0 + pitch - 1] = False
+        else:
+            obstacles[x0:x0 + pitch - 1, y0:y0 + 2 * pitch - 1] = False
+        stack.append((nx, ny))
+    return obstacles
+
+
+# rectangular rooms joined in a chain by L shaped corridors
+def make_rooms(size_x, size_y, border, rng):
+    obstacles = np.ones((size_x, size_y), dtype=bool)
+    width = 2 * border + 1
+    room_count = max(2, (size_x * size_y) // 2000)
+    centers = []
+    for _ in range(room_count):
+        room_x = rng.randint(width, max(width, min(size_x // 3, 40)))
+        room_y = rng.randint(width, max(width, min(size_y // 3, 40)))
+        x = rng.randrange(0, max(1, size_x - room_x))
+        y = rng.randrange(0, max(1, size_y - room_y))
+        obstacles[x:x + room_x, y:y + room_y] = False
+        centers.append((x + room_x // 2, y + room_y // 2))
+
+    for (x0, y0), (x1, y1) in zip(centers, centers[1:]):
+        obstacles[min(x0, x1):max(x0, x1) + width, y0:y0 + width] = False
+        obstacles[x1:x1 + width, min(y0, y1):max(y0, y1) + width] = False
+    return obstacles
+
+
+# average time to place and then remove an obstacle, which keeps the borders up to date incrementally.
+# The fastest of repeat rounds counts.
+def time_set_node(grid, rng, repeat, count=200):
+    cells = [(rng.randrange(grid.nodes_in_x), rng.randrange(grid.nodes_in_y)) for _ in range(count)]
+    cells = [(x, y) for x, y in cells if grid.node_types[x, y] == OPEN_SPACE]
+    if len(cells) == 0:
+        return 0.0
+
+    # one pass untimed first, the first changes to a grid are much slower than the rest
+    for x, y in cells:
+        grid.set_node(x, y, OBSTACLE)
+        grid.set_node(x, y, OPEN_SPACE)
+
+    best = float("inf")
+    for _ in range(max(1, repeat)):
+        start_time = time.perf_counter()
+        for x, y in cells:
+            grid.set_node(x, y, OBSTACLE)
+            grid.set_node(x, y, OPEN_SPACE)
+        best = min(best, time.perf_counter() - start_time)
+    return best / (2 * len(cells)) * 1000000
+
+
+# time every query with one algorithm
+def run_queries(grid, pairs, algorithm, repeat):
+    latencies = []
+    expansions = 0
+    cost = 0.0
+    found = 0
+    for start, end in pairs:
+        start_node = grid.get_node_from_index(start)
+        end_node = grid.get_node_from_index(end)
+        best = float("inf")
+        for _ in range(max(1, repeat)):
+            start_time = time.perf_counter()
+            path, _ = grid.find_path(start_node, end_node, algorithm=algorithm)
+            best = min(best, (time.perf_counter() - start_time) * 1000)
+        latencies.append(best)
+        expansions += grid.last_expansions
+        if len(path) > 0:
+            found += 1
+            cost += path_cost(grid, start_node, path)
+
+    latencies = np.array(latencies) if len(latencies) > 0 else np.zeros(1)
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p90_ms": float(np.percentile(latencies, 90)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "max_ms": float(latencies.max()),
+        "expansions": expansions,
+        "cost": cost,
+        "found": found
+    }
+
+
+# the cost of a path by the grid's own weights
+def path_cost(grid, start, path):
+    cost = 0.0
+    previous = start
+    for node in path:
+        if previous.gridPos.x != node.gridPos.x and previous.gridPos.y != node.gridPos.y:
+            cost += grid.diagonal_weight
+        else:
+            cost += grid.non_diagonal_weight
+        previous = node
+    return cost
+
+
+def print_map(name, result):
+    print("  remake_borders %.2f ms, set_node %.1f us" % (result["remake_borders_ms"], result["set_node_us"]))
+    for algorithm in ALGORITHMS:
+        stats = result[algorithm]
+        print("  %-4s p50 %8.2f ms  p90 %8.2f ms  p99 %8.2f ms  expansions %9d  cost %10.1f  found %3d  peak %8.1f kb"
+              % (algorithm, stats["p50_ms"], stats["p90_ms"], stats["p99_ms"], stats["expansions"], stats["cost"],
+                 stats["found"], stats["peak_kb"]))
+
+
+# every way the new results are worse than the baseline.  Costs and the number of paths found must match exactly,
+# they only change if a search stops finding optimal paths.  Only the median time is gated on, the tail of a handful
+# of queries moves too much from run to run.  The other percentiles are still reported.
+def compare(baseline, results, tolerance):
+    regressions = []
+    for name, result in results["maps"].items():
+        base = baseline["maps"].get(name)
+        if base is None:
+            continue
+
+        for key, floor in (("remake_borders_ms", NOISE_FLOOR_MS), ("set_node_us", NOISE_FLOOR_US)):
+            if is_slower(base, result, key, tolerance, floor):
+                regressions.append("%s %s %.2f -> %.2f" % (name, key, base[key], result[key]))
+
+        for algorithm in ALGORITHMS:
+            if algorithm not in base:
+                continue
+            new = result[algorithm]
+            old = base[algorithm]
+            if is_slower(old, new, "p50_ms", tolerance, NOISE_FLOOR_MS):
+                regressions.append("%s %s p50_ms %.2f -> %.2f" % (name, algorithm, old["p50_ms"], new["p50_ms"]))
+            if new["expansions"] > old["expansions"] * (1 + tolerance):
+                regressions.append("%s %s expansions %d -> %d" % (name, algorithm, old["expansions"],
+                                                                 new["expansions"]))
+            if new["found"] != old["found"] or abs(new["cost"] - old["cost"]) > 1e-6:
+                regressions.append("%s %s paths changed, found %d -> %d, cost %.1f -> %.1f" %
+                                   (name, algorithm, old["found"], new["found"], old["cost"], new["cost"]))
+    return regressions
+
+
+# a timing only counts as slower if even its fastest round is slower than the baseline's slowest round by more than
+# the tolerance and the floor, so the gate never fires on the spread the timing already has from run to run.
+def is_slower(old, new, key, tolerance, floor):
+    fastest = new.get(key + "_range", [new[key]])[0]
+    slowest = old.get(key + "_range", [old[key]])[-1]
+    return fastest > slowest * (1 + tolerance) and fastest - slowest > floor
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+from marvelmind import PACKET_FORMATS, PACKET_HEADER_SIZE, PACKET_OVERHEAD, CRC16_TABLE, PACKET_US_POSITION_CM, \
+    PACKET_US_POSITION_MM, PACKET_IMU_RAW, PACKET_IMU
+import numpy as np
+import argparse
+import mmap
+import time
+
+# bytes decoded at a time.  A chunk needs about this much again for the copied packet rows and a few bytes per header
+# found for their offsets, whatever the size of the capture.
+CHUNK_SIZE = 1 << 26
+
+# the payload of every packet type as a structured dtype.  The fields and padding are laid out exactly like the
+# struct formats the live decoder uses, CRC included.
+PACKET_DTYPES = {
+    PACKET_US_POSITION_CM: np.dtype({
+        'names': ['timestamp', 'x', 'y', 'z', 'address', 'crc'],
+        'formats': ['<u4', '<i2', '<i2', '<i2', 'u1', '<u2'],
+        'offsets': [0, 4, 6, 8, 11, 16],
+        'itemsize': 18}),
+    PACKET_US_POSITION_MM: np.dtype({
+        'names': ['timestamp', 'x', 'y', 'z', 'address', 'crc'],
+        'formats': ['<u4', '<i4', '<i4', '<i4', 'u1', '<u2'],
+        'offsets': [0, 4, 8, 12, 17, 22],
+        'itemsize': 24}),
+    PACKET_IMU_RAW: np.dtype({
+        'names': ['ax', 'ay', 'az', 'gx', 'gy', 'gz', 'mx', 'my', 'mz', 'timestamp', 'crc'],
+        'formats': ['<i2'] * 9 + ['<u4', '<u2'],
+        'offsets': [0, 2, 4, 6, 8, 10, 12, 14, 16, 24, 32],
+        'itemsize': 34}),
+    PACKET_IMU: np.dtype({
+        'names': ['x', 'y', 'z', 'qw', 'qx', 'qy', 'qz', 'vx', 'vy', 'vz', 'ax', 'ay', 'az', 'timestamp', 'crc'],
+        'formats': ['<i4'] * 3 + ['<i2'] * 10 + ['<u4', '<u2'],
+        'offsets': [0, 4, 8, 12, 14, 16, 18, 20, 22, 24, 26, 28, 30, 34, 42],
+        'itemsize': 44}),
+}
+PACKET_NAMES = {
+    PACKET_US_POSITION_CM: "position_cm",
+    PACKET_US_POSITION_MM: "position_mm",
+    PACKET_IMU_RAW: "imu_raw",
+    PACKET_IMU: "imu",
+}
+
+# a dtype that does not match its struct would decode garbage without any error
+for _packet_type, _dtype in PACKET_DTYPES.items():
+    assert _dtype.itemsize == PACKET_FORMATS[_packet_type].size, PACKET_NAMES[_packet_type]
+
+_CRC16_TABLE = np.array(CRC16_TABLE, dtype=np.uint16)
+_LONGEST_PACKET = 255 + PACKET_OVERHEAD
+
+
+# This script decodes a raw serial capture of the marvelmind modem in bulk with numpy, for looking at a run afterwards.
+# Every header in a chunk is found at once, the CRCs of all packets of a length are checked together a column at a
+# time, and the good packets are viewed straight through the structured dtypes above.
+#   python capture_decoder.py capture.bin --output capture.npz
+def main():
+    parser = argparse.ArgumentParser(description="Decode a raw Marvelmind serial capture.")
+    parser.add_argument("capture", help="file of raw bytes read from the modem")
+    parser.add_argument("--output", help="write the decoded packets to this npz file, one array per packet type")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    packets = decode_file(args.capture)
+    elapsed = time.perf_counter() - start_time
+
+    for packet_type, name in PACKET_NAMES.items():
+        print("%-12s %10d packets" % (name, len(packets[name])))
+    print("decoded in %.2f s" % elapsed)
+
+    if args.output:
+        np.savez(args.output, **packets)
+        print("packets written to", args.output)
+
+
+# decode every packet in a capture file.  It returns a dict of packet type name -> structured array, each with an
+# extra 'offset' field giving where the packet starts in the file.
+def decode_file(path):
+    with open(path, 'rb') as file:
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            data = b''  # an empty file can not be mapped
+        try:
+            return decode_bytes(np.frombuffer(data, dtype=np.uint8))
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+# decode every packet in a uint8 array, a chunk at a time so the memory used does not grow with the capture
+def decode_bytes(data):
+    results = {packet_type: [] for packet_type in PACKET_DTYPES}
+    size = len(data)
+    chunk_start = 0
+    last_end = 0  # where the last good packet ended, a packet that ran over a chunk's end hides headers in the next
+    while chunk_start < size:
+        # each chunk only starts packets before its end, but may read past it to finish the last one
+        chunk_end = min(size, chunk_start + CHUNK_SIZE)
+        window = data[chunk_start:min(size, chunk_end + _LONGEST_PACKET)]
+        packets_by_type, window_end = decode_chunk(window, chunk_end - chunk_start, max(0, last_end - chunk_start))
+        for packet_type, packets in packets_by_type.items():
+            packets['offset'] += chunk_start
+            results[packet_type].append(packets)
+        last_end = max(last_end, chunk_start + window_end)
+        chunk_start = chunk_end
+
+    decoded = {}
+    for packet_type, chunks in results.items():
+        decoded[PACKET_NAMES[packet_type]] = np.concatenate(chunks) if len(chunks) > 0 else \
+            np.zeros(0, dtype=_with_offset(PACKET_DTYPES[packet_type]))
+    return decoded
+
+
+# find, check and decode the packets that start in the first start_limit bytes of window and not before last_end.
+# It returns the packets by type and where the last good packet in the window ends.
+def decode_chunk(window, start_limit, last_end=0):
+    size = len(window)
+    if size < PACKET_OVERHEAD:
+        return {}, last_end
+    starts = np.flatnonzero((window[:-1] == 0xff) & (window[1:] == 0x47))
+    starts = starts[(starts >= last_end) & (starts < start_limit) & (starts + PACKET_HEADER_SIZE <= size)]
+    ends = starts + window[starts + 4].astype(np.int64) + PACKET_OVERHEAD
+    keep = ends <= size
+    starts = starts[keep]
+    ends = ends[keep]
+
+    # The live decoder skips over every packet with a good CRC, whatever its type, so every header is checked here
+    # too.  Packets of the same length are checked together as one block of rows.
+    good = np.zeros(len(starts), dtype=bool)
+    for frame_size in np.unique(ends - starts):
+        same_size = np.flatnonzero(ends - starts == frame_size)
+        rows = _rows(window, starts[same_size], frame_size)
+        good[same_size] = crc16_rows(rows) == 0
+    starts = starts[good]
+    ends = ends[good]
+    if len(starts) == 0:
+        return {}, last_end
+
+    # A header that turns up inside a good packet is payload that happened to look like one, the live decoder would
+    # never have seen it.  Only packets that are kept hide the headers after them, which is worked out by keeping
+    # every packet that starts after the packets kept so far end, until nothing changes.  Each pass settles at least
+    # the next packet that overlaps another one, and those are rare, so it only takes a few passes.
+    keep = np.ones(len(starts), dtype=bool)
+    while True:
+        kept_ends = np.where(keep, ends, 0)
+        previous_end = np.maximum.accumulate(np.concatenate(([last_end], kept_ends[:-1])))
+        new_keep = starts >= previous_end
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+    starts = starts[keep]
+    ends = ends[keep]
+    last_end = int(ends[-1]) if len(ends) > 0 else last_end
+
+    # only the known packet types with the right length are decoded, the rest are skipped like the live decoder does
+    packet_types = window[starts + 2].astype(np.uint16) | (window[starts + 3].astype(np.uint16) << 8)
+    known = np.zeros(len(starts), dtype=bool)
+    for packet_type, dtype in PACKET_DTYPES.items():
+        known |= (packet_types == packet_type) & (ends - starts == dtype.itemsize + PACKET_HEADER_SIZE)
+    valid_starts = starts[known]
+    valid_types = packet_types[known]
+
+    decoded = {}
+    for packet_type, dtype in PACKET_DTYPES.items():
+        packet_starts = valid_starts[valid_types == packet_type]
+        if len(packet_starts) == 0:
+            continue
+        payloads = _rows(window, packet_starts + PACKET_HEADER_SIZE, dtype.itemsize).view(dtype).ravel()
+
+        packets = np.zeros(len(payloads), dtype=_with_offset(dtype))
+        for name in dtype.names:
+            packets[name] = payloads[name]
+        packets['offset'] = packet_starts
+        decoded[packet_type] = packets
+    return decoded, last_end
+
+
+# copy the size bytes at each start out of window as the rows of a uint8 array.  The rows are picked out of a strided
+# view of every size byte run in window, so no index array bigger than starts is ever made.
+def _rows(window, starts, size):
+    runs = np.lib.stride_tricks.as_strided(window, shape=(len(window) - size + 1, size),
+                                           strides=(window.strides[0], window.strides[0]), writeable=False)
+    return runs[starts]
+
+
+# CRC16 (modbus) of every row of a uint8 array at once.  A row that is a whole packet comes out 0 if it is intact.
+def crc16_rows(rows):
+    crc = np.full(len(rows), 0xFFFF, dtype=np.uint16)
+    for column in range(rows.shape[1]):
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ rows[:, column]) & 0xFF]
+    return crc
+
+
+# a packed copy of a packet dtype without the padding, with the offset of the packet in the capture added
+def _with_offset(dtype):
+    return np.dtype([('offset', '<i8')] + [(name, dtype.fields[name][0]) for name in dtype.names])
+
+
+if __name__ == "__main__":
+    main()
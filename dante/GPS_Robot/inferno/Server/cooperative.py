@@ -0,0 +1,171 @@
+from grid import OPEN_SPACE
+import numpy as np
+import heapq
+import threading
+
+
+# This class plans paths for several rovers sharing one grid so that they never run into each other (cooperative a*).
+# Rovers are planned one after another.  Every planned path is written into a space-time reservation table, which
+# later rovers treat as moving obstacles: a cell can only hold one rover at each time step, two rovers can not swap
+# cells in the same step, and a rover that has arrived keeps its destination to itself from then on.
+# Until a rover has been planned nobody knows when it leaves its starting cell, so that cell is kept clear for good
+# until then.  A rover that can not be planned stays where it is, and nobody has been routed through it.
+# Every step takes one unit of time, whether it is a move or a wait.
+class CooperativePlanner:
+    def __init__(self, grid, max_steps=None):
+        self.grid = grid
+        self.max_steps = max_steps  # the longest a single rover's plan may take, worked out from its route if None
+        self.__lock = threading.Lock()
+
+        # reservation table
+        self.__cells = set()  # (time, cell) pairs that are taken
+        self.__moves = set()  # (time, from cell, to cell) moves that are taken
+        self.__parked = {}  # cell -> time a rover arrives there and stays for good
+        self.__last_reserved = {}  # cell -> last time any rover passes through it
+        self.__held = set()  # starting cells of rovers that have not been planned yet, taken at every time
+
+    # plan a path for every rover at once.  agents is a list of (start, end) node pairs, in order of priority.
+    # It returns a (path, simple_path) tuple for each of them in the same order.  A path has one node per time step,
+    # so a rover waiting in place shows up as the same node more than once.  A rover with no safe route gets an empty
+    # path and is kept where it is.
+    def find_paths(self, agents):
+        with self.__lock:
+            self.__clear_reservations()
+
+            # a rover's starting cell belongs to it until it has been planned, rovers with nowhere to go never leave
+            for start, end in agents:
+                if start is None:
+                    continue
+                if self.__needs_path(start, end):
+                    self.__held.add(start.index)
+                else:
+                    self.__reserve(start.index, [])
+
+            results = []
+            for start, end in agents:
+                if not self.__needs_path(start, end):
+                    results.append(([], []))
+                    continue
+
+                self.__held.discard(start.index)
+                cells = self.__space_time_search(start.index, end.index)
+                self.__reserve(start.index, cells)
+
+                path = [self.grid.get_node_from_index(cell) for cell in cells]
+                results.append((path, self.grid.simplify_path(path) if len(path) > 0 else []))
+            return results
+
+    # if the pathfinding solution is worth calculating.
+    @staticmethod
+    def __needs_path(start, end):
+        return start is not None and end is not None and start != end and end.node_type == OPEN_SPACE
+
+    def __clear_reservations(self):
+        self.__cells = set()
+        self.__moves = set()
+        self.__parked = {}
+        self.__last_reserved = {}
+        self.__held = set()
+
+    # write a path that starts at start into the table, the rover parks on its last cell
+    def __reserve(self, start, cells):
+        previous = start
+        for time, cell in enumerate(cells, 1):
+            self.__cells.add((time, cell))
+            self.__moves.add((time, previous, cell))
+            self.__last_reserved[cell] = max(self.__last_reserved.get(cell, 0), time)
+            previous = cell
+        self.__last_reserved[start] = max(self.__last_reserved.get(start, 0), 0)
+        self.__parked[previous] = len(cells)
+
+    # can a rover step from cell to neighbor, arriving at time
+    def __is_free(self, cell, neighbor, time):
+        if neighbor in self.__held or (time, neighbor) in self.__cells:
+            return False
+        parked = self.__parked.get(neighbor)
+        if parked is not None and parked <= time:
+            return False
+
+        # the rover coming the other way would pass straight through this one
+        return (time, neighbor, cell) not in self.__moves
+
+    # a* over (time, cell) states.  It returns the cell ids from start (exclusive) to end, one per time step.
+    def __space_time_search(self, start, end):
+        grid = self.grid
+        size_y = grid.nodes_in_y
+        size_x = grid.nodes_in_x
+        cell_types = grid.flat_types
+        diagonals = grid.include_diagonals
+        end_x, end_y = divmod(end, size_y)
+        max_steps = self.max_steps if self.max_steps is not None else self.__horizon(start, end)
+
+        # a rover may only stop for good once nobody else needs its destination any more
+        earliest_finish = self.__last_reserved.get(end, -1) + 1
+
+        def heuristic(cell):
+            x, y = divmod(cell, size_y)
+            dst_x = abs(x - end_x)
+            dst_y = abs(y - end_y)
+            return grid.diagonal_weight * min(dst_x, dst_y) + grid.non_diagonal_weight * abs(dst_x - dst_y)
+
+        costs = {(0, start): 0.0}
+        parents = {}
+        open_set = [(heuristic(start), 0, start)]
+        closed = set()
+        truncated = False
+        while len(open_set) > 0:
+            _, time, cell = heapq.heappop(open_set)
+            state = (time, cell)
+            if state in closed:
+                continue
+            closed.add(state)
+
+            if cell == end and time >= earliest_finish:
+                path = []
+                while state in parents:
+                    path.append(state[1])
+                    state = parents[state]
+                path.reverse()
+                return path
+            if time >= max_steps:
+                truncated = True
+                continue
+
+            x, y = divmod(cell, size_y)
+            cost = costs[(time, cell)]
+            for i in range(-1, 2):
+                for j in range(-1, 2):
+                    if i != 0 and j != 0 and not diagonals:
+                        continue
+                    if not (0 <= x + i < size_x and 0 <= y + j < size_y):
+                        continue
+                    neighbor = cell + i * size_y + j
+
+                    # waiting is always allowed, even for a rover that starts on a border cell
+                    if (neighbor != cell and cell_types[neighbor] != OPEN_SPACE) or \
+                            not self.__is_free(cell, neighbor, time + 1):
+                        continue
+
+                    # waiting costs as much as a straight step, so rovers only wait when going around is worse
+                    weight = grid.diagonal_weight if i != 0 and j != 0 else grid.non_diagonal_weight
+                    next_state = (time + 1, neighbor)
+                    new_cost = cost + weight
+                    if next_state not in closed and new_cost < costs.get(next_state, float("inf")):
+                        costs[next_state] = new_cost
+                        parents[next_state] = (time, cell)
+                        heapq.heappush(open_set, (new_cost + heuristic(neighbor), time + 1, neighbor))
+
+        if truncated:
+            print("cooperative planner gave up on the route from %s to %s after %d steps" %
+                  (divmod(start, size_y), divmod(end, size_y), max_steps))
+        return []
+
+    # the most steps a rover's plan may take: its route with nobody else around, a wait for every step some other
+    # rover has reserved, and room for a detour around rovers that are parked or not planned yet.
+    # Without a route (a rover starting on a border) every open cell might have to be visited.
+    def __horizon(self, start, end):
+        detour = 2 * (self.grid.nodes_in_x + self.grid.nodes_in_y) + len(self.__cells) + len(self.__parked)
+        cells = self.grid.find_cells(start, end)
+        if len(cells) == 0:
+            return int(np.count_nonzero(self.grid.flat_types == OPEN_SPACE)) + detour
+        return len(cells) + detour
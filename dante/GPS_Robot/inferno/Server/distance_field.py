@@ -0,0 +1,37 @@
+from incremental import IncrementalSearch, INFINITY
+from grid import OPEN_SPACE
+
+
+# This class keeps the cost from every cell of a grid to a single root cell, usually the rover's home.
+# It is the incremental search with no start to aim for: the whole field is found once with dijkstra, after that a
+# grid change only repairs the costs that went through the changed cells, so the route from any cell to the root is
+# just a walk downhill through the field.
+class DistanceField(IncrementalSearch):
+    def __init__(self, grid, root):
+        IncrementalSearch.__init__(self, grid, root)
+
+        # grow the whole field out from the root now, so the first route is as quick as every other one
+        self._compute(None)
+
+    # the cost of the cheapest route from a node to the root, inf if there is none
+    def cost(self, node):
+        with self._lock:
+            self.__bring_up_to_date()
+            return self._g_costs[node.index]
+
+    # get the path from start to the root, in the same form as Grid.find_path
+    def plan(self, start):
+        # if the pathfinding solution is not worth calculating.
+        if start is None or start == self.root or self.root.node_type != OPEN_SPACE:
+            return [], []
+
+        with self._lock:
+            self.__bring_up_to_date()
+            cells = self._extract_path(start.index)
+        return self._make_path(start, cells)
+
+    # bring the field up to date with every change made to the grid since it was last used
+    def __bring_up_to_date(self):
+        if len(self._changed_cells) > 0:
+            self._repair(None)
+            self._compute(None)
@@ -0,0 +1,90 @@
+from threading import Thread
+import time
+
+# how often the sensor is read, the distance sensor needs about 30 ms a reading
+DEFAULT_RATE = 20
+
+# how many readings the buffer holds and how many the median filter looks at
+DEFAULT_DEPTH = 64
+MEDIAN_SIZE = 5
+
+
+# This class reads the distance sensor on its own thread so the slow i2c reading never holds up the driving loop.
+# Every reading goes into a ring buffer with the time it was taken and where the rover was at that moment.
+# Only this thread writes to the buffer.  A slot is filled before the count is raised, so readers never need a lock:
+# they look at the count first and only read slots it says are full.
+class DistanceSampler(Thread):
+    def __init__(self, read_distance, get_pose=None, rate=DEFAULT_RATE, depth=DEFAULT_DEPTH):
+        Thread.__init__(self)
+        self.daemon = True
+        self.read_distance = read_distance  # returns the distance in cm
+        self.get_pose = get_pose  # returns where the rover is, stored as it is with each reading
+        self.rate = rate
+        self.depth = depth
+        self.__samples = [None] * depth  # (timestamp, distance, pose)
+        self.__count = 0
+        self.__thread_done = False
+
+    # read at the set rate until stopped
+    def run(self):
+        period = 1.0 / self.rate
+        next_tick = time.time()
+        while not self.__thread_done:
+            self.sample()
+
+            next_tick += period
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.time()
+
+    def stop(self):
+        self.__thread_done = True
+
+    # take one reading, a failed i2c read is skipped.  It returns whether a reading was stored.
+    def sample(self):
+        pose = self.get_pose() if self.get_pose is not None else None
+        try:
+            distance = self.read_distance()
+        except IOError:
+            return False
+        self.__samples[self.__count % self.depth] = (time.time(), distance, pose)
+        self.__count += 1
+        return True
+
+    # how many readings have been taken so far, it only goes up.  Comparing it tells if there is a new reading.
+    def count(self):
+        return self.__count
+
+    # the newest (timestamp, distance, pose), or None before the first reading
+    def latest(self):
+        count = self.__count
+        if count == 0:
+            return None
+        return self.__samples[(count - 1) % self.depth]
+
+    # up to size of the newest readings, oldest first.  If seconds is set only readings that recent are kept.
+    def window(self, size=None, seconds=None):
+        count = self.__count
+        size = self.depth if size is None else min(size, self.depth)
+        size = min(size, count)
+        samples = [self.__samples[i % self.depth] for i in range(count - size, count)]
+        if seconds is not None:
+            oldest = time.time() - seconds
+            samples = [sample for sample in samples if sample[0] >= oldest]
+        return samples
+
+    # the median distance of the newest readings, which throws out the odd bad reading, along with the newest
+    # reading itself.  It returns None before the first reading.
+    def median(self, size=MEDIAN_SIZE, seconds=None):
+        samples = self.window(size, seconds)
+        if len(samples) == 0:
+            return None
+        distances = sorted(sample[1] for sample in samples)
+        middle = len(distances) // 2
+        if len(distances) % 2 == 1:
+            distance = distances[middle]
+        else:
+            distance = (distances[middle - 1] + distances[middle]) / 2.0
+        return distance, samples[-1]
@@ -1,18 +1,39 @@
 from marvelmind import MarvelmindHedge
+from pose_estimator import PoseEstimator, quaternion_yaw
+from hedge_samples import HedgeSampleStore
+from path_follower import PathFollower, TURN_IN_PLACE_ANGLE
+from distance_sampler import DistanceSampler
 import time
 import math
 from vector import Vector
-from threading import Thread
+from threading import Thread, Condition
+import asyncio
+import queue
 
 DISTANCE_FROM_CENTER = 15
 
+# the most often each part of the driving loop may run, in seconds.  The loop itself only wakes up for new positions.
+OBSTACLE_CHECK_PERIOD = .1  # the distance sensor is read over i2c
+POSITION_REPORT_PERIOD = .1  # every report is sent over the network
+MAX_POSITION_WAIT = .1  # the longest to wait for the hedge, so obstacles are still checked if it goes quiet
+IDLE_PERIOD = .1  # how often the position and obstacles are checked while there is nothing to do
+
+# where the hedges sit on the rover, in meters in front of the middle of the wheels (negative is behind).
+# These need measuring again if the hedges are moved.
+FRONT_HEDGE_OFFSET = .06
+REAR_HEDGE_OFFSET = -.1
+
+# the slowest a wheel is ever told to turn, in degrees a second.  A limit of 0 means no limit at all to the motors.
+MIN_WHEEL_SPEED = 5
+
 
 # This class serves as a wrapper for marvelmind and gopigo movement.
 # It uses them together to find its way to destinations
 class GPS(Thread):
 
     # initialize the class
-    def __init__(self, front_hedge, rear_hedge, gopigo, speed=300, q=None, debug_mode=False):
+    def __init__(self, front_hedge, rear_hedge, gopigo, speed=300, q=None, debug_mode=False, use_estimator=True,
+                 start_threads=True):
         Thread.__init__(self)
 
         # initialize the gopigo components
@@ -27,21 +48,56 @@ class GPS(Thread):
         self.__cancel_early = False
         self.__thread_done = False
 
+        # new hedge positions are counted, the driving loop sleeps on this until the count changes
+        self.__position_count = 0
+        self.__position_changed = Condition()
+        self.__position_event = None  # the same for the asyncio core, set while run_async is going
+        self.__loop = None
+
         # setup geometry information
         self.__transform = Transform()
+        self.__front_position = Vector()
         self.__rear_position = Vector()
+        self.__pose_covariance = None
         self.__speed = speed
         self.gpg.set_speed(speed)
         self.__destination = None
+        self.__wheel_circumference = self.gpg.get_wheel_circumference()
+        self.__follower = PathFollower(self.gpg.get_wheel_base(), self.__wheel_speed_to_meters(speed),
+                                       self.__threshold)
 
         # setup thread information
         self.path = []
 
+        # the pose estimator fuses the hedges, encoders and imu, without it the hedges are used as they are
+        self.__estimator = None
+        self.__hedge_samples = HedgeSampleStore()  # recent timestamped samples of both hedges
+        if use_estimator:
+            self.__estimator = PoseEstimator(self.gpg.read_encoders, self.gpg.get_wheel_circumference(),
+                                             self.gpg.get_wheel_base(), pose_callback=self.__on_pose)
+
         # start the hedge
         self.__front_hedge = front_hedge
         self.__rear_hedge = rear_hedge
-        self.__hedge = MarvelmindHedge(tty="/dev/ttyACM0", recieveUltrasoundPositionCallback=self.position_update)
-        self.__hedge.start()
+        self.__hedge_sequences = {}  # hedge address -> sequence of the last sample used
+        self.__hedge = MarvelmindHedge(tty="/dev/ttyACM0", recieveImuDataCallback=self.__on_imu_data)
+        self.__hedge.add_address_callback(front_hedge, self.__on_hedge_position)
+        self.__hedge.add_address_callback(rear_hedge, self.__on_hedge_position)
+        if start_threads:
+            self.__hedge.start()
+            if self.__estimator is not None:
+                self.__estimator.start()
+
+        # the distance sensor is read on its own thread, each reading remembers where the rover was when it was taken
+        self.__distance_sampler = DistanceSampler(self.distance_sensor.read, self.__get_pose)
+        self.__distance_count = 0  # readings already checked for obstacles
+        if start_threads:
+            self.__distance_sampler.start()
+
+        # the state of the path being followed, kept between steps
+        self.__last_update = 0.0
+        self.__next_obstacle_check = 0.0
+        self.__next_position_report = 0.0
 
         # setup callbacks
         self.__position_callback = None
@@ -59,37 +115,129 @@ class GPS(Thread):
         # FOREVER
         while not self.__thread_done:
 
+            # wait for a command, a new point is acted on as soon as it arrives
+            try:
+                command = self.__command_queue.get(timeout=IDLE_PERIOD)
+            except queue.Empty:
+                command = None
+
             # if we have a command
-            if not self.__command_queue.empty():
-                command = self.__command_queue.get()
+            if command is not None:
                 print("point received", command)
-
-                # goto point
-                self.__destination = command
-                self.goto_point(self.__destination)
+                self.follow_path(self.__command_waypoints(command))
 
             # if we have nothing to do
             else:
                 # update where we are and run callbacks
                 self.get_position_callback()
                 self.check_for_obstacles()
-                time.sleep(.1)
         self.stop()
         print("GPS Thread stopped")
 
-    # A callback sent to the hedge, it changes the position and rotation information every time it receives an update.
-    def position_update(self):
-        position = self.__hedge.position()
-        if position[0] == self.__front_hedge:
-            self.__transform.position = self.__convert_hedge_coords(position)
-        else:
-            self.__rear_position = self.__convert_hedge_coords(position)
-        self.__transform.rotation = self.get_angle(self.__transform.position, self.__rear_position)
+    # the same as run for the asyncio core, which has to have been started with start_threads=False.
+    # The hedge, estimator and distance sampler are driven by the core instead of their own threads.
+    async def run_async(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__position_event = asyncio.Event()
+        while not self.__thread_done:
+            try:
+                command = self.__command_queue.get_nowait()
+            except queue.Empty:
+                command = None
 
-    # converts a hedge position into a 2D Vector in the transform
+            if command is not None:
+                print("point received", command)
+                await self.follow_path_async(self.__command_waypoints(command))
+            else:
+                self.get_position_callback()
+                self.check_for_obstacles()
+                await asyncio.sleep(IDLE_PERIOD)
+        self.__position_event = None
+        print("GPS coroutine stopped")
+
+    # a list of points is driven through without stopping, a single point is driven straight to
     @staticmethod
-    def __convert_hedge_coords(position):
-        return Vector(position[1], position[2])
+    def __command_waypoints(command):
+        return command if isinstance(command, list) else [command]
+
+    # Brings the position and rotation information up to date with every hedge sample that has not been used yet.
+    # The hedge keeps the samples of each address apart, so front and rear are never mixed up.
+    # With the estimator running the samples are handed to it instead, and the transform follows the estimate.
+    def position_update(self, address=None):
+        addresses = (self.__front_hedge, self.__rear_hedge) if address is None else (address,)
+        for address in addresses:
+            for sequence, timestamp, x, y, _ in self.__hedge.samples_since(address,
+                                                                          self.__hedge_sequences.get(address, -1)):
+                self.__hedge_sequences[address] = sequence
+                self.__use_hedge_sample(address, timestamp, Vector(x, y))
+
+    def __use_hedge_sample(self, address, timestamp, sample):
+        is_front = address == self.__front_hedge
+        if is_front:
+            self.__front_position = sample
+        else:
+            self.__rear_position = sample
+
+        # every sample is only used once, the position is asked for again whenever obstacles are checked
+        if not self.__hedge_samples.add(address, timestamp, sample.x, sample.y):
+            return
+
+        # the hedges take turns, so the rear hedge is moved to the moment the front one was measured before the two
+        # are compared.  Without the estimator the front position is also carried forward by how late it arrived.
+        if self.__estimator is None:
+            position_now = self.__hedge_samples.position_now(self.__front_hedge)
+            heading = self.__hedge_samples.heading(self.__front_hedge, self.__rear_hedge, self.get_angle)
+            self.__transform.position = self.__front_position if position_now is None else position_now
+            if heading is not None:
+                self.__transform.rotation = heading
+            return
+
+        # the first time both hedges have been heard from gives a rough heading to start from
+        if not self.__estimator.has_heading() and self.__hedge_samples.has_samples(self.__front_hedge) \
+                and self.__hedge_samples.has_samples(self.__rear_hedge):
+            beacon_time, front = self.__hedge_samples.latest(self.__front_hedge)
+            self.__estimator.initialize_heading(front, self.__hedge_samples.position_at(self.__rear_hedge,
+                                                                                        beacon_time))
+
+        offset = FRONT_HEDGE_OFFSET if is_front else REAR_HEDGE_OFFSET
+        self.__estimator.update_hedge(sample.x, sample.y, offset)
+
+    # the estimator calls this with every new pose, the transform stays where the front hedge is
+    def __on_pose(self, x, y, heading, covariance):
+        front_x, front_y = self.__estimator.point_ahead(FRONT_HEDGE_OFFSET)
+        self.__transform.position = Vector(front_x, front_y)
+        self.__transform.rotation = heading
+        self.__pose_covariance = covariance
+
+        # a fresh estimate is as good as a new hedge position to the driving loop
+        self.__notify_position()
+
+    # the hedge thread calls this for every processed imu packet
+    def __on_imu_data(self):
+        if self.__estimator is not None:
+            values = self.__hedge.valuesImuData[-1]
+            self.__estimator.update_heading(quaternion_yaw(values[3], values[4], values[5], values[6]))
+
+    # the hedge thread calls this for every new position of the front or rear hedge, it wakes up the driving loop
+    def __on_hedge_position(self, address):
+        self.position_update(address)
+        self.__notify_position()
+
+    # wake up whichever driving loop is running.  Under the asyncio core this is only ever called on the loop.
+    def __notify_position(self):
+        with self.__position_changed:
+            self.__position_count += 1
+            self.__position_changed.notify_all()
+        if self.__position_event is not None:
+            self.__position_event.set()
+
+    # sleep until the hedge has sent a position newer than count, or until timeout.
+    # It returns the newest count, which is the same as count if nothing arrived.
+    def __wait_for_position(self, count, timeout):
+        with self.__position_changed:
+            if self.__position_count == count and not self.__cancel_early:
+                self.__position_changed.wait(timeout)
+            return self.__position_count
 
     # the following methods set callbacks or get them.
     # If they are getting them, they will do nothing if None is used
@@ -124,6 +272,10 @@ class GPS(Thread):
 
     def cancel_movement(self):
         self.__cancel_early = True
+        with self.__position_changed:
+            self.__position_changed.notify_all()
+        if self.__position_event is not None:
+            self.__loop.call_soon_threadsafe(self.__position_event.set)
 
     def stop_thread(self):
         self.__thread_done = False
@@ -151,13 +303,39 @@ class GPS(Thread):
     def get_position(self):
         return self.__transform.position
 
+    # the position and rotation together, the transform's position is replaced rather than changed so this is safe to
+    # keep
+    def __get_pose(self):
+        return self.__transform.position, self.__transform.rotation
+
     # get the current rotation
     def get_rotation(self):
         return self.__transform.rotation
 
+    # the parts the asyncio core drives itself when the gps is made with start_threads=False
+    def get_hedge(self):
+        return self.__hedge
+
+    def get_estimator(self):
+        return self.__estimator
+
+    def get_distance_sampler(self):
+        return self.__distance_sampler
+
+    # the covariance of the x, y and heading estimate, None without the estimator
+    def get_pose_covariance(self):
+        return self.__pose_covariance
+
+    # how old the newest front hedge position is in seconds, delay included, or None before the first one
+    def get_position_age(self):
+        return self.__hedge_samples.age(self.__front_hedge)
+
     # this stops the hedge from recording positions
     def stop(self):
         self.__hedge.stop()
+        self.__distance_sampler.stop()
+        if self.__estimator is not None:
+            self.__estimator.stop()
         self.gpg.stop()
         self.__cancel_early = True
         self.__thread_done = True
@@ -184,135 +362,145 @@ class GPS(Thread):
 
     # travel to a given destination
     def goto_point(self, coord):
+        self.follow_path([coord])
 
-        # mark our new destination
-        self.__destination = coord
-
-        # default local variables
-        sleep_tick = .00100
-        distance_threshold = self.__threshold
-        previous_locations = []
-        self.__cancel_early = False
-
-        # if we are already there, don't do anything
-        if self.distance_to_destination() <= distance_threshold:
-            self.__destination = None
-            self.get_reached_point_callback()
-            self.gpg.set_speed(self.__speed)
+    # drive through every waypoint in turn without stopping at any but the last one.
+    # The follower steers by setting the speed limit of each wheel while the motors run forward.
+    def follow_path(self, waypoints):
+        if not self.__start_path(waypoints):
             return
 
-        # prep to move
-        self.turn_to_face(coord)
-        self.check_for_obstacles()
-        time.sleep(sleep_tick)
-        dst = self.distance_to_destination()
-        self.__determine_speed(dst)
-
-        # time to move
-        self.gpg.forward()
-
-        # while we haven't found our destination
-        while dst >= distance_threshold:
-
-            # if we need to cancel early
-            if self.__cancel_early:
-                self.gpg.stop()
-                self.__cancel_early = False
-                self.gpg.set_speed(self.__speed)
-                print("canceling early")
+        # while we haven't found our destination, sleep until the hedge says something new
+        position_count = self.__position_count
+        while True:
+            new_count = self.__wait_for_position(position_count, MAX_POSITION_WAIT)
+            if self.__follow_step(new_count != position_count):
                 return
+            position_count = new_count
 
-            # update distance
-            dst = self.distance_to_destination()
-            self.get_position_callback()
-
-            # check for obstacles
-            self.check_for_obstacles()
-
-            # slow down if needed
-            self.__determine_speed(dst)
-            time.sleep(sleep_tick)
+    # the same as follow_path for the asyncio core
+    async def follow_path_async(self, waypoints):
+        if not self.__start_path(waypoints):
+            return
 
-            # prep for rotation re-evaluation
-            previous_locations.append(Vector(self.__transform.position))
+        position_count = self.__position_count
+        while True:
+            if self.__position_count == position_count and not self.__cancel_early:
+                self.__position_event.clear()
+                try:
+                    await asyncio.wait_for(self.__position_event.wait(), MAX_POSITION_WAIT)
+                except asyncio.TimeoutError:
+                    pass
+            new_count = self.__position_count
+            if self.__follow_step(new_count != position_count):
+                return
+            position_count = new_count
 
-            # have we been going straight long enough to determine our own rotation?
-            if len(previous_locations) == 2:
+    # get ready to follow waypoints and start the motors.  It returns False if there is nowhere to go.
+    def __start_path(self, waypoints):
 
-                # are we on an intercept trajectory?
-                corrections = self.__plot_intersection()
-                if corrections != 0:
+        # mark our new destination
+        self.__destination = waypoints[-1]
+        self.__cancel_early = False
 
-                    # correct rotation
-                    self.gpg.stop()
-                    self.turn_to_face(coord)
+        # if we are already there, don't do anything
+        if len(waypoints) == 1 and self.distance_to_destination() <= self.__threshold:
+            self.__finish_path()
+            return False
+
+        # prep to move, the follower can not drive away from a path that is behind the rover
+        self.__follower.max_speed = self.__wheel_speed_to_meters(self.__speed)
+        self.__follower.start(self.__transform.position, waypoints)
+        self.__face_path()
+        self.check_for_obstacles()
 
-                    # reset
-                    self.__determine_speed(dst)
-                    self.gpg.forward()
-                    previous_locations = []
+        # time to move, the wheels start slow and the follower speeds them up
+        self.__set_wheel_speeds(0.0, 0.0)
+        self.gpg.forward()
 
-                # we are going the wrong way and are lost
-                elif self.__distance(previous_locations[0], self.__destination) < self.distance_to_destination():
+        # when each of the rate limited steps may run next
+        self.__last_update = time.time()
+        self.__next_obstacle_check = time.time() + OBSTACLE_CHECK_PERIOD
+        self.__next_position_report = time.time()
+        return True
 
-                    # reorient ourselves
-                    self.gpg.stop()
-                    self.turn_to_face(coord)
+    # one pass of the driving loop, has_position is set if there is a new position since the last one.
+    # It returns True once the path is over, whether it was finished or cancelled.
+    def __follow_step(self, has_position):
 
-                    # reset
-                    self.__determine_speed(dst)
-                    self.gpg.forward()
-                    previous_locations = []
+        # if we need to cancel early
+        if self.__cancel_early:
+            self.gpg.stop()
+            self.__cancel_early = False
+            self.gpg.set_speed(self.__speed)
+            print("canceling early")
+            return True
 
-                # everything is running fine, remove the oldest position
-                else:
-                    previous_locations.pop(0)
+        now = time.time()
+        if now >= self.__next_position_report:
+            self.get_position_callback()
+            self.__next_position_report = now + POSITION_REPORT_PERIOD
 
-            # print debug info
-            if self.__debug:
-                print("distance", dst)
-                print("current position", self.__transform.position)
-                print("current rotation", self.__transform.rotation)
-                print("destination", coord)
-                print("************************")
+        # check for obstacles
+        if now >= self.__next_obstacle_check:
+            self.check_for_obstacles()
+            self.__next_obstacle_check = now + OBSTACLE_CHECK_PERIOD
+
+        # nothing else can change until we know where we are
+        if not has_position:
+            return False
+
+        # steer towards the path
+        left, right, done = self.__follower.update(self.__transform.position, self.__transform.rotation,
+                                                   now - self.__last_update)
+        self.__last_update = now
+        if done:
+            # We found the destination do final status update
+            self.gpg.stop()
+            self.get_position_callback()
+            self.__finish_path()
+            return True
+
+        # we are going the wrong way and are lost, reorient ourselves
+        if abs(self.__follower.heading_error(self.__transform.position, self.__transform.rotation)) > \
+                TURN_IN_PLACE_ANGLE:
+            self.gpg.stop()
+            self.__face_path()
+            self.__set_wheel_speeds(0.0, 0.0)
+            self.gpg.forward()
+            self.__last_update = time.time()
+            return False
+        self.__set_wheel_speeds(left, right)
 
-        # We found the destination do final status update
-        self.gpg.stop()
-        self.get_position_callback()
-        self.get_reached_point_callback()
+        # print debug info
+        if self.__debug:
+            print("distance", self.__follower.remaining(self.__transform.position))
+            print("current position", self.__transform.position)
+            print("current rotation", self.__transform.rotation)
+            print("wheel speeds", left, right)
+            print("destination", self.__destination)
+            print("************************")
+        return False
+
+    def __finish_path(self):
         self.__destination = None
+        self.get_reached_point_callback()
         self.gpg.set_speed(self.__speed)
 
-    # gps is inaccurate at times, so if we are close we should slowdown to increase fidelity.
-    def __determine_speed(self, dst):
-        # if we are approaching the destination, slow down for more accuracy
-        if dst <= self.__threshold * 10:
-            self.gpg.set_speed(self.__speed / 2)
-        else:
-            self.gpg.set_speed(self.__speed)
+    # turn on the spot to face the path if it is too far to one side to steer onto
+    def __face_path(self):
+        error = self.__follower.heading_error(self.__transform.position, self.__transform.rotation)
+        if abs(error) > TURN_IN_PLACE_ANGLE:
+            self.turn_to_angle((self.__transform.rotation + error) % 360)
 
-    # This method is used to calculate an intercept trajectory with the circle surrounding the destination point.
-    # it returns 0 if the trajectory bisects at all (tangents are considered misses)
-    # it then return -1 if the current angle is greater, or 1 if it is the opposite
-    def __plot_intersection(self):
-        direction = self.__transform.position - self.__destination
-        vx = math.cos(self.__transform.rotation)
-        vy = math.sin(self.__transform.rotation)
-        a = pow(vx, 2) + pow(vy, 2)
-        b = 2 * (vx * direction.x + vy * direction.y)
-        c = pow(direction.x, 2) + pow(direction.y, 2) - pow(self.__threshold / 2, 2)
-        det = pow(b, 2) - 4 * a * c
-
-        # if it hits somehow
-        if det < 0:
-            return 0
-        else:
-            angle = self.get_angle(self.__transform.position, self.__destination)
-            angle -= self.__transform.rotation
-            if angle < 0:
-                return -1
-            else:
-                return 1
+    # set the speed limit of each wheel in meters a second, the motors must be running forward
+    def __set_wheel_speeds(self, left, right):
+        self.gpg.set_left_wheel(max(MIN_WHEEL_SPEED, left / self.__wheel_circumference * 360))
+        self.gpg.set_right_wheel(max(MIN_WHEEL_SPEED, right / self.__wheel_circumference * 360))
+
+    # convert a wheel speed in degrees a second to meters a second
+    def __wheel_speed_to_meters(self, speed):
+        return speed / 360.0 * self.__wheel_circumference
 
     # rotate left by degrees
     def __turn_left(self, degrees):
@@ -405,33 +593,32 @@ class GPS(Thread):
         angle = self.get_angle(coord, self.__transform.position)
         self.turn_to_angle(angle)
 
-    # checks for an obstacle and reports its position to a callback
+    # checks for an obstacle and reports its position to a callback.
+    # The newest readings of the distance sensor are filtered, nothing is done until there is a new one.
     def check_for_obstacles(self):
         # check for obstacle
         self.position_update()
-        distance = self.distance_sensor.read()
+        count = self.__distance_sampler.count()
+        if count == self.__distance_count:
+            return
+        self.__distance_count = count
+        distance, (_, _, (position, rotation)) = self.__distance_sampler.median()
 
         # if it was close enough
         if distance <= self.__minimum_distance:
             # get its position and send to callback
-            distance += DISTANCE_FROM_CENTER
-            distance = distance / 100
-            x = (math.cos(math.radians(self.__transform.rotation)) * distance) + self.__transform.position.x
-            y = (math.sin(math.radians(self.__transform.rotation)) * distance) + self.__transform.position.y
-
-            pos = Vector(x, y)
-            self.get_obstacle_callback(pos)
+            self.get_obstacle_callback(self.__sensor_point(distance, position, rotation))
         else:
-            distance = self.__minimum_distance
-
             # get its position and send to callback
-            distance += DISTANCE_FROM_CENTER
-            distance = distance / 100
-            x = (math.cos(math.radians(self.__transform.rotation)) * distance) + self.__transform.position.x
-            y = (math.sin(math.radians(self.__transform.rotation)) * distance) + self.__transform.position.y
+            self.get_no_obstacle_callback(self.__sensor_point(self.__minimum_distance, position, rotation))
 
-            pos = Vector(x, y)
-            self.get_no_obstacle_callback(pos)
+    # where a distance sensor reading in cm puts the point it saw, seen from a pose
+    @staticmethod
+    def __sensor_point(distance, position, rotation):
+        distance = (distance + DISTANCE_FROM_CENTER) / 100
+        x = (math.cos(math.radians(rotation)) * distance) + position.x
+        y = (math.sin(math.radians(rotation)) * distance) + position.y
+        return Vector(x, y)
 
 
 # This is a little helper class that makes organizing position and rotation a little easier
@@ -1,13 +1,36 @@
 from vector import *
-import heapq
+from search import SearchScratch
+import numpy as np
 import traceback
+import struct
+import mmap
+import multiprocessing
+
+# shared memory arrived in python 3.8, batches run in this process without it
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 OPEN_SPACE = 0
 OBSTACLE = 1
 OBSTACLE_BORDER = 2
 
+# search algorithms
+A_STAR = "a*"
+JPS = "jps"
+
+# saved grid files: a fixed header followed by one byte per cell in cell id order
+GRID_FILE_MAGIC = b"GRID"
+GRID_FILE_VERSION = 1
+# magic, version, size x, size y, nodes in x, nodes in y, world x, world y, border thickness, diagonals.
+# The header is padded to 64 bytes so the cells start on an aligned offset.
+GRID_FILE_HEADER = struct.Struct("<4sH2xddIIddIB11x")
+
 
 # This class is used for creating a 2d square grid that implements an a* pathfinding solution.
+# Cell information is stored in flat arrays indexed by cell id (x * nodes_in_y + y) rather than one object per cell,
+# Node objects are only created on demand as light weight views into these arrays.
 class Grid:
     def __init__(self, size_x, size_y, node_x, node_y, world_x=0, world_y=0, border_thickness=0, diagonal_default=True):
         # initialize default values
@@ -23,43 +46,65 @@ class Grid:
         # pathfinding waits
         self.non_diagonal_weight = 10.0
         self.diagonal_weight = 14  # the hypotenuse of a 10,10 triangle is roughly 14
+        self.any_angle = True  # simple paths go straight between any two cells that can see each other
 
         # set up important count values
         self.__world_bottom_left = Vector(world_x,
                                           world_y)  # the base start of the grid, used for returning "true"coordinates
         self.__number_of_nodes = self.nodes_in_x * self.nodes_in_y
 
-        # these sets keep track of obstacles and borders for convenience.
-        self.all_obstacles = set()  # List of all obstacles on the map for easy retrieval
-        self.all_borders = set()  # List of all borders on the map for easy recalculations.
+        # these views keep track of obstacles and borders for convenience.
+        self.all_obstacles = NodeTypeView(self, OBSTACLE)  # all obstacles on the map for easy retrieval
+        self.all_borders = NodeTypeView(self, OBSTACLE_BORDER)  # all borders on the map
 
         # set up the grid
-        self.nodes = [[]]  # 2d array of coordinates
-        self.nodes = [[Node(0, 0, 0) for y in range(node_y)] for x in range(node_x)]
+        self.node_types = None  # 2d array of cell types, indexed [x, y]
+        self.flat_types = None  # the same array seen as one row, indexed by cell id
+        self.border_counts = None  # how many obstacles have each cell inside their border, indexed [x, y]
+        self.__border_kernel = self.__make_border_kernel()
         self.__create_grid()
-        Node.grid = self
+
+        # change tracking, the version goes up every time a change is published to the listeners
+        self.version = 0
+        self.__change_listeners = []
+        self.__pending_changes = []
+
+        # costs and parents belong to a single search, not to the grid
+        self.__scratch = SearchScratch(self.__number_of_nodes)
+        self.last_expansions = 0  # how many nodes the last search expanded
 
     # This method initializes the grid.  It should be run during the constructor and then never again.
     def __create_grid(self):
         # create a blank map
-        for x in range(0, self.nodes_in_x):
-            for y in range(0, self.nodes_in_y):
-                self.nodes[x][y] = Node(x, y, OPEN_SPACE)
+        self.node_types = np.zeros((self.nodes_in_x, self.nodes_in_y), dtype=np.uint8)
+        self.flat_types = self.node_types.reshape(-1)
+        self.border_counts = np.zeros((self.nodes_in_x, self.nodes_in_y), dtype=np.uint16)
 
     # get the number of nodes
     def get_num_of_nodes(self):
         return self.__number_of_nodes
 
+    # convert an x, y grid point into a cell id
+    def get_index(self, x, y):
+        return x * self.nodes_in_y + y
+
     # return a node from an x ,y grid point
     def get_node(self, x, y):
-        return self.nodes[x][y]
+        if x < 0 or y < 0 or x >= self.nodes_in_x or y >= self.nodes_in_y:
+            raise IndexError("node " + str(x) + " " + str(y) + " is outside of the grid")
+        return Node(self, int(x), int(y))
+
+    # return a node from a cell id
+    def get_node_from_index(self, index):
+        x, y = divmod(int(index), self.nodes_in_y)
+        return Node(self, x, y)
 
     # return a node from local coordinates.  like node_from_global_coord, but assuming bottom left is 0,0
     def node_from_local_coord(self, coords):
         x = int((coords.x) / self.node_length_x)
         y = int((coords.y) / self.node_length_y)
         if coords.x >= 0 and coords.x <= self.nodes_in_x and coords.y >= 0 and coords.y <= self.nodes_in_y:
-            temp = self.nodes[x][y]
+            temp = self.get_node(x, y)
         else:
             temp = None
         return temp
@@ -71,7 +116,7 @@ class Grid:
         try:
 
             if coords.x >= 0 and coords.x <= self.nodes_in_x and coords.y >= 0 and coords.y <= self.nodes_in_y:
-                temp = self.nodes[x][y]
+                temp = self.get_node(x, y)
             else:
                 temp = None
         except:
@@ -89,30 +134,71 @@ class Grid:
         return Vector(((node.gridPos.x + self.__world_bottom_left.x) * self.node_length_x) + (.5 * self.node_length_x),
                       ((node.gridPos.y + self.__world_bottom_left.y) * self.node_length_y) + (.5 * self.node_length_y))
 
+    # get the cell ids surrounding a cell id.  Without diagonals only the four straight neighbors are returned.
+    def get_neighbor_indices(self, index, diagonals=True):
+        x, y = divmod(index, self.nodes_in_y)
+        temp = []
+        for i in range(-1, 2):
+            for j in range(-1, 2):
+                if (i == 0 and j == 0) or (not diagonals and i != 0 and j != 0):
+                    continue
+                if 0 <= x + i < self.nodes_in_x and 0 <= y + j < self.nodes_in_y:
+                    temp.append(index + i * self.nodes_in_y + j)
+        return temp
+
     # get all the neighbors of a node in any distance.
     def get_neighbors(self, node, recurse=0, diagonals=True):
-        neighbors = set()
-        new_neighbors = set()
-
-        # get each neighbor
-        neighbors.add(node)
-        while recurse > 0 and len(neighbors) != 0:
-            for neighbor in neighbors:
-                # get each of these neighbor's neighbor if they aren't none.
-                if neighbors is not None:
-                    for n in neighbor.get_neighbors(diagonals):
-                        if n is not None and n.node_type != 1:
-                            new_neighbors.add(n)
-
-            # we now have a new set of neighbors to check
-            neighbors = neighbors.union(new_neighbors)
-            new_neighbors = set()
+        flat_types = self.flat_types
+        found = {node.index}
+        frontier = [node.index]
+
+        # spread out one ring at a time, obstacles stop the spread.
+        while recurse > 0 and len(frontier) != 0:
+            new_frontier = []
+            for index in frontier:
+                for n in self.get_neighbor_indices(index, diagonals):
+                    if n not in found and flat_types[n] != OBSTACLE:
+                        found.add(n)
+                        new_frontier.append(n)
+            frontier = new_frontier
             recurse -= 1
 
         # the start node is not a neighbor to itself
-        neighbors.remove(node)
-
-        return neighbors
+        found.remove(node.index)
+
+        return set(self.get_node_from_index(n) for n in found)
+
+    # listeners are called with a list of the changed cell ids every time the grid finishes a change
+    def add_change_listener(self, listener):
+        self.__change_listeners.append(listener)
+
+    def remove_change_listener(self, listener):
+        if listener in self.__change_listeners:
+            self.__change_listeners.remove(listener)
+
+    # write the type of a single cell, remembering it so listeners can be told once the whole change is done
+    def write_node_type(self, index, node_type):
+        if self.flat_types[index] != node_type:
+            self.flat_types[index] = node_type
+            self.__pending_changes.append(index)
+
+    # write the types of many cells at once, given as an array of cell ids and an array (or single value) of types
+    def write_node_types(self, indices, node_types):
+        indices = np.asarray(indices, dtype=np.intp)
+        changed = self.flat_types[indices] != node_types
+        if np.any(changed):
+            self.flat_types[indices] = node_types
+            self.__pending_changes.extend(indices[changed].tolist())
+
+    # tell every listener about the cells that changed since the last time
+    def publish_changes(self):
+        if len(self.__pending_changes) == 0:
+            return
+        changes = self.__pending_changes
+        self.__pending_changes = []
+        self.version += 1
+        for listener in list(self.__change_listeners):
+            listener(changes)
 
     # set a node to a given type
     def set_node(self, x, y, node_type):
@@ -120,56 +206,148 @@ class Grid:
         if node.node_type != node_type:
             self.set_node_type(node, node_type)
 
-    # set a nodes type.
+    # set a nodes type.  Borders are kept up to date incrementally, only the cells around the node are touched.
     def set_node_type(self, node, node_type):
-        # add border if obstacle. otherwise re-calculating borders is necessary
         old_type = node.node_type
-        node.node_type = node_type
-        if node_type == OBSTACLE:
-            self.spread_border(node, self.border_thickness, self.include_diagonals)
-            self.all_obstacles.add(node)
-        else:
-            if old_type == OBSTACLE:
-                self.all_obstacles.remove(node)
-            elif old_type == OBSTACLE_BORDER:
-                self.all_borders.remove(node)
-            self.remake_borders()
-
-    # this remakes all borders
-    def remake_borders(self):
-        self.clear_borders()
-
-        # draw borders for every obstacle
-        for obstacle in self.all_obstacles:
-            self.spread_border(obstacle, self.border_thickness, self.include_diagonals)
-
-    # remove all borders from the map.
-    def clear_borders(self):
-        for border in self.all_borders:
-            border.node_type = 0
-        self.all_borders = set()
 
-    # this adds borders from all obstacles.
-    def spread_border(self, node, border_thickness=0, diagonals=True):
+        # an obstacle going away takes its share of the surrounding borders with it
+        if old_type == OBSTACLE and node_type != OBSTACLE:
+            self.__remove_border_coverage(node)
 
-        # recursively get all neighbors and then turn them into borders.
-        neighbors = list(self.get_neighbors(node, border_thickness, diagonals))
-        for n in neighbors:
-            if n.node_type == OPEN_SPACE:
-                n.node_type = OBSTACLE_BORDER
-                self.all_borders.add(n)
+        if node_type == OBSTACLE:
+            if old_type != OBSTACLE:
+                node.node_type = OBSTACLE
+                self.__add_border_coverage(node)
 
-        # if the node wasn't and obstacle before it had better be now.
-        node.node_type = OBSTACLE
-        return neighbors
+        # a cell inside another obstacle's border stays a border no matter what it is set to
+        elif node_type == OBSTACLE_BORDER or self.border_counts[node.gridPos.x, node.gridPos.y] > 0:
+            node.node_type = OBSTACLE_BORDER
+        else:
+            node.node_type = OPEN_SPACE
+        self.publish_changes()
+
+    # the nodes a straight line from start to end passes through, in order with both ends included
+    def cast_ray(self, start, end):
+        return [self.get_node(x, y) for x, y in self.__line_cells(start.gridPos.x, start.gridPos.y,
+                                                                    end.gridPos.x, end.gridPos.y)]
+
+    # the cell ids that many straight lines from one origin node pass through, all found at once.
+    # ends holds the grid x, y of the end of every ray.  Each ray takes one step at a time along its longer axis
+    # (bresenham), so it can be a cell thinner than cast_ray where it passes close to a corner.
+    def cast_rays(self, origin, ends):
+        ends = np.asarray(ends, dtype=np.intp).reshape(-1, 2)
+        if len(ends) == 0:
+            return np.empty(0, dtype=np.intp)
+
+        deltas = ends - (origin.gridPos.x, origin.gridPos.y)
+        lengths = np.abs(deltas).max(axis=1)
+
+        # every ray gets as many steps as the longest one, the shorter ones just stay on their end cell
+        steps = np.minimum(np.arange(lengths.max() + 1), lengths[:, None]) / np.maximum(lengths, 1)[:, None]
+        xs = np.floor(origin.gridPos.x + deltas[:, 0:1] * steps + 0.5).astype(np.intp)
+        ys = np.floor(origin.gridPos.y + deltas[:, 1:2] * steps + 0.5).astype(np.intp)
+        return np.unique(xs * self.nodes_in_y + ys)
+
+    # apply a single range reading: every cell between start and end is free space, and the end is an obstacle if
+    # the sensor hit something or free space if it did not.
+    # It returns the nodes on the ray that changed type.  Listeners hear about the whole reading at once.
+    def apply_ray(self, start, end, hit):
+        cells = np.array([x * self.nodes_in_y + y for x, y in self.__line_cells(start.gridPos.x, start.gridPos.y,
+                                                                                end.gridPos.x, end.gridPos.y)],
+                         dtype=np.intp)
+        if hit:
+            return self.mark_cells(cells[:-1], cells[-1:])
+        return self.mark_cells(cells, cells[:0])
+
+    # the same as apply_ray for many rays from one origin node, hits says which of the rays ended on an obstacle
+    def apply_rays(self, origin, ends, hits):
+        ends = np.asarray(ends, dtype=np.intp).reshape(-1, 2)
+        end_cells = ends[:, 0] * self.nodes_in_y + ends[:, 1]
+        return self.mark_cells(self.cast_rays(origin, ends), end_cells[np.asarray(hits, dtype=bool)])
+
+    # mark the free cells as open (or border if an obstacle still covers them) and the occupied cells as obstacles,
+    # both given as arrays of cell ids, then publish everything as one change.
+    # It returns the nodes given that changed type.
+    def mark_cells(self, free, occupied):
+        occupied = np.asarray(occupied, dtype=np.intp)
+        free = np.setdiff1d(free, occupied).astype(np.intp)  # an obstacle one ray ends on is not cleared by another
+        cells = np.union1d(free, occupied)
+        old_types = self.flat_types[cells]
+
+        # obstacles that are gone take their share of the surrounding borders with them
+        for cell in free[self.flat_types[free] == OBSTACLE]:
+            self.__remove_border_coverage(self.get_node_from_index(cell))
+        counts = self.border_counts.reshape(-1)[free]
+        self.write_node_types(free, np.where(counts > 0, OBSTACLE_BORDER, OPEN_SPACE).astype(np.uint8))
+
+        for cell in occupied[self.flat_types[occupied] != OBSTACLE]:
+            self.write_node_type(cell, OBSTACLE)
+            self.__add_border_coverage(self.get_node_from_index(cell))
+
+        self.publish_changes()
+        return [self.get_node_from_index(cell) for cell in cells[self.flat_types[cells] != old_types]]
+
+    # this remakes all borders from scratch using the obstacles currently in the grid.
+    # The whole map is dilated at once, so this is the fast way to inflate a freshly loaded map.
+    def remake_borders(self):
+        obstacles = self.node_types == OBSTACLE
+        t = self.border_thickness
+
+        # count how many obstacles have each cell in their border by adding up shifted copies of the obstacle map
+        padded = np.pad(obstacles.astype(np.uint16), t, mode='constant')
+        counts = np.zeros((self.nodes_in_x, self.nodes_in_y), dtype=np.uint16)
+        for dx, dy in zip(*np.nonzero(self.__border_kernel)):
+            counts += padded[dx:dx + self.nodes_in_x, dy:dy + self.nodes_in_y]
+        self.border_counts = counts
+
+        # work out every cell's new type and write the ones that changed
+        new_types = np.where(counts > 0, OBSTACLE_BORDER, OPEN_SPACE).astype(np.uint8)
+        new_types[obstacles] = OBSTACLE
+        changed = np.flatnonzero(new_types.reshape(-1) != self.flat_types)
+        self.write_node_types(changed, new_types.reshape(-1)[changed])
+        self.publish_changes()
+
+    # the shape of the border around a single obstacle, a square with diagonals or a diamond without
+    def __make_border_kernel(self):
+        t = self.border_thickness
+        kernel = np.zeros((2 * t + 1, 2 * t + 1), dtype=np.uint16)
+        for i in range(-t, t + 1):
+            for j in range(-t, t + 1):
+                if self.include_diagonals or abs(i) + abs(j) <= t:
+                    kernel[i + t, j + t] = 1
+        kernel[t, t] = 0
+        return kernel
+
+    # the part of the grid a border around x, y covers and the matching part of the kernel
+    def __border_window(self, x, y):
+        t = self.border_thickness
+        x0 = max(0, x - t)
+        x1 = min(self.nodes_in_x, x + t + 1)
+        y0 = max(0, y - t)
+        y1 = min(self.nodes_in_y, y + t + 1)
+        kernel = self.__border_kernel[x0 - (x - t):x1 - (x - t), y0 - (y - t):y1 - (y - t)]
+        return (slice(x0, x1), slice(y0, y1)), kernel
+
+    # count a new obstacle's border and turn any open space inside it into border
+    def __add_border_coverage(self, node):
+        window, kernel = self.__border_window(node.gridPos.x, node.gridPos.y)
+        self.border_counts[window] += kernel
+        new_borders = (self.node_types[window] == OPEN_SPACE) & (self.border_counts[window] > 0)
+        for x, y in zip(*np.nonzero(new_borders)):
+            self.write_node_type(self.get_index(window[0].start + x, window[1].start + y), OBSTACLE_BORDER)
+
+    # forget an obstacle's border, cells no other obstacle covers go back to open space
+    def __remove_border_coverage(self, node):
+        window, kernel = self.__border_window(node.gridPos.x, node.gridPos.y)
+        self.border_counts[window] -= kernel
+        cleared = (self.node_types[window] == OBSTACLE_BORDER) & (self.border_counts[window] == 0) & (kernel > 0)
+        for x, y in zip(*np.nonzero(cleared)):
+            self.write_node_type(self.get_index(window[0].start + x, window[1].start + y), OPEN_SPACE)
 
     # Uses an A* pathfinding solution in order to find the shortest route to the destination.
     # it returns a tuple, the full path and a simplified path.
-    def find_path(self, start, end, use_obstacles=True):
-        # initialize lists
-        path = []
-        simple_path = []
-
+    # algorithm can be A_STAR or JPS, jump point search only works with diagonals and falls back to a* without them.
+    def find_path(self, start, end, use_obstacles=True, algorithm=A_STAR):
         # if the pathfinding solution is not worth calculating.
         if end is None or start is None:
             return [], []
@@ -178,66 +356,301 @@ class Grid:
         elif end.node_type != OPEN_SPACE and use_obstacles:
             return [], []
 
-        # initialize variables
-        open_set = []
-        closed_set = set()
-        current_node = start
+        cells = self.find_cells(start.index, end.index, use_obstacles, algorithm)
+
+        # no route exists
+        if len(cells) == 0:
+            return [], []
+
+        path = [self.get_node_from_index(cell) for cell in cells]
+        if use_obstacles:
+            simple_path = self.make_simple_path(start, path)
+        else:
+            simple_path = self.simplify_path(path)
+        return path, simple_path
+
+    # the search behind find_path working purely on cell ids, without any of its checks.
+    # It returns the cell ids from start (exclusive) to end, or an empty list if there is no route.
+    def find_cells(self, start, end, use_obstacles=True, algorithm=A_STAR):
+        # only one search can use the scratch area at a time
+        with self.__scratch.lock:
+            if algorithm == JPS and self.include_diagonals:
+                return self.__jump_point_search(start, end, use_obstacles)
+            return self.__a_star(start, end, use_obstacles)
+
+    # find many paths at once.  pairs is a list of (start, end) nodes.
+    # With more than one worker the cells are put in shared memory once and the queries are split between a pool of
+    # processes, so the searches are not held back by the GIL.
+    # It returns an array with the cost of every path (inf where there is none) and, if asked for, the paths.
+    def find_paths(self, pairs, workers=1, return_paths=False, algorithm=A_STAR):
+        queries = []
+        for start, end in pairs:
+            if start is None or end is None or start == end or end.node_type != OPEN_SPACE:
+                queries.append(None)
+            else:
+                queries.append((start.index, end.index))
+        jobs = [query for query in queries if query is not None]
+
+        if workers > 1 and shared_memory is not None and len(jobs) > 1:
+            results = self.__find_paths_in_pool(jobs, workers, return_paths, algorithm)
+        else:
+            results = _find_cells_batch(self, jobs, return_paths, algorithm)
+
+        # put the answers back in the order they were asked, the skipped pairs have no path
+        costs = np.full(len(pairs), np.inf)
+        paths = [[] for _ in pairs] if return_paths else None
+        answers = iter(results)
+        for i, query in enumerate(queries):
+            if query is None:
+                if pairs[i][0] is not None and pairs[i][0] == pairs[i][1]:
+                    costs[i] = 0.0
+                continue
+            cost, cells = next(answers)
+            costs[i] = cost
+            if return_paths:
+                paths[i] = [self.get_node_from_index(cell) for cell in cells]
+        return costs, paths
+
+    # the cost of getting from every node to every other node, indexed [from, to]
+    def find_cost_matrix(self, nodes, workers=1, algorithm=A_STAR):
+        pairs = [(start, end) for start in nodes for end in nodes]
+        costs, _ = self.find_paths(pairs, workers, algorithm=algorithm)
+        return costs.reshape(len(nodes), len(nodes))
+
+    def __find_paths_in_pool(self, jobs, workers, return_paths, algorithm):
+        memory = shared_memory.SharedMemory(create=True, size=max(1, self.__number_of_nodes))
+        try:
+            np.ndarray(self.__number_of_nodes, dtype=np.uint8, buffer=memory.buf)[:] = self.flat_types
+
+            # a few chunks per worker keeps them all busy when some searches take much longer than others
+            chunk_size = max(1, len(jobs) // (workers * 4))
+            chunks = [(jobs[i:i + chunk_size], return_paths, algorithm) for i in range(0, len(jobs), chunk_size)]
+            settings = (memory.name, self.nodes_in_x, self.nodes_in_y, self.include_diagonals,
+                        self.non_diagonal_weight, self.diagonal_weight)
+            with multiprocessing.Pool(workers, initializer=_start_path_worker, initargs=settings) as pool:
+                results = []
+                for chunk_results in pool.map(_run_path_worker, chunks):
+                    results += chunk_results
+            return results
+        finally:
+            memory.close()
+            memory.unlink()
+
+    # the a* search itself, working purely on cell ids.  It returns the cell ids from start (exclusive) to end.
+    def __a_star(self, start, end, use_obstacles):
+        # initialize the search state
+        scratch = self.__scratch
+        generation = scratch.begin()
+        open_set = scratch.open_set
+        stamps = scratch.stamps
+        g_costs = scratch.g_costs
+        parents = scratch.parents
+        closed = scratch.closed
+        cell_types = memoryview(self.flat_types)
+        size_x = self.nodes_in_x
+        size_y = self.nodes_in_y
+        moves = self.__get_moves()
+        end_x, end_y = divmod(end, size_y)
 
         # let's go
-        open_set.append(start)
-        while len(open_set) > 0 and current_node != end:
+        scratch.visit(start, 0.0, -1)
+        start_x, start_y = divmod(start, size_y)
+        h_cost = self.__get_distance(abs(start_x - end_x), abs(start_y - end_y))
+        open_set.push(start, (h_cost, h_cost))
+        self.last_expansions = 0
+        while len(open_set) > 0:
 
             # get the next node, don't use it again.
-            current_node = heapq.heappop(open_set)
-            closed_set.add(current_node)
+            current = open_set.pop()
+            self.last_expansions += 1
 
-            # if we're done get the path and break
-            if current_node == end:
-                path = self.__trace_path(start, end)
-                simple_path = self.__simplify_path(path)
-                break
+            # if we're done get the path
+            if current == end:
+                return scratch.trace(start, end)
+            closed[current >> 3] |= 1 << (current & 7)
 
             # get paths for all the current neighbors
-            neighbor_list = current_node.get_neighbors(self.include_diagonals)
-            for neighbor in neighbor_list:
-
-                if use_obstacles:
-                    # if this is a neighbor worth calculating calculate its cost.
-                    if neighbor.node_type == OPEN_SPACE and not closed_set.__contains__(neighbor):
-                        new_movement_cost = current_node.g_cost + self.__get_distance(current_node, neighbor)
-
-                        # If this is a better route, or this is a new node.
-                        if new_movement_cost < neighbor.g_cost or not open_set.__contains__(neighbor):
-                            neighbor.g_cost = new_movement_cost
-                            neighbor.h_cost = self.__get_distance(neighbor, end)
-                            neighbor.parent = current_node
-
-                            # If the node is already going to be calculated, resort it.  otherwise add it to the set.
-                            if open_set.__contains__(neighbor):
-                                heapq.heapify(open_set)
-                            else:
-                                heapq.heappush(open_set, neighbor)
+            current_x, current_y = divmod(current, size_y)
+            current_g = g_costs[current]
+            for dx, dy, offset, weight in moves:
+                x = current_x + dx
+                y = current_y + dy
+                if x < 0 or y < 0 or x >= size_x or y >= size_y:
+                    continue
+                neighbor = current + offset
+
+                # if this is a neighbor worth calculating calculate its cost.
+                if closed[neighbor >> 3] & (1 << (neighbor & 7)):
+                    continue
+                if use_obstacles and cell_types[neighbor] != OPEN_SPACE:
+                    continue
+                new_movement_cost = current_g + weight
+
+                # If this is a better route, or this is a new node.
+                if stamps[neighbor] != generation or new_movement_cost < g_costs[neighbor]:
+                    stamps[neighbor] = generation
+                    g_costs[neighbor] = new_movement_cost
+                    parents[neighbor] = current
+                    h_cost = self.__get_distance(abs(x - end_x), abs(y - end_y))
+
+                    # ties are broken towards the node closest to the destination
+                    open_set.push(neighbor, (new_movement_cost + h_cost, h_cost))
+        return []
+
+    # Jump point search, an a* that skips over the cells of an 8 connected uniform cost grid where nothing can change.
+    # Only jump points (cells next to an obstacle corner, or leading to one) are added to the open set.  Like the a*
+    # above, diagonal moves may cut corners.  The returned cell ids are filled in between jump points so the result
+    # looks exactly like an a* path.
+    def __jump_point_search(self, start, end, use_obstacles):
+        # initialize the search state
+        scratch = self.__scratch
+        generation = scratch.begin()
+        open_set = scratch.open_set
+        stamps = scratch.stamps
+        g_costs = scratch.g_costs
+        parents = scratch.parents
+        closed = scratch.closed
+        cell_types = memoryview(self.flat_types)
+        size_x = self.nodes_in_x
+        size_y = self.nodes_in_y
+        end_x, end_y = divmod(end, size_y)
+
+        def walkable(x, y):
+            return 0 <= x < size_x and 0 <= y < size_y and (not use_obstacles or cell_types[x * size_y + y] == OPEN_SPACE)
+
+        # move in a straight line until the destination, a wall or a forced neighbor is found
+        def jump_straight(x, y, dx, dy):
+            while True:
+                x += dx
+                y += dy
+                if not walkable(x, y):
+                    return None
+                if x == end_x and y == end_y:
+                    return x, y
+                if dx != 0:
+                    if (walkable(x + dx, y + 1) and not walkable(x, y + 1)) or \
+                            (walkable(x + dx, y - 1) and not walkable(x, y - 1)):
+                        return x, y
                 else:
-                    # if this is a neighbor worth calculating calculate its cost.
-                    if not closed_set.__contains__(neighbor):
-                        new_movement_cost = current_node.g_cost + self.__get_distance(current_node, neighbor)
-
-                        # If this is a better route, or this is a new node.
-                        if new_movement_cost < neighbor.g_cost or not open_set.__contains__(neighbor):
-                            neighbor.g_cost = new_movement_cost
-                            neighbor.h_cost = self.__get_distance(neighbor, end)
-                            neighbor.parent = current_node
-
-                            # If the node is already going to be calculated, resort it.  otherwise add it to the set.
-                            if open_set.__contains__(neighbor):
-                                heapq.heapify(open_set)
-                            else:
-                                heapq.heappush(open_set, neighbor)
-        return path, simple_path
+                    if (walkable(x + 1, y + dy) and not walkable(x + 1, y)) or \
+                            (walkable(x - 1, y + dy) and not walkable(x - 1, y)):
+                        return x, y
+
+        # move diagonally, also stopping wherever a straight line from here would find a jump point
+        def jump_diagonal(x, y, dx, dy):
+            while True:
+                x += dx
+                y += dy
+                if not walkable(x, y):
+                    return None
+                if x == end_x and y == end_y:
+                    return x, y
+                if (walkable(x - dx, y + dy) and not walkable(x - dx, y)) or \
+                        (walkable(x + dx, y - dy) and not walkable(x, y - dy)):
+                    return x, y
+                if jump_straight(x, y, dx, 0) is not None or jump_straight(x, y, 0, dy) is not None:
+                    return x, y
+
+        # the directions worth searching from a cell, based on the direction we arrived from
+        def get_directions(x, y, parent):
+            if parent < 0:
+                return [(i, j) for i in range(-1, 2) for j in range(-1, 2) if i != 0 or j != 0]
+            parent_x, parent_y = divmod(parent, size_y)
+            dx = (x > parent_x) - (x < parent_x)
+            dy = (y > parent_y) - (y < parent_y)
+            if dx != 0 and dy != 0:
+                directions = [(0, dy), (dx, 0), (dx, dy)]
+                if not walkable(x - dx, y):
+                    directions.append((-dx, dy))
+                if not walkable(x, y - dy):
+                    directions.append((dx, -dy))
+            elif dx != 0:
+                directions = [(dx, 0)]
+                if not walkable(x, y + 1):
+                    directions.append((dx, 1))
+                if not walkable(x, y - 1):
+                    directions.append((dx, -1))
+            else:
+                directions = [(0, dy)]
+                if not walkable(x + 1, y):
+                    directions.append((1, dy))
+                if not walkable(x - 1, y):
+                    directions.append((-1, dy))
+            return directions
+
+        # let's go
+        scratch.visit(start, 0.0, -1)
+        start_x, start_y = divmod(start, size_y)
+        h_cost = self.__get_distance(abs(start_x - end_x), abs(start_y - end_y))
+        open_set.push(start, (h_cost, h_cost))
+        self.last_expansions = 0
+        while len(open_set) > 0:
+
+            # get the next jump point, don't use it again.
+            current = open_set.pop()
+            self.last_expansions += 1
+
+            # if we're done get the path
+            if current == end:
+                return self.__fill_jumps(scratch.trace(start, end), start)
+            closed[current >> 3] |= 1 << (current & 7)
+
+            current_x, current_y = divmod(current, size_y)
+            current_g = g_costs[current]
+            for dx, dy in get_directions(current_x, current_y, parents[current]):
+                if dx != 0 and dy != 0:
+                    jump_point = jump_diagonal(current_x, current_y, dx, dy)
+                else:
+                    jump_point = jump_straight(current_x, current_y, dx, dy)
+                if jump_point is None:
+                    continue
+                x, y = jump_point
+                neighbor = x * size_y + y
+                if closed[neighbor >> 3] & (1 << (neighbor & 7)):
+                    continue
+
+                # jump points are always in a straight or diagonal line, so the grid distance is the exact cost
+                new_movement_cost = current_g + self.__get_distance(abs(x - current_x), abs(y - current_y))
+                if stamps[neighbor] != generation or new_movement_cost < g_costs[neighbor]:
+                    stamps[neighbor] = generation
+                    g_costs[neighbor] = new_movement_cost
+                    parents[neighbor] = current
+                    h_cost = self.__get_distance(abs(x - end_x), abs(y - end_y))
+                    open_set.push(neighbor, (new_movement_cost + h_cost, h_cost))
+        return []
+
+    # fill in every cell between consecutive jump points
+    def __fill_jumps(self, jump_points, start):
+        size_y = self.nodes_in_y
+        cells = []
+        x, y = divmod(start, size_y)
+        for jump_point in jump_points:
+            jump_x, jump_y = divmod(jump_point, size_y)
+            dx = (jump_x > x) - (jump_x < x)
+            dy = (jump_y > y) - (jump_y < y)
+            while x != jump_x or y != jump_y:
+                x += dx
+                y += dy
+                cells.append(x * size_y + y)
+        return cells
+
+    # the moves a search may take from a cell: x offset, y offset, cell id offset and the cost of the move
+    def __get_moves(self):
+        moves = []
+        for i in range(-1, 2):
+            for j in range(-1, 2):
+                if i == 0 and j == 0:
+                    continue
+                if i != 0 and j != 0:
+                    if self.include_diagonals:
+                        moves.append((i, j, i * self.nodes_in_y + j, self.diagonal_weight))
+                else:
+                    moves.append((i, j, i * self.nodes_in_y + j, self.non_diagonal_weight))
+        return moves
 
     # this simplifies an existing path to only include nodes that cause a direction change
     @staticmethod
-    def __simplify_path(path):
+    def simplify_path(path):
         old_dir = Vector(0, 0)
         simple_path = []
 
@@ -253,145 +666,259 @@ class Grid:
         simple_path.append(path[-1])
         return simple_path
 
-    # calculate the distance, note that this is not a straight line it is by grid movement.
-    def __get_distance(self, a, b):
-        dst_x = abs(a.gridPos.x - b.gridPos.x)
-        dst_y = abs(a.gridPos.y - b.gridPos.y)
+    # the waypoints the rover should drive through to follow a path from start.
+    # With any_angle set the path is smoothed by line of sight, otherwise only the direction changes are kept.
+    def make_simple_path(self, start, path):
+        if self.any_angle:
+            return self.smooth_path(start, path)
+        return self.simplify_path(path)
+
+    # this reduces a path to the fewest waypoints it can by skipping ahead to the furthest cell of the path that can
+    # be seen in a straight line.  Every leg between two waypoints only crosses open space.
+    def smooth_path(self, start, path):
+        simple_path = []
+        anchor = start
+        i = 0
+        while i < len(path):
+            # the next cell of the path can always be reached, it is a single step
+            furthest = i
+            for j in range(i + 1, len(path)):
+                if not self.has_line_of_sight(anchor, path[j]):
+                    break
+                furthest = j
+
+            anchor = path[furthest]
+            simple_path.append(anchor)
+            i = furthest + 1
+        return simple_path
+
+    # whether a straight line between the centers of two nodes only crosses open space
+    def has_line_of_sight(self, start, end):
+        cell_types = self.flat_types
+        size_y = self.nodes_in_y
+        for x, y in self.__line_cells(start.gridPos.x, start.gridPos.y, end.gridPos.x, end.gridPos.y):
+            if cell_types[x * size_y + y] != OPEN_SPACE:
+                return False
+        return True
+
+    # every cell a straight line between two cell centers passes through, in order.
+    # When the line goes exactly through a corner both cells beside the corner are included.
+    @staticmethod
+    def __line_cells(x0, y0, x1, y1):
+        dx = abs(x1 - x0)
+        dy = abs(y1 - y0)
+        step_x = 1 if x1 > x0 else -1
+        step_y = 1 if y1 > y0 else -1
+        error = dx - dy  # which cell edge the line crosses next, scaled to stay in integers
+        x, y = x0, y0
+        yield x, y
+
+        remaining = dx + dy
+        while remaining > 0:
+            if error > 0:
+                x += step_x
+                error -= 2 * dy
+                remaining -= 1
+            elif error < 0:
+                y += step_y
+                error += 2 * dx
+                remaining -= 1
+            else:
+                # through the corner, it touches both neighbors on the way to the diagonal cell
+                yield x + step_x, y
+                yield x, y + step_y
+                x += step_x
+                y += step_y
+                error += 2 * dx - 2 * dy
+                remaining -= 2
+            yield x, y
 
+    # calculate the distance, note that this is not a straight line it is by grid movement.
+    def __get_distance(self, dst_x, dst_y):
         if dst_x > dst_y:
             return self.diagonal_weight * dst_y + self.non_diagonal_weight * (dst_x - dst_y)
         else:
             return self.diagonal_weight * dst_x + self.non_diagonal_weight * (dst_y - dst_x)
 
-    # traceback the path of nodes.  NOTE do not send this a garbage start and end otherwise it will continue forever.
-    @staticmethod
-    def __trace_path(start, end):
-        path = []
-        current_node = end
-        while current_node != start:
-            path.append(current_node)
-            current_node = current_node.parent
-
-        # this creates the path backwards.
-        path.reverse()
-        return path
-
-    # this allows saving the saving of this grid to file.  It can also be send back as a string for networking purposes.
+    # this saves the grid to a binary file, the header followed by the raw cell array.
+    # The bytes written are returned as well if asked for, for networking purposes.
     def save(self, filename, return_as_string=False):
+        data = self.to_bytes()
         try:
-            file = open(filename, 'w')
-            temp = "" + self.grid_size_x.__str__() + "\n" + self.grid_size_y.__str__() + "\n"
-            temp += self.nodes_in_x.__str__() + "\n" + self.nodes_in_y.__str__() + "\n"
-            temp += self.__world_bottom_left.x.__str__() + "\n" + self.__world_bottom_left.y.__str__() + "\n"
-            temp += self.border_thickness.__str__() + "\n" + self.include_diagonals.__str__()
-
-            for x in range(0, self.nodes_in_x):
-                for y in range(0, self.nodes_in_y):
-                    temp += "\n" + self.nodes[x][y].node_type.__str__()
-
-            file.write(temp)
-
+            with open(filename, 'wb') as file:
+                file.write(data)
         except Exception as ex:
             print(ex)
-        finally:
-            file.close()
-            if return_as_string:
-                return temp
-
-    # this creates a new grid from scratch for use.
+        if return_as_string:
+            return data
+
+    # the grid in the binary file format
+    def to_bytes(self):
+        header = GRID_FILE_HEADER.pack(GRID_FILE_MAGIC, GRID_FILE_VERSION, self.grid_size_x, self.grid_size_y,
+                                       self.nodes_in_x, self.nodes_in_y, self.__world_bottom_left.x,
+                                       self.__world_bottom_left.y, self.border_thickness, self.include_diagonals)
+        return header + self.flat_types.tobytes()
+
+    # this creates a new grid from a saved file.  Binary files are mapped into memory rather than read, the cells are
+    # only copied when they are changed.  Files in the old text format are handed to the importer.
+    # None is returned if the file could not be read.
     @staticmethod
     def load(filename):
         try:
-            file = open(filename, 'r')
-            data = file.readlines()
-            size_x = float(data.pop(0))
-            size_y = float(data.pop(0))
-            nodes_x = int(data.pop(0))
-            nodes_y = int(data.pop(0))
-            world_x = float(data.pop(0))
-            world_y = int(data.pop(0))
-            thickness = int(data.pop(0))
-            diagonals = bool(data.pop(0))
-            grid = Grid(size_x, size_y, nodes_x, nodes_y, world_x, world_y, thickness, diagonals)
-            for x in range(0, nodes_x):
-                for y in range(0, nodes_y):
-                    grid.get_node(x, y).node_type = int(data.pop(0))
+            with open(filename, 'rb') as file:
+                if file.read(len(GRID_FILE_MAGIC)) != GRID_FILE_MAGIC:
+                    return Grid.import_text(filename)
+                cells = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+            magic, version, size_x, size_y, nodes_x, nodes_y, world_x, world_y, thickness, diagonals = \
+                GRID_FILE_HEADER.unpack_from(cells)
+            if version != GRID_FILE_VERSION:
+                raise ValueError("unsupported grid file version " + str(version))
+
+            grid = Grid(size_x, size_y, nodes_x, nodes_y, world_x, world_y, thickness, bool(diagonals))
+            grid.__set_cells(np.frombuffer(cells, dtype=np.uint8, count=nodes_x * nodes_y,
+                                           offset=GRID_FILE_HEADER.size))
+            return grid
+        except Exception as ex:
+            print(ex)
+            return None
 
+    # this reads a grid saved in the old text format, one value per line: the sizes, the world position, the border
+    # thickness, whether diagonals are used and then every cell type.
+    # None is returned if the file could not be read.
+    @staticmethod
+    def import_text(filename):
+        try:
+            with open(filename, 'r') as file:
+                data = file.read().split()
+            size_x = float(data[0])
+            size_y = float(data[1])
+            nodes_x = int(data[2])
+            nodes_y = int(data[3])
+            world_x = float(data[4])
+            world_y = float(data[5])
+            thickness = int(data[6])
+            diagonals = data[7] == "True"
+
+            grid = Grid(size_x, size_y, nodes_x, nodes_y, world_x, world_y, thickness, diagonals)
+            grid.__set_cells(np.fromiter(map(int, data[8:]), dtype=np.uint8, count=nodes_x * nodes_y))
+            return grid
         except Exception as ex:
             print(ex)
-        finally:
-            file.close()
-        return grid
+            return None
+
+    # take over a flat array of loaded cell types, then rebuild the border counts from the obstacles in it
+    def __set_cells(self, cells):
+        self.flat_types = cells
+        self.node_types = cells.reshape(self.nodes_in_x, self.nodes_in_y)
+        self.remake_borders()
+
+
+# the grid a path worker process searches on, set up once when the worker starts
+_worker_grid = None
+_worker_memory = None
+
+
+# attach a pool worker to the shared cells of the grid being searched
+def _start_path_worker(memory_name, nodes_x, nodes_y, diagonals, non_diagonal_weight, diagonal_weight):
+    global _worker_grid, _worker_memory
+    _worker_memory = shared_memory.SharedMemory(name=memory_name)
+    grid = Grid(nodes_x, nodes_y, nodes_x, nodes_y, diagonal_default=diagonals)
+    grid.non_diagonal_weight = non_diagonal_weight
+    grid.diagonal_weight = diagonal_weight
+    grid.flat_types = np.ndarray(nodes_x * nodes_y, dtype=np.uint8, buffer=_worker_memory.buf)
+    grid.node_types = grid.flat_types.reshape(nodes_x, nodes_y)
+    _worker_grid = grid
+
+
+def _run_path_worker(chunk):
+    jobs, return_paths, algorithm = chunk
+    return _find_cells_batch(_worker_grid, jobs, return_paths, algorithm)
+
+
+# search every (start cell, end cell) job on a grid, each answer is the cost and the cells (if asked for) of the path
+def _find_cells_batch(grid, jobs, return_paths, algorithm):
+    results = []
+    size_y = grid.nodes_in_y
+    for start, end in jobs:
+        cells = grid.find_cells(start, end, True, algorithm)
+        if len(cells) == 0:
+            results.append((float("inf"), []))
+            continue
+
+        # diagonal steps change both x and y
+        steps = np.array([start] + cells)
+        xs, ys = np.divmod(steps, size_y)
+        diagonal = (np.diff(xs) != 0) & (np.diff(ys) != 0)
+        cost = float(np.count_nonzero(diagonal) * grid.diagonal_weight +
+                     np.count_nonzero(~diagonal) * grid.non_diagonal_weight)
+        results.append((cost, cells if return_paths else []))
+    return results
 
 
 # this class represents a single point on a node.
+# It holds no state of its own, every property reads from or writes to the arrays of the grid it belongs to.
 class Node:
-    grid = None
+    __slots__ = ('grid', 'index', 'gridPos')
 
-    def __init__(self, x, y, node_type):
+    def __init__(self, grid, x, y):
+        self.grid = grid
+        self.index = x * grid.nodes_in_y + y
         self.gridPos = Vector(x, y)
-        self.node_type = node_type
-        self.parent = None
-        self.g_cost = 0  # cost to get to this node
-        self.h_cost = 0  # cost to get from this node to a destination
 
-    # the total weight of a node
-    def f_cost(self):
-        return self.g_cost + self.h_cost
+    # the type of this node (open space, obstacle or border)
+    @property
+    def node_type(self):
+        return int(self.grid.node_types[self.gridPos.x, self.gridPos.y])
+
+    @node_type.setter
+    def node_type(self, node_type):
+        self.grid.write_node_type(self.index, node_type)
 
     # this returns the nodes neighbors
     def get_neighbors(self, use_diagonals=True):
         try:
-            if use_diagonals:
-                return self.__neighbors_with_diagonals()
-            else:
-                return self.__neighbors()
+            return [self.grid.get_node_from_index(n) for n in self.grid.get_neighbor_indices(self.index, use_diagonals)]
         except:
             print(traceback.format_exc())
 
-    def __neighbors_with_diagonals(self):
-        temp = []
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                if self.gridPos.x + i != -1 and self.gridPos.y + j != -1 and self.gridPos.x + i != Node.grid.nodes_in_x and Node.grid.nodes_in_y != self.gridPos.y + j:
-                    if self != Node.grid.nodes[self.gridPos.x + i][self.gridPos.y + j]:
-                        temp.append(Node.grid.nodes[self.gridPos.x + i][self.gridPos.y + j])
-        return temp
-
-    def __neighbors(self):
-        temp = []
-
-        if self.gridPos.x != 0 and self.gridPos.y != 0:
-            temp.append(Node.grid.nodes[self.gridPos.x-1][self.gridPos.y-1])
-
-        if self.gridPos.x != 0 and self.gridPos.y != Node.grid.nodes_in_y:
-            temp.append(Node.grid.nodes[self.gridPos.x - 1][self.gridPos.y + 1])
-
-        if self.gridPos.x != Node.grid.nodes_in_x and self.gridPos.y != 0:
-            temp.append(Node.grid.nodes[self.gridPos.x + 1][self.gridPos.y - 1])
-
-        if self.gridPos.x != Node.grid.nodes_in_x and self.gridPos.y != Node.grid.nodes_in_y:
-            temp.append(Node.grid.nodes[self.gridPos.x + 1][self.gridPos.y + 1])
-
-        return temp
-
     def __eq__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
         return self.gridPos.x == other.gridPos.x and self.gridPos.y == other.gridPos.y
 
     def __ne__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
         return not self.__eq__(other)
 
-    def __lt__(self, other):
-        return self.f_cost() < other.f_cost()
-
-    def __gt__(self, other):
-        return self.f_cost() > other.f_cost()
-
-    def __key(self):
-        return self.gridPos.x, self.gridPos.y
-
     def __hash__(self):
-        return hash(self.__key())
+        return hash(self.index)
 
     def __str__(self):
         return str(self.gridPos.x) + " " + str(self.gridPos.y)
+
+
+# A read only, set like view of every node of one type.  It reads straight from the grid's arrays so it never has to
+# be kept up to date by hand, membership is a single array lookup.
+class NodeTypeView:
+    def __init__(self, grid, node_type):
+        self.grid = grid
+        self.node_type = node_type
+
+    def __contains__(self, node):
+        if not isinstance(node, Node):
+            return False
+        x = node.gridPos.x
+        y = node.gridPos.y
+        if x < 0 or y < 0 or x >= self.grid.nodes_in_x or y >= self.grid.nodes_in_y:
+            return False
+        return self.grid.node_types[x, y] == self.node_type
+
+    # the nodes are found up front, so changing the grid while looping is safe
+    def __iter__(self):
+        for index in np.flatnonzero(self.grid.flat_types == self.node_type):
+            yield self.grid.get_node_from_index(index)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.grid.flat_types == self.node_type))
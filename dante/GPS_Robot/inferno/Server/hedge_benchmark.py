@@ -0,0 +1,248 @@
+from marvelmind import MarvelmindHedge, crc16_modbus, PACKET_HEADER, PACKET_US_POSITION_CM, PACKET_US_POSITION_MM, \
+    PACKET_IMU_RAW, PACKET_DISTANCES, PACKET_IMU
+import numpy as np
+import argparse
+import bisect
+import json
+import platform
+import random
+import struct
+import sys
+import time
+
+# how often each kind of packet turns up in the stream, roughly what a hedge with its imu on sends
+PACKET_MIX = [(PACKET_US_POSITION_MM, 4), (PACKET_US_POSITION_CM, 1), (PACKET_IMU, 4), (PACKET_IMU_RAW, 2),
+              (PACKET_DISTANCES, 1)]
+
+# the usb serial adapter hands bytes over in chunks about this big
+DEFAULT_CHUNK = 64
+
+DEFAULT_TOLERANCE = 0.25
+
+
+# This script measures how fast MarvelmindHedge decodes a synthetic stream of packets, with and without line noise.
+# The stream is fed through an in-memory stand in for serial.Serial, so the hedge's own thread reads it exactly like
+# the modem, and the result can be written out as a json baseline and later runs checked against it.
+#   python hedge_benchmark.py --save hedge_baseline.json
+#   python hedge_benchmark.py --crc-errors 0.05 --truncations 0.02 --compare hedge_baseline.json
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Marvelmind packet decoder.")
+    parser.add_argument("--packets", type=int, default=50000, help="packets in the stream")
+    parser.add_argument("--crc-errors", type=float, default=0.0, help="share of packets with a damaged byte")
+    parser.add_argument("--truncations", type=float, default=0.0, help="share of packets cut off part way")
+    parser.add_argument("--noise", type=float, default=0.0, help="share of packets followed by random bytes")
+    parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK, help="most bytes handed over by one read")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the stream")
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--compare", help="compare the results against this json baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed slowdown, 0.25 is 25%%")
+    args = parser.parse_args()
+
+    stream = make_stream(args.packets, args.crc_errors, args.truncations, args.noise, random.Random(args.seed))
+    print("stream of %d bytes, %d packets should decode" % (len(stream.data), stream.expected))
+    results = {
+        "meta": {"python": platform.python_version(), "packets": args.packets, "crc_errors": args.crc_errors,
+                 "truncations": args.truncations, "noise": args.noise, "chunk": args.chunk, "seed": args.seed},
+        "decode": run_decode(stream, args.chunk),
+        "thread": run_thread(stream, args.chunk)
+    }
+    for name in ("decode", "thread"):
+        print_result(name, results[name])
+    if results["thread"]["decoded"] != stream.expected:
+        print("WARNING decoded %d packets but %d were good" % (results["thread"]["decoded"], stream.expected))
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print("baseline written to", args.save)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("no regressions against", args.compare)
+
+
+# A generated stream: the bytes, how many packets in it are intact and get decoded (distances packets are skipped by
+# the decoder), and where each intact position packet ends so callback latency can be measured.
+class Stream:
+    def __init__(self):
+        self.data = b''
+        self.expected = 0
+        self.position_ends = {}  # position packet timestamp -> offset just past the packet
+
+
+def make_stream(count, crc_errors, truncations, noise, rng):
+    stream = Stream()
+    kinds = [kind for kind, weight in PACKET_MIX for _ in range(weight)]
+    parts = []
+    size = 0
+    for i in range(count):
+        kind = rng.choice(kinds)
+        packet = bytearray(make_packet(kind, i, rng))
+        intact = True
+
+        if rng.random() < crc_errors:
+            packet[rng.randrange(5, len(packet))] ^= 1 << rng.randrange(8)
+            intact = False
+        if rng.random() < truncations:
+            packet = packet[:rng.randrange(1, len(packet))]
+            intact = False
+
+        parts.append(bytes(packet))
+        size += len(packet)
+        if intact and kind != PACKET_DISTANCES:
+            stream.expected += 1
+            if kind in (PACKET_US_POSITION_CM, PACKET_US_POSITION_MM):
+                stream.position_ends[i] = size
+
+        if rng.random() < noise:
+            garbage = bytes(rng.randrange(256) for _ in range(rng.randint(1, 20)))
+            parts.append(garbage)
+            size += len(garbage)
+    stream.data = b''.join(parts)
+    return stream
+
+
+# one whole packet of a kind, timestamp doubles as the packet's number in the stream
+def make_packet(kind, timestamp, rng):
+    address = rng.choice((1, 10))
+    if kind == PACKET_US_POSITION_CM:
+        payload = struct.pack('<LhhhxBxxxx', timestamp, rng.randint(0, 250), rng.randint(0, 350), 20, address)
+    elif kind == PACKET_US_POSITION_MM:
+        payload = struct.pack('<LlllxBxxxx', timestamp, rng.randint(0, 2500), rng.randint(0, 3500), 200, address)
+    elif kind == PACKET_IMU_RAW:
+        payload = struct.pack('<hhhhhhhhhxxxxxxLxxxx', *([rng.randint(-2000, 2000) for _ in range(9)] + [timestamp]))
+    elif kind == PACKET_IMU:
+        payload = struct.pack('<lllhhhhhhhhhhxxLxxxx', *([rng.randint(-2000, 2000) for _ in range(13)] + [timestamp]))
+    else:
+        # hedge address, then four beacons of address, distance in mm and a reserved byte, then the timestamp
+        beacons = b''.join(struct.pack('<BLx', beacon, rng.randint(500, 5000)) for beacon in range(2, 6))
+        payload = struct.pack('<B', address) + beacons + struct.pack('<Lxxx', timestamp)
+
+    body = PACKET_HEADER + struct.pack('<HB', kind, len(payload)) + payload
+    return body + struct.pack('<H', crc16_modbus(body))
+
+
+# An in-memory stand in for serial.Serial that hands the stream over a chunk at a time, like the usb adapter.
+# It remembers when each chunk was handed over.
+class FakeSerial:
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+        self.offset = 0
+        self.read_ends = []
+        self.read_times = []
+        self.__available = 0
+
+    @property
+    def in_waiting(self):
+        return self.__available
+
+    # a new chunk arrives whenever the reader has used up the last one
+    def read(self, size=1):
+        if self.__available == 0:
+            if self.offset >= len(self.data):
+                return b''
+            self.__available = min(self.chunk, len(self.data) - self.offset)
+        size = min(size, self.__available)
+        data = self.data[self.offset:self.offset + size]
+        self.offset += size
+        self.__available -= size
+        self.read_ends.append(self.offset)
+        self.read_times.append(time.perf_counter())
+        return data
+
+    # when the byte just before offset was handed over
+    def time_read(self, offset):
+        return self.read_times[bisect.bisect_left(self.read_ends, offset)]
+
+    def close(self):
+        pass
+
+
+# the decoder on its own, the stream handed to it a chunk at a time
+def run_decode(stream, chunk):
+    hedge = MarvelmindHedge()
+    data = stream.data
+    decoded = 0
+    cpu_start = time.process_time()
+    start_time = time.perf_counter()
+    for offset in range(0, len(data), chunk):
+        decoded += hedge.decode(data[offset:offset + chunk])
+    return make_result(decoded, time.perf_counter() - start_time, time.process_time() - cpu_start, [])
+
+
+# the hedge's own thread reading the fake port, with a callback on every position
+def run_thread(stream, chunk):
+    port = FakeSerial(stream.data, chunk)
+    latencies = []
+    counts = [0]
+
+    def on_packet():
+        counts[0] += 1
+
+    def on_position():
+        now = time.perf_counter()
+        counts[0] += 1
+        end = stream.position_ends.get(hedge.position()[4])
+        if end is not None:
+            latencies.append(now - port.time_read(end))
+
+    hedge = MarvelmindHedge(recieveUltrasoundPositionCallback=on_position, recieveImuRawDataCallback=on_packet,
+                            recieveImuDataCallback=on_packet)
+    hedge.serialPort = port
+    cpu_start = time.process_time()
+    start_time = time.perf_counter()
+    hedge.start()
+    while port.offset < len(stream.data) or port.in_waiting > 0:
+        time.sleep(.001)
+    hedge.terminationRequired = True
+    hedge.join()
+    elapsed = time.perf_counter() - start_time
+    return make_result(counts[0], elapsed, time.process_time() - cpu_start, latencies)
+
+
+def make_result(decoded, elapsed, cpu, latencies):
+    latencies = np.array(latencies) * 1000000 if len(latencies) > 0 else np.zeros(1)
+    return {
+        "decoded": decoded,
+        "packets_per_s": decoded / elapsed if elapsed > 0 else 0.0,
+        "cpu_us_per_packet": cpu / max(1, decoded) * 1000000,
+        "latency_p50_us": float(np.percentile(latencies, 50)),
+        "latency_p99_us": float(np.percentile(latencies, 99))
+    }
+
+
+def print_result(name, result):
+    print("  %-6s decoded %8d  %10.0f packets/s  cpu %7.2f us/packet  callback latency p50 %8.1f us  p99 %8.1f us"
+          % (name, result["decoded"], result["packets_per_s"], result["cpu_us_per_packet"],
+             result["latency_p50_us"], result["latency_p99_us"]))
+
+
+# every way the new results are worse than the baseline.  The decoded count must match exactly if the stream is the
+# same, a change means packets are being lost or made up.
+def compare(baseline, results, tolerance):
+    regressions = []
+    same_stream = baseline.get("meta") == results["meta"]
+    for name in ("decode", "thread"):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        new = results[name]
+        if new["packets_per_s"] < base["packets_per_s"] / (1 + tolerance):
+            regressions.append("%s packets_per_s %.0f -> %.0f" % (name, base["packets_per_s"], new["packets_per_s"]))
+        if new["cpu_us_per_packet"] > base["cpu_us_per_packet"] * (1 + tolerance):
+            regressions.append("%s cpu_us_per_packet %.2f -> %.2f" % (name, base["cpu_us_per_packet"],
+                                                                      new["cpu_us_per_packet"]))
+        if same_stream and new["decoded"] != base["decoded"]:
+            regressions.append("%s decoded %d -> %d" % (name, base["decoded"], new["decoded"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
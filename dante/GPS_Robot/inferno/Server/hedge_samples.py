@@ -0,0 +1,110 @@
+from vector import Vector
+import collections
+import threading
+import time
+
+# time between a beacon taking a position and the serial packet for it starting to arrive, in seconds.
+# This part of the delay can not be seen from the timestamps, everything after it is measured.
+BEACON_LATENCY = .03
+
+# the furthest ahead a position is ever extrapolated, so a beacon that goes quiet does not send the rover flying
+MAX_EXTRAPOLATION = .5
+
+
+# This class keeps the recent positions of every hedge along with the beacon timestamp of each one.
+# Positions of different hedges can then be compared at the same moment instead of whenever each last arrived, and
+# the newest position can be carried forward to now using how fast the hedge was moving.
+# The beacon clock is lined up with the local one by the quickest a sample has ever arrived.
+class HedgeSampleStore:
+    def __init__(self, depth=8, beacon_latency=BEACON_LATENCY):
+        self.depth = depth
+        self.beacon_latency = beacon_latency
+        self.__samples = {}  # address -> deque of (beacon time in seconds, x, y)
+        self.__clock_offset = None  # local time minus beacon time for the quickest sample seen
+        self.__lock = threading.Lock()
+
+    # add a sample, timestamp is the beacon's own time in milliseconds.  Repeats of the newest sample are ignored.
+    # It returns whether the sample was new.
+    def add(self, address, timestamp, x, y, arrival=None):
+        arrival = time.time() if arrival is None else arrival
+        beacon_time = timestamp / 1000.0
+        with self.__lock:
+            samples = self.__samples.get(address)
+            if samples is None:
+                samples = collections.deque(maxlen=self.depth)
+                self.__samples[address] = samples
+            elif len(samples) > 0 and beacon_time <= samples[-1][0]:
+                return False
+            samples.append((beacon_time, x, y))
+
+            offset = arrival - beacon_time
+            if self.__clock_offset is None or offset < self.__clock_offset:
+                self.__clock_offset = offset
+            return True
+
+    def has_samples(self, address):
+        return len(self.__samples.get(address, ())) > 0
+
+    # the newest sample of a hedge as (beacon time in seconds, Vector), or None
+    def latest(self, address):
+        with self.__lock:
+            samples = self.__samples.get(address)
+            if not samples:
+                return None
+            beacon_time, x, y = samples[-1]
+            return beacon_time, Vector(x, y)
+
+    # where a hedge was at a beacon time.  Between two samples it is interpolated, past the newest one it is
+    # extrapolated from the last two (never by more than MAX_EXTRAPOLATION).
+    def position_at(self, address, beacon_time):
+        with self.__lock:
+            samples = self.__samples.get(address)
+            if not samples:
+                return None
+            samples = list(samples)
+
+        # there is nothing to go on before the oldest sample, or to work out a speed from with only one
+        if beacon_time <= samples[0][0]:
+            return Vector(samples[0][1], samples[0][2])
+        if len(samples) == 1:
+            return Vector(samples[-1][1], samples[-1][2])
+
+        # find the pair around the time, or the last pair if the time is past every sample
+        for i in range(1, len(samples)):
+            if samples[i][0] >= beacon_time:
+                break
+        t0, x0, y0 = samples[i - 1]
+        t1, x1, y1 = samples[i]
+        beacon_time = min(beacon_time, t1 + MAX_EXTRAPOLATION)
+        share = (beacon_time - t0) / (t1 - t0)
+        return Vector(x0 + (x1 - x0) * share, y0 + (y1 - y0) * share)
+
+    # the beacon time that matches the local time now, so positions can be carried forward to the present
+    def beacon_now(self):
+        if self.__clock_offset is None:
+            return None
+        return time.time() - self.__clock_offset - self.beacon_latency
+
+    # how old the newest sample of a hedge is, in seconds, counting the delay before it reached us
+    def age(self, address):
+        latest = self.latest(address)
+        now = self.beacon_now()
+        if latest is None or now is None:
+            return None
+        return now - latest[0]
+
+    # where a hedge is now, its newest position carried forward by how long it has taken to get here
+    def position_now(self, address):
+        now = self.beacon_now()
+        if now is None:
+            return None
+        return self.position_at(address, now)
+
+    # the direction (degrees, the same as GPS.get_angle) from the rear hedge to the front hedge at the moment of the
+    # newest front sample, with the rear hedge moved to that same moment.  None until both have been heard from.
+    def heading(self, front, rear, get_angle):
+        latest = self.latest(front)
+        if latest is None or not self.has_samples(rear):
+            return None
+        beacon_time, front_position = latest
+        return get_angle(front_position, self.position_at(rear, beacon_time))
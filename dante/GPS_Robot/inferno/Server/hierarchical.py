@@ -0,0 +1,297 @@
+from grid import OPEN_SPACE
+import heapq
+import threading
+
+# entrances at least this wide get a transition at each end as well as the one in the middle
+WIDE_ENTRANCE = 6
+
+# queries whose start and end clusters are at most this many clusters apart are left to the flat search
+LOCAL_CLUSTERS = 2
+
+
+# This class is a hierarchical pathfinder (HPA*) layered over a Grid for large maps.
+# The grid is cut into square clusters.  Where two clusters touch, every run of open cells on both sides is an
+# entrance, and the cells either side of it are abstract nodes.  Inside each cluster the cost between its abstract
+# nodes is found once and kept, so a query is a small search over the abstract graph followed by short local searches
+# to turn it back into cells.  Clusters are only connected the first time a search reaches them, and when a cell
+# changes only its cluster (and the borders it sits on) are thrown away to be recomputed.
+class HierarchicalGrid:
+    def __init__(self, grid, cluster_size=10):
+        self.grid = grid
+        self.cluster_size = cluster_size
+        self.clusters_in_x = (grid.nodes_in_x + cluster_size - 1) // cluster_size
+        self.clusters_in_y = (grid.nodes_in_y + cluster_size - 1) // cluster_size
+        self.__cell_types = memoryview(grid.flat_types)
+        self.__lock = threading.Lock()
+
+        # abstract graph, filled in as searches need it
+        self.__transitions = {}  # (cluster, cluster) -> list of (cell, cell) pairs crossing that border
+        self.__intra_edges = {}  # cluster -> {cell: [(cell, cost), ...]} between the cluster's abstract nodes
+
+        # parts of the graph that are out of date
+        self.__dirty_borders = set()
+        self.__dirty_clusters = set()
+
+        grid.add_change_listener(self.cells_changed)
+
+    # stop listening to the grid
+    def close(self):
+        self.grid.remove_change_listener(self.cells_changed)
+
+    # grid listener, mark the clusters and borders the changed cells belong to
+    def cells_changed(self, cells):
+        size_y = self.grid.nodes_in_y
+        with self.__lock:
+            for cell in cells:
+                x, y = divmod(cell, size_y)
+                cluster = self.get_cluster(x, y)
+                self.__dirty_clusters.add(cluster)
+
+                # cells on the edge of a cluster also belong to the border with the cluster next to it
+                cx, cy = cluster
+                if x % self.cluster_size == 0 and cx > 0:
+                    self.__dirty_borders.add(((cx - 1, cy), cluster))
+                if (x + 1) % self.cluster_size == 0 and cx + 1 < self.clusters_in_x:
+                    self.__dirty_borders.add((cluster, (cx + 1, cy)))
+                if y % self.cluster_size == 0 and cy > 0:
+                    self.__dirty_borders.add(((cx, cy - 1), cluster))
+                if (y + 1) % self.cluster_size == 0 and cy + 1 < self.clusters_in_y:
+                    self.__dirty_borders.add((cluster, (cx, cy + 1)))
+
+    # which cluster an x, y grid point is in
+    def get_cluster(self, x, y):
+        return x // self.cluster_size, y // self.cluster_size
+
+    # the same as Grid.find_path, it returns a tuple of the full path and a simplified path
+    def find_path(self, start, end, use_obstacles=True):
+        # without obstacles there is nothing to gain from the hierarchy
+        if not use_obstacles:
+            return self.grid.find_path(start, end, False)
+
+        # if the pathfinding solution is not worth calculating.
+        if end is None or start is None:
+            return [], []
+        elif start == end:
+            return [], []
+        elif end.node_type != OPEN_SPACE:
+            return [], []
+
+        # nearby queries are cheap enough for the flat search, which is also always optimal
+        start_cluster = self.get_cluster(start.gridPos.x, start.gridPos.y)
+        end_cluster = self.get_cluster(end.gridPos.x, end.gridPos.y)
+        if abs(start_cluster[0] - end_cluster[0]) <= LOCAL_CLUSTERS and \
+                abs(start_cluster[1] - end_cluster[1]) <= LOCAL_CLUSTERS:
+            return self.grid.find_path(start, end)
+
+        with self.__lock:
+            self.__refresh()
+            abstract_path = self.__abstract_search(start.index, end.index)
+
+        # moves that cut a corner between clusters are not part of the abstract graph, let the flat search decide
+        if abstract_path is None:
+            return self.grid.find_path(start, end)
+
+        # refine every abstract step into real cells, each search only covers a short distance
+        path = []
+        previous = start
+        for cell in abstract_path[1:]:
+            node = self.grid.get_node_from_index(cell)
+            segment, _ = self.grid.find_path(previous, node)
+            if len(segment) == 0:
+                return self.grid.find_path(start, end)
+            path += segment
+            previous = node
+        return path, self.grid.make_simple_path(start, path)
+
+    # throw away the parts of the abstract graph the grid changes made out of date
+    def __refresh(self):
+        # new entrances change the abstract nodes of the clusters on both sides
+        for border in self.__dirty_borders:
+            self.__transitions.pop(border, None)
+            self.__dirty_clusters.update(border)
+        self.__dirty_borders = set()
+
+        for cluster in self.__dirty_clusters:
+            self.__intra_edges.pop(cluster, None)
+        self.__dirty_clusters = set()
+
+    # the borders a cluster shares with its neighbors, each written as (lower cluster, higher cluster)
+    def __cluster_borders(self, cluster):
+        cx, cy = cluster
+        borders = []
+        if cx > 0:
+            borders.append(((cx - 1, cy), cluster))
+        if cx + 1 < self.clusters_in_x:
+            borders.append((cluster, (cx + 1, cy)))
+        if cy > 0:
+            borders.append(((cx, cy - 1), cluster))
+        if cy + 1 < self.clusters_in_y:
+            borders.append((cluster, (cx, cy + 1)))
+        return borders
+
+    def __get_transitions(self, border):
+        if border not in self.__transitions:
+            self.__transitions[border] = self.__find_transitions(border)
+        return self.__transitions[border]
+
+    def __get_intra_edges(self, cluster):
+        if cluster not in self.__intra_edges:
+            self.__intra_edges[cluster] = self.__connect_cluster(cluster)
+        return self.__intra_edges[cluster]
+
+    # the edges from an abstract node across the borders of its cluster
+    def __get_inter_edges(self, cell):
+        edges = []
+        cluster = self.get_cluster(*divmod(cell, self.grid.nodes_in_y))
+        for border in self.__cluster_borders(cluster):
+            for a, b in self.__get_transitions(border):
+                if a == cell:
+                    edges.append((b, self.grid.non_diagonal_weight))
+                elif b == cell:
+                    edges.append((a, self.grid.non_diagonal_weight))
+        return edges
+
+    # the cells from x0 up to (not including) x1, and the same for y, that a cluster covers
+    def __cluster_bounds(self, cluster):
+        x0 = cluster[0] * self.cluster_size
+        y0 = cluster[1] * self.cluster_size
+        return x0, min(x0 + self.cluster_size, self.grid.nodes_in_x), \
+            y0, min(y0 + self.cluster_size, self.grid.nodes_in_y)
+
+    # find the transitions across a border, one or two for every run of open cells on both sides
+    def __find_transitions(self, border):
+        a, b = border
+        ax0, ax1, ay0, ay1 = self.__cluster_bounds(a)
+        size_y = self.grid.nodes_in_y
+
+        # the pairs of cells facing each other across the border
+        if a[0] != b[0]:
+            pairs = [((ax1 - 1) * size_y + y, ax1 * size_y + y) for y in range(ay0, ay1)]
+        else:
+            pairs = [(x * size_y + ay1 - 1, x * size_y + ay1) for x in range(ax0, ax1)]
+
+        transitions = []
+        run = []
+        for pair in pairs + [None]:
+            if pair is not None and self.__cell_types[pair[0]] == OPEN_SPACE and \
+                    self.__cell_types[pair[1]] == OPEN_SPACE:
+                run.append(pair)
+                continue
+
+            # a run just ended
+            if len(run) >= WIDE_ENTRANCE:
+                transitions.append(run[0])
+                transitions.append(run[-1])
+            if len(run) > 0:
+                transitions.append(run[len(run) // 2])
+            run = []
+        return transitions
+
+    # the abstract nodes of a cluster
+    def __cluster_nodes(self, cluster):
+        cells = set()
+        for border in self.__cluster_borders(cluster):
+            for a, b in self.__get_transitions(border):
+                cells.add(a if border[0] == cluster else b)
+        return cells
+
+    # costs between every pair of abstract nodes in a cluster
+    def __connect_cluster(self, cluster):
+        cells = self.__cluster_nodes(cluster)
+        edges = {}
+        for cell in cells:
+            costs = self.__search_cluster(cell, cluster, cells)
+            edges[cell] = [(other, cost) for other, cost in costs.items() if other != cell]
+        return edges
+
+    # dijkstra from one cell that never leaves a cluster, it returns the cost to each of the targets it reached
+    def __search_cluster(self, source, cluster, targets):
+        x0, x1, y0, y1 = self.__cluster_bounds(cluster)
+        size_y = self.grid.nodes_in_y
+        cell_types = self.__cell_types
+        diagonals = self.grid.include_diagonals
+        found = {}
+        remaining = len(targets)
+        costs = {source: 0.0}
+        open_set = [(0.0, source)]
+
+        while len(open_set) > 0 and remaining > 0:
+            cost, cell = heapq.heappop(open_set)
+            if cost > costs[cell]:
+                continue
+            if cell in targets and cell not in found:
+                found[cell] = cost
+                remaining -= 1
+
+            x, y = divmod(cell, size_y)
+            for i in range(-1, 2):
+                for j in range(-1, 2):
+                    if (i == 0 and j == 0) or (i != 0 and j != 0 and not diagonals):
+                        continue
+                    if not (x0 <= x + i < x1 and y0 <= y + j < y1):
+                        continue
+                    neighbor = cell + i * size_y + j
+                    if cell_types[neighbor] != OPEN_SPACE:
+                        continue
+                    new_cost = cost + (self.grid.diagonal_weight if i != 0 and j != 0 else
+                                       self.grid.non_diagonal_weight)
+                    if new_cost < costs.get(neighbor, float("inf")):
+                        costs[neighbor] = new_cost
+                        heapq.heappush(open_set, (new_cost, neighbor))
+        return found
+
+    # a* over the abstract graph with the start and end temporarily connected to their clusters.
+    # It returns the abstract cells from start to end, or None if the graph has no route.
+    def __abstract_search(self, start, end):
+        size_y = self.grid.nodes_in_y
+        start_cluster = self.get_cluster(*divmod(start, size_y))
+        end_cluster = self.get_cluster(*divmod(end, size_y))
+
+        # connect the start and the end to their clusters (and to each other if they share one)
+        start_targets = self.__cluster_nodes(start_cluster)
+        if start_cluster == end_cluster:
+            start_targets.add(end)
+        start_edges = list(self.__search_cluster(start, start_cluster, start_targets).items())
+        end_edges = self.__search_cluster(end, end_cluster, self.__cluster_nodes(end_cluster))
+
+        def get_edges(cell):
+            if cell == start:
+                edges = list(start_edges)
+            else:
+                edges = list(self.__get_intra_edges(self.get_cluster(*divmod(cell, size_y))).get(cell, []))
+                edges += self.__get_inter_edges(cell)
+            if cell in end_edges:
+                edges.append((end, end_edges[cell]))
+            return edges
+
+        def heuristic(cell):
+            x, y = divmod(cell, size_y)
+            end_x, end_y = divmod(end, size_y)
+            dst_x = abs(x - end_x)
+            dst_y = abs(y - end_y)
+            return self.grid.diagonal_weight * min(dst_x, dst_y) + self.grid.non_diagonal_weight * abs(dst_x - dst_y)
+
+        costs = {start: 0.0}
+        parents = {start: None}
+        open_set = [(heuristic(start), start)]
+        closed = set()
+        while len(open_set) > 0:
+            _, cell = heapq.heappop(open_set)
+            if cell in closed:
+                continue
+            if cell == end:
+                path = []
+                while cell is not None:
+                    path.append(cell)
+                    cell = parents[cell]
+                path.reverse()
+                return path
+            closed.add(cell)
+
+            for neighbor, weight in get_edges(cell):
+                new_cost = costs[cell] + weight
+                if neighbor not in closed and new_cost < costs.get(neighbor, float("inf")):
+                    costs[neighbor] = new_cost
+                    parents[neighbor] = cell
+                    heapq.heappush(open_set, (new_cost + heuristic(neighbor), neighbor))
+        return None
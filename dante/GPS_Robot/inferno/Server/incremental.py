@@ -0,0 +1,153 @@
+from array import array
+from search import IndexedHeap
+from grid import OPEN_SPACE
+import threading
+
+INFINITY = float("inf")
+
+
+# This class is the incremental search (D* Lite) shared by the incremental planner and the distance field.
+# Costs grow outwards from a root cell and are kept between calls.  A grid change only repairs the costs that went
+# through the changed cells, and the route from a cell to the root is a walk downhill through the costs.
+# A subclass picks when to stop searching and may guide the search towards a start cell with a heuristic, the
+# distance field has no start and settles every cell.
+class IncrementalSearch:
+    def __init__(self, grid, root):
+        self.grid = grid
+        self.root = root
+        self._cell_types = memoryview(grid.flat_types)
+        self._lock = threading.Lock()  # the gps thread and the command thread may both ask for paths
+
+        # search state, every cell starts unreached
+        size = grid.get_num_of_nodes()
+        self._g_costs = array('d', [INFINITY]) * size
+        self._rhs = array('d', [INFINITY]) * size  # one step look ahead costs
+        self._open_set = IndexedHeap(size)
+        self._km = 0.0  # how far the start has moved, it keeps old queue keys valid
+        self._changed_cells = set()
+
+        # the root of the search tree
+        self._rhs[root.index] = 0.0
+        self._open_set.push(root.index, self._calculate_key(root.index, None))
+
+        # hear about every change made to the grid
+        grid.add_change_listener(self.cells_changed)
+
+    # stop listening to the grid, the search can not be used afterwards
+    def close(self):
+        self.grid.remove_change_listener(self.cells_changed)
+
+    # grid listener, the changed cells are only remembered here.  They are repaired the next time the search is used.
+    def cells_changed(self, cells):
+        with self._lock:
+            self._changed_cells.update(cells)
+
+    # a lower bound on the cost between two cells, start is None when there is no start to aim for
+    def _heuristic(self, start, cell):
+        return 0.0
+
+    def _calculate_key(self, cell, start):
+        cost = min(self._g_costs[cell], self._rhs[cell])
+        return cost + self._heuristic(start, cell) + self._km, cost
+
+    # the cost of stepping from cell into one of its neighbors, obstacles and borders can not be entered
+    def _move_cost(self, cell, neighbor):
+        if self._cell_types[neighbor] != OPEN_SPACE:
+            return INFINITY
+        size_y = self.grid.nodes_in_y
+        if cell // size_y != neighbor // size_y and cell % size_y != neighbor % size_y:
+            return self.grid.diagonal_weight
+        return self.grid.non_diagonal_weight
+
+    # repair every cell whose way into a changed cell just got cheaper or more expensive
+    def _repair(self, start):
+        if len(self._changed_cells) == 0:
+            return
+        changed = self._changed_cells
+        self._changed_cells = set()
+        for cell in changed:
+            self._update_vertex(cell, start)
+            for neighbor in self.grid.get_neighbor_indices(cell, self.grid.include_diagonals):
+                self._update_vertex(neighbor, start)
+
+    # recalculate the look ahead cost of a cell and put it in the queue if it is inconsistent
+    def _update_vertex(self, cell, start):
+        if cell != self.root.index:
+            best = INFINITY
+            for neighbor in self.grid.get_neighbor_indices(cell, self.grid.include_diagonals):
+                cost = self._move_cost(cell, neighbor) + self._g_costs[neighbor]
+                if cost < best:
+                    best = cost
+            self._rhs[cell] = best
+
+        in_queue = cell in self._open_set
+        if self._g_costs[cell] != self._rhs[cell]:
+            if in_queue:
+                self._open_set.update(cell, self._calculate_key(cell, start))
+            else:
+                self._open_set.push(cell, self._calculate_key(cell, start))
+        elif in_queue:
+            self._open_set.remove(cell)
+
+    # expand cells until the start is consistent and nothing in the queue could still improve it.
+    # Without a start every cell is settled.
+    def _compute(self, start):
+        open_set = self._open_set
+        g_costs = self._g_costs
+        rhs = self._rhs
+        diagonals = self.grid.include_diagonals
+
+        while len(open_set) > 0 and (start is None or open_set.top_key() < self._calculate_key(start, start) or
+                                     rhs[start] != g_costs[start]):
+            cell = open_set.top()
+            old_key = open_set.top_key()
+            new_key = self._calculate_key(cell, start)
+
+            # the key is out of date because the start moved
+            if old_key < new_key:
+                open_set.update(cell, new_key)
+
+            # the cell got cheaper, settle it and let its neighbors know
+            elif g_costs[cell] > rhs[cell]:
+                g_costs[cell] = rhs[cell]
+                open_set.remove(cell)
+                for neighbor in self.grid.get_neighbor_indices(cell, diagonals):
+                    self._update_vertex(neighbor, start)
+
+            # the cell got more expensive, throw its cost away and recalculate it and its neighbors
+            else:
+                g_costs[cell] = INFINITY
+                self._update_vertex(cell, start)
+                for neighbor in self.grid.get_neighbor_indices(cell, diagonals):
+                    self._update_vertex(neighbor, start)
+
+    # follow the cheapest neighbor from the start until the root is reached
+    def _extract_path(self, start):
+        if self._g_costs[start] == INFINITY:
+            return []
+
+        path = []
+        cell = start
+        root = self.root.index
+        while cell != root:
+            best = None
+            best_cost = INFINITY
+            for neighbor in self.grid.get_neighbor_indices(cell, self.grid.include_diagonals):
+                cost = self._move_cost(cell, neighbor) + self._g_costs[neighbor]
+                if cost < best_cost:
+                    best = neighbor
+                    best_cost = cost
+
+            # a dead end or a loop means the tree is not usable, there is no path
+            if best is None or len(path) > self.grid.get_num_of_nodes():
+                return []
+            path.append(best)
+            cell = best
+        return path
+
+    # turn the cells of a path from start into nodes, in the same form as Grid.find_path
+    def _make_path(self, start, cells):
+        if len(cells) == 0:
+            return [], []
+        path = [self.grid.get_node_from_index(cell) for cell in cells]
+        return path, self.grid.make_simple_path(start, path)
@@ -18,6 +18,9 @@
 #   maxvaluescount - maximum count of measurements of coordinates stored in buffer
 #       default: 3
 #
+#   samplesdepth - count of positions kept for every hedge address, the newest samplesdepth - 1 of them can be read
+#       default: 64
+#
 #   valuesUltrasoundPosition - buffer of measurements
 #
 #   debug - debug flag which activate console output    
@@ -39,16 +42,27 @@
 #   position(self)
 #       return last measured data in array [x, y, z, timestamp]
 #
+#   latest(self, address)
+#       return the newest (sequence, timestamp, x, y, z) of one hedge, or None
+#
+#   samples_since(self, address, sequence)
+#       iterate over the (sequence, timestamp, x, y, z) of one hedge that came after sequence
+#
+#   add_address_callback(self, address, callback)
+#       call callback(address) for every new position of one hedge
+#
 #   stop(self)
 #       stop infinite loop and close port
 #
+#   open_port(self), read_available(self)
+#       read the port from an event loop instead of the thread
+#
+#   decode(self, data)
+#       parse a chunk of serial bytes, any packet cut off at the end is finished by the next chunk
+#
 ### Needed libraries:
 #
-# To prevent errors when installing crcmod module used in this script, use the following sequence of commands:
-#   sudo apt-get install python-pip
-#   sudo apt-get update
-#   sudo apt-get install python-dev
-#   sudo pip install crcmod
+#   pyserial.  The CRC16 (modbus) is worked out from a table in this file, crcmod is no longer needed.
 #
 ###
 
@@ -59,10 +73,11 @@
 # lastImuValues -> valuesImuRawData
 # recieveAccelerometerDataCallback -> recieveImuRawDataCallback
 # mm and cm -> m
+# bytes are read in bulk and parsed in place, packets are picked by their type with one lookup
 ###
 
-import crcmod
 import serial
+from array import array
 import struct
 import collections
 import time
@@ -72,15 +87,117 @@ import math
 # import numpy as np
 # import marvelmindQuaternion as mq
 
+# every packet starts with these two bytes, then the packet type (2 bytes), the payload length (1 byte), the payload
+# and a CRC16 (modbus) of everything before it
+PACKET_HEADER = b'\xff\x47'
+PACKET_HEADER_SIZE = 5
+PACKET_OVERHEAD = PACKET_HEADER_SIZE + 2
+MAX_BUFFER_SIZE = 4096  # bytes kept while waiting for the rest of a packet, anything more is garbage
+
+# packet types
+PACKET_US_POSITION_CM = 0x0001
+PACKET_IMU_RAW = 0x0003
+PACKET_DISTANCES = 0x0004
+PACKET_IMU = 0x0005
+PACKET_US_POSITION_MM = 0x0011
+
+# payload layouts, each one ends with the CRC
+PACKET_FORMATS = {
+    PACKET_US_POSITION_CM: struct.Struct('<LhhhxBxxxxH'),
+    PACKET_US_POSITION_MM: struct.Struct('<LlllxBxxxxH'),
+    PACKET_IMU_RAW: struct.Struct('<hhhhhhhhhxxxxxxLxxxxH'),
+    PACKET_IMU: struct.Struct('<lllhhhhhhhhhhxxLxxxxH'),
+}
+
+
+def _make_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = _make_crc16_table()
+
+
+# CRC16 (modbus) of data[start:end].  Run over a whole packet, CRC included, it comes out 0 if the packet is intact.
+def crc16_modbus(data, start=0, end=None):
+    table = CRC16_TABLE
+    crc = 0xFFFF
+    with memoryview(data) as view:
+        for byte in view[start:end]:
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+# The positions of one hedge, kept in preallocated arrays used as a ring buffer.
+# Only the thread reading the serial port writes to it.  A slot is filled before the sequence is raised, so readers
+# never need a lock.  A reader checks the sequence again after reading a slot, in case the writer lapped it.  The oldest
+# slot is the one the writer fills next, so only the newest depth - 1 samples can be read.
+class HedgeSampleBuffer:
+    def __init__(self, address, depth=64):
+        self.address = address
+        self.depth = depth
+        self.timestamps = array('d', [0.0]) * depth
+        self.xs = array('d', [0.0]) * depth
+        self.ys = array('d', [0.0]) * depth
+        self.zs = array('d', [0.0]) * depth
+        self.sequence = 0  # number of positions ever added, the newest one has sequence - 1
+
+    def append(self, timestamp, x, y, z):
+        slot = self.sequence % self.depth
+        self.timestamps[slot] = timestamp
+        self.xs[slot] = x
+        self.ys[slot] = y
+        self.zs[slot] = z
+        self.sequence += 1
+
+    # the sample with a sequence number as (sequence, timestamp, x, y, z), None if it is gone or not there yet
+    def get(self, sequence):
+        if sequence < 0 or sequence >= self.sequence:
+            return None
+        slot = sequence % self.depth
+        sample = (sequence, self.timestamps[slot], self.xs[slot], self.ys[slot], self.zs[slot])
+        if self.sequence - sequence >= self.depth:
+            return None
+        return sample
+
+    def latest(self):
+        return self.get(self.sequence - 1)
+
+    # every sample after sequence that is still in the buffer, oldest first.  Start at -1 to get everything.
+    def since(self, sequence):
+        newest = self.sequence
+        for i in range(max(sequence + 1, newest - self.depth + 1), newest):
+            sample = self.get(i)
+            if sample is not None:
+                yield sample
+
+
 class MarvelmindHedge (Thread):
-    def __init__ (self, adr=None, tty="/dev/ttyACM0", baud=9600, maxvaluescount=3, debug=False, recieveUltrasoundPositionCallback=None, recieveImuRawDataCallback=None, recieveImuDataCallback=None, recieveUltrasoundRawDataCallback=None):
+    def __init__ (self, adr=None, tty="/dev/ttyACM0", baud=9600, maxvaluescount=3, debug=False, recieveUltrasoundPositionCallback=None, recieveImuRawDataCallback=None, recieveImuDataCallback=None, recieveUltrasoundRawDataCallback=None, samplesdepth=64):
         self.tty = tty  # serial
         self.baud = baud  # baudrate
         self.debug = debug  # debug flag
-        self._bufferSerialDeque = collections.deque(maxlen=255)  # serial buffer
+        self._bufferSerial = bytearray()  # serial bytes that have not been parsed yet
+        self._packetHandlers = {
+            PACKET_US_POSITION_CM: self._handle_position_cm,
+            PACKET_US_POSITION_MM: self._handle_position_mm,
+            PACKET_IMU_RAW: self._handle_imu_raw,
+            PACKET_IMU: self._handle_imu,
+        }
 
         self.valuesUltrasoundPosition = collections.deque([[0]*5]*maxvaluescount, maxlen=maxvaluescount) # ultrasound position buffer
         self.recieveUltrasoundPositionCallback = recieveUltrasoundPositionCallback
+        self.samplesDepth = samplesdepth
+        self.samplesByAddress = {}  # address -> HedgeSampleBuffer
+        self.addressCallbacks = {}  # address -> list of callbacks
         
         self.valuesImuRawData = collections.deque([[0]*10]*maxvaluescount, maxlen=maxvaluescount) # raw imu data buffer
         self.recieveImuRawDataCallback = recieveImuRawDataCallback
@@ -107,6 +224,26 @@ class MarvelmindHedge (Thread):
 
     def position(self):
         return list(self.valuesUltrasoundPosition)[-1];
+
+    def latest(self, address):
+        buffer = self.samplesByAddress.get(address)
+        return None if buffer is None else buffer.latest()
+
+    def samples_since(self, address, sequence=-1):
+        buffer = self.samplesByAddress.get(address)
+        if (buffer is None):
+            return iter(())
+        return buffer.since(sequence)
+
+    def addresses(self):
+        return list(self.samplesByAddress.keys())
+
+    def add_address_callback(self, address, callback):
+        self.addressCallbacks.setdefault(address, []).append(callback)
+
+    def remove_address_callback(self, address, callback):
+        if (callback in self.addressCallbacks.get(address, [])):
+            self.addressCallbacks[address].remove(callback)
     
     def stop(self):
         self.terminationRequired = True
@@ -118,105 +255,15 @@ class MarvelmindHedge (Thread):
                 try:
                     if (self.serialPort is None):
                         self.serialPort = serial.Serial(self.tty, self.baud, timeout=3)
-                    readChar = self.serialPort.read(1)
-                    while (readChar is not None) and (readChar is not '') and (not self.terminationRequired):
-                        self._bufferSerialDeque.append(readChar)
-                        readChar = self.serialPort.read(1)
-                        bufferList = list(self._bufferSerialDeque)
-                        
-                        strbuf = (b''.join(bufferList))
-
-                        pktHdrOffset = strbuf.find(b'\xff\x47')
-                        if (pktHdrOffset >= 0 and len(bufferList) > pktHdrOffset + 4 and pktHdrOffset<220):
-#                           print(bufferList)
-                            isMmMessageDetected = False
-                            isCmMessageDetected = False
-                            isRawImuMessageDetected = False
-                            isImuMessageDetected = False
-                            isDistancesMessageDetected = False
-                            pktHdrOffsetCm = strbuf.find(b'\xff\x47\x01\x00')
-                            pktHdrOffsetMm = strbuf.find(b'\xff\x47\x11\x00')
-                            pktHdrOffsetRawImu = strbuf.find(b'\xff\x47\x03\x00')
-                            pktHdrOffsetDistances = strbuf.find(b'\xff\x47\x04\x00')
-                            pktHdrOffsetImu = strbuf.find(b'\xff\x47\x05\x00')
-
-                            if (pktHdrOffsetMm!=-1):
-                                isMmMessageDetected = True
-                                if (self.debug): print ('Message with US-position(mm) was detected')
-                            elif (pktHdrOffsetCm!=-1):
-                                isCmMessageDetected = True
-                                if (self.debug): print ('Message with US-position(cm) was detected')
-                            elif (pktHdrOffsetRawImu!=-1):
-                                isRawImuMessageDetected = True
-                                if (self.debug): print ('Message with raw IMU data was detected')
-                            elif (pktHdrOffsetDistances!=-1):
-                                isDistancesMessageDetected = True
-                                if (self.debug): print ('Message with distances was detected')
-                            elif (pktHdrOffsetImu!=-1):
-                                isImuMessageDetected = True
-                                if (self.debug): print ('Message with processed IMU data was detected')
-                            msgLen = ord(bufferList[pktHdrOffset + 4])
-                            if (self.debug): print ('Message length: ', msgLen)
-
-                            try:
-                                if (len(bufferList) > pktHdrOffset + 4 + msgLen + 2):
-                                    usnCRC16 = 0
-                                    if (isCmMessageDetected):
-                                        usnTimestamp, usnX, usnY, usnZ, usnAdr, usnCRC16 = struct.unpack_from ('<LhhhxBxxxxH', strbuf, pktHdrOffset + 5)
-                                        usnX = usnX/100.0
-                                        usnY = usnY/100.0
-                                        usnZ = usnZ/100.0
-                                    elif (isMmMessageDetected):
-                                        usnTimestamp, usnX, usnY, usnZ, usnAdr, usnCRC16 = struct.unpack_from ('<LlllxBxxxxH', strbuf, pktHdrOffset + 5)
-                                        usnX = usnX/1000.0
-                                        usnY = usnY/1000.0
-                                        usnZ = usnZ/1000.0
-                                    elif (isRawImuMessageDetected):
-                                        ax, ay, az, gx, gy, gz, mx, my, mz, timestamp, usnCRC16 = struct.unpack_from ('<hhhhhhhhhxxxxxxLxxxxH', strbuf, pktHdrOffset + 5)
-                                    elif (isImuMessageDetected):
-                                        x, y, z, qw, qx, qy, qz, vx, vy, vz, ax, ay, az, timestamp, usnCRC16 = struct.unpack_from ('<lllhhhhhhhhhhxxLxxxxH', strbuf, pktHdrOffset + 5)
-
-                                    crc16 = crcmod.predefined.Crc('modbus')
-                                    crc16.update(strbuf[ pktHdrOffset : pktHdrOffset + msgLen + 5 ])
-                                    CRC_calc = int(crc16.hexdigest(), 16)
-
-                                    if CRC_calc == usnCRC16:
-                                        if (isMmMessageDetected or isCmMessageDetected):
-                                            value = [usnAdr, usnX, usnY, usnZ, usnTimestamp]
-                                            if (self.adr == usnAdr or self.adr is None):
-                                                self.valuesUltrasoundPosition.append(value)
-                                                if (self.recieveUltrasoundPositionCallback is not None):
-                                                    self.recieveUltrasoundPositionCallback()
-                                        elif (isRawImuMessageDetected):
-                                            value = [ax, ay, az, gx, gy, gz, mx, my, mz, timestamp]
-                                            self.valuesImuRawData.append(value)
-                                            if (self.recieveImuRawDataCallback is not None):
-                                                self.recieveImuRawDataCallback()
-                                        # elif (isDistancesMessageDetected):
-                                        #     value = 
-                                        #     self.valuesUltrasoundRawData.append(value)
-                                        #     if (self.recieveUltrasoundRawDataCallback is not None):
-                                        #         self.recieveUltrasoundRawDataCallback()
-                                        elif (isImuMessageDetected):
-                                            value = [x/1000.0, y/1000.0, z/1000.0, qw/10000.0, qx/10000.0, qy/10000.0, qz/10000.0, vx/1000.0, vy/1000.0, vz/1000.0, ax/1000.0,ay/1000.0,az/1000.0, timestamp]
-                                            self.valuesImuData.append(value)
-                                            if (self.recieveImuDataCallback is not None):
-                                                self.recieveImuDataCallback()
-                                    else:
-                                        if self.debug:
-                                            print ('\n*** CRC ERROR')
-
-                                    if pktHdrOffset == -1:
-                                        if self.debug:
-                                            print ('\n*** ERROR: Marvelmind USNAV beacon packet header not found (check modem board or radio link)')
-                                        continue
-                                    elif pktHdrOffset >= 0:
-                                        if self.debug:
-                                            print ('\n>> Found USNAV beacon packet header at offset %d' % pktHdrOffset)
-                                    for x in range(0, pktHdrOffset + msgLen + 7):
-                                        self._bufferSerialDeque.popleft()
-                            except struct.error:
-                                print ('smth wrong')
+
+                    # wait for the first byte, then take everything that has arrived with it
+                    data = self.serialPort.read(1)
+                    while (len(data) > 0) and (not self.terminationRequired):
+                        waiting = self.serialPort.in_waiting
+                        if (waiting > 0):
+                            data += self.serialPort.read(waiting)
+                        self.decode(data)
+                        data = self.serialPort.read(1)
                 except OSError:
                     if self.debug:
                         print ('\n*** ERROR: OS error (possibly serial port is not available)')
@@ -230,4 +277,109 @@ class MarvelmindHedge (Thread):
                 time.sleep(1)
     
         if (self.serialPort is not None):
-            self.serialPort.close()
\ No newline at end of file
+            self.serialPort.close()
+
+    # open the serial port without starting the thread, for reading it from an event loop instead.
+    # It returns the file descriptor to wait on.
+    def open_port(self):
+        if (self.serialPort is None):
+            self.serialPort = serial.Serial(self.tty, self.baud, timeout=0)
+        return self.serialPort.fileno()
+
+    # read and parse whatever has arrived without waiting for more.  It returns False if the port has gone away, it
+    # has to be opened again before the next read.
+    def read_available(self):
+        try:
+            waiting = self.serialPort.in_waiting
+            if (waiting > 0):
+                self.decode(self.serialPort.read(waiting))
+            return True
+        except (OSError, serial.SerialException):
+            if self.debug:
+                print ('\n*** ERROR: serial port error (possibly beacon is reset, powered down or in sleep mode). Restarting reading process...')
+            try:
+                self.serialPort.close()
+            except (OSError, serial.SerialException):
+                pass
+            self.serialPort = None
+            return False
+
+    # parse every whole packet in the buffered bytes plus data.  Packets are unpacked where they sit in the buffer and
+    # the used bytes are dropped in one go at the end.  It returns the number of packets with a good CRC.
+    def decode(self, data):
+        buf = self._bufferSerial
+        buf += data
+        size = len(buf)
+        offset = 0
+        decoded = 0
+        while (True):
+            pktHdrOffset = buf.find(PACKET_HEADER, offset)
+            if (pktHdrOffset == -1):
+                # a lone 0xff at the very end could still be the start of a header
+                offset = size - 1 if (size > 0 and buf[-1] == 0xff) else size
+                break
+            if (pktHdrOffset + PACKET_HEADER_SIZE > size):
+                offset = pktHdrOffset
+                break
+
+            msgLen = buf[pktHdrOffset + 4]
+            pktEnd = pktHdrOffset + msgLen + PACKET_OVERHEAD
+            if (pktEnd > size):
+                offset = pktHdrOffset
+                break
+
+            # a bad CRC means the header was a coincidence or the packet is damaged, look again one byte on
+            if (crc16_modbus(buf, pktHdrOffset, pktEnd) != 0):
+                if self.debug:
+                    print ('\n*** CRC ERROR')
+                offset = pktHdrOffset + 1
+                continue
+
+            pktType = buf[pktHdrOffset + 2] | (buf[pktHdrOffset + 3] << 8)
+            packetFormat = PACKET_FORMATS.get(pktType)
+            if (packetFormat is not None and packetFormat.size == msgLen + 2):
+                self._packetHandlers[pktType](packetFormat.unpack_from(buf, pktHdrOffset + PACKET_HEADER_SIZE))
+                decoded += 1
+            elif self.debug:
+                print ('\n>> Skipped packet of type 0x%04x' % pktType)
+            offset = pktEnd
+
+        # drop what has been used, and garbage that has piled up without a packet in it
+        if (size - offset > MAX_BUFFER_SIZE):
+            offset = size - MAX_BUFFER_SIZE
+        del buf[:offset]
+        return decoded
+
+    def _handle_position_cm(self, values):
+        usnTimestamp, usnX, usnY, usnZ, usnAdr, _ = values
+        self._add_position(usnAdr, usnX/100.0, usnY/100.0, usnZ/100.0, usnTimestamp)
+
+    def _handle_position_mm(self, values):
+        usnTimestamp, usnX, usnY, usnZ, usnAdr, _ = values
+        self._add_position(usnAdr, usnX/1000.0, usnY/1000.0, usnZ/1000.0, usnTimestamp)
+
+    def _add_position(self, usnAdr, usnX, usnY, usnZ, usnTimestamp):
+        if (self.adr == usnAdr or self.adr is None):
+            buffer = self.samplesByAddress.get(usnAdr)
+            if (buffer is None):
+                buffer = HedgeSampleBuffer(usnAdr, self.samplesDepth)
+                self.samplesByAddress[usnAdr] = buffer
+            buffer.append(usnTimestamp, usnX, usnY, usnZ)
+
+            self.valuesUltrasoundPosition.append([usnAdr, usnX, usnY, usnZ, usnTimestamp])
+            if (self.recieveUltrasoundPositionCallback is not None):
+                self.recieveUltrasoundPositionCallback()
+            for callback in self.addressCallbacks.get(usnAdr, ()):
+                callback(usnAdr)
+
+    def _handle_imu_raw(self, values):
+        self.valuesImuRawData.append(list(values[:10]))
+        if (self.recieveImuRawDataCallback is not None):
+            self.recieveImuRawDataCallback()
+
+    def _handle_imu(self, values):
+        x, y, z, qw, qx, qy, qz, vx, vy, vz, ax, ay, az, timestamp, _ = values
+        value = [x/1000.0, y/1000.0, z/1000.0, qw/10000.0, qx/10000.0, qy/10000.0, qz/10000.0, vx/1000.0, vy/1000.0, vz/1000.0, ax/1000.0,ay/1000.0,az/1000.0, timestamp]
+        self.valuesImuData.append(value)
+        if (self.recieveImuDataCallback is not None):
+            self.recieveImuDataCallback()
@@ -0,0 +1,70 @@
+from grid import OBSTACLE
+import numpy as np
+import threading
+
+# evidence a single reading adds to a cell, as log odds.  A hit means roughly 70% occupied, a miss 40%.
+HIT_LOG_ODDS = 0.85
+MISS_LOG_ODDS = -0.4
+
+# how sure the layer has to be before the grid is changed
+OCCUPIED_THRESHOLD = 1.5  # two hits in a row
+FREE_THRESHOLD = -0.8  # two misses in a row for a cell nothing has been seen in
+
+# cells never get more certain than this, so a cell can always change its mind in a handful of readings
+MAX_LOG_ODDS = 3.5
+
+
+# This class keeps a log odds occupancy estimate for every cell of a grid, fed by the distance sensor.
+# Readings only add evidence.  A cell is turned into an obstacle once it is confidently occupied and cleared once it
+# is confidently free, so a single bad echo no longer reroutes the rover.
+class OccupancyLayer:
+    def __init__(self, grid, hit=HIT_LOG_ODDS, miss=MISS_LOG_ODDS, occupied_threshold=OCCUPIED_THRESHOLD,
+                 free_threshold=FREE_THRESHOLD, max_log_odds=MAX_LOG_ODDS):
+        self.grid = grid
+        self.hit = hit
+        self.miss = miss
+        self.occupied_threshold = occupied_threshold
+        self.free_threshold = free_threshold
+        self.max_log_odds = max_log_odds
+        self.log_odds = np.zeros(grid.get_num_of_nodes(), dtype=np.float32)  # indexed by cell id, 0 is unknown
+        self.__lock = threading.Lock()
+
+    # the chance a node is occupied
+    def probability(self, node):
+        return 1.0 - 1.0 / (1.0 + float(np.exp(self.log_odds[node.index])))
+
+    # forget everything that has been seen
+    def clear(self):
+        with self.__lock:
+            self.log_odds[:] = 0.0
+
+    # add a single reading from start to end, see update_rays
+    def update_ray(self, start, end, hit):
+        return self.update_rays(start, [(end.gridPos.x, end.gridPos.y)], [hit])
+
+    # add many readings taken from one origin node.  ends holds the grid x, y of the end of every ray and hits says
+    # which of the rays ended on something.  Every cell a ray passes through counts as a miss, the end of a ray that
+    # hit counts as a hit.
+    # It returns the cell ids that should become obstacles and the ones that should be cleared, judged against the
+    # current state of the grid.  The grid itself is left for the caller to change.
+    def update_rays(self, origin, ends, hits):
+        ends = np.asarray(ends, dtype=np.intp).reshape(-1, 2)
+        hits = np.asarray(hits, dtype=bool)
+        hit_cells = ends[hits, 0] * self.grid.nodes_in_y + ends[hits, 1]
+        missed_cells = np.setdiff1d(self.grid.cast_rays(origin, ends), hit_cells)
+
+        with self.__lock:
+            # a cell hit by several rays gets all of the evidence, a cell passed through only counts once
+            log_odds = self.log_odds
+            log_odds[missed_cells] += self.miss
+            np.add.at(log_odds, hit_cells, self.hit)
+
+            cells = np.union1d(missed_cells, hit_cells).astype(np.intp)
+            cell_odds = np.clip(log_odds[cells], -self.max_log_odds, self.max_log_odds)
+            log_odds[cells] = cell_odds
+
+        # only cells that crossed a threshold against what the grid already says are worth changing
+        is_obstacle = self.grid.flat_types[cells] == OBSTACLE
+        occupied = cells[(cell_odds >= self.occupied_threshold) & ~is_obstacle]
+        free = cells[(cell_odds <= self.free_threshold) & is_obstacle]
+        return occupied, free
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from grid import OPEN_SPACE
+import threading
+
+
+# This class remembers paths found on a grid so the same segment does not have to be searched again every time the
+# rover crosses into a new cell.  Entries are keyed by start and goal and are valid for the grid version they were
+# found (or last checked) in.  When the grid changes, only the entries the change could affect are thrown away:
+#   - a cell that became blocked only matters if the path runs through it.
+#   - a cell that became open only matters if it is inside the path's bounding box (plus a margin), since that is
+#     where a shorter route would have to go.
+# Every other entry is carried over to the new version.  Least recently used entries are dropped once full.
+class PathCache:
+    def __init__(self, grid, max_size=64, margin=None):
+        self.grid = grid
+        self.max_size = max_size
+        self.margin = grid.border_thickness + 1 if margin is None else margin  # how far the bounding box is inflated
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+        grid.add_change_listener(self.cells_changed)
+
+    # stop listening to the grid and forget everything
+    def close(self):
+        self.grid.remove_change_listener(self.cells_changed)
+        self.clear()
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    # the same as Grid.find_path, but answered from the cache when possible
+    def find_path(self, start, end):
+        if start is None or end is None:
+            return [], []
+
+        key = (start.index, end.index)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry.version == self.grid.version:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return list(entry.path), list(entry.simple_path)
+            self.misses += 1
+
+        # search outside the lock, the grid's own search is already thread safe
+        version = self.grid.version
+        path, simple_path = self.grid.find_path(start, end)
+
+        # having no route says nothing about where a route could open up, so failures are never kept
+        if len(path) > 0:
+            with self.__lock:
+                self.__entries[key] = CacheEntry(self.grid, start, path, simple_path, version, self.margin)
+                self.__entries.move_to_end(key)
+                while len(self.__entries) > self.max_size:
+                    self.__entries.popitem(last=False)
+        return list(path), list(simple_path)
+
+    # grid listener, drop the entries affected by the changed cells and carry the rest over to the new version
+    def cells_changed(self, cells):
+        size_y = self.grid.nodes_in_y
+        cell_types = self.grid.flat_types
+        blocked = []
+        opened = []
+        for cell in cells:
+            if cell_types[cell] == OPEN_SPACE:
+                opened.append(divmod(cell, size_y))
+            else:
+                blocked.append(cell)
+
+        with self.__lock:
+            for key in list(self.__entries.keys()):
+                entry = self.__entries[key]
+                if entry.is_affected(blocked, opened):
+                    del self.__entries[key]
+                else:
+                    entry.version = self.grid.version
+
+
+# A single cached path along with the region of the grid it depends on.
+class CacheEntry:
+    def __init__(self, grid, start, path, simple_path, version, margin):
+        self.path = path
+        self.simple_path = simple_path
+        self.version = version
+        self.cells = set(node.index for node in path)
+
+        # bounding box of the whole route, inflated by the margin
+        xs = [start.gridPos.x] + [node.gridPos.x for node in path]
+        ys = [start.gridPos.y] + [node.gridPos.y for node in path]
+        self.min_x = min(xs) - margin
+        self.max_x = max(xs) + margin
+        self.min_y = min(ys) - margin
+        self.max_y = max(ys) + margin
+
+    def is_affected(self, blocked, opened):
+        for cell in blocked:
+            if cell in self.cells:
+                return True
+        for x, y in opened:
+            if self.min_x <= x <= self.max_x and self.min_y <= y <= self.max_y:
+                return True
+        return False
@@ -0,0 +1,184 @@
+from vector import Vector
+import math
+
+# how far along the path the follower aims, in meters.  It grows with speed so fast driving does not weave.
+MIN_LOOKAHEAD = .15
+LOOKAHEAD_TIME = .6  # seconds of driving
+
+# the speed profile, in meters a second (squared)
+ACCELERATION = .25
+DECELERATION = .2
+MIN_SPEED = .03  # slowest the rover creeps along, it would stall any slower
+MAX_LATERAL_ACCELERATION = .3  # how hard the rover may be pushed sideways going around a curve
+
+# the slowest share of full speed a corner is taken at, a u turn gets this and a straight line gets full speed
+MIN_CORNER_SHARE = .25
+
+# past this heading error (degrees) the rover stops and turns on the spot instead of driving around in a loop
+TURN_IN_PLACE_ANGLE = 75
+
+
+# This class follows a whole list of waypoints without stopping at each one (pure pursuit).
+# Every update it finds the point a lookahead distance further along the path and steers along the arc that reaches
+# it, which gives a speed for each wheel.  The speed follows a trapezoid: it ramps up, holds, and is brought down early
+# enough to get around each corner and to stop on the last waypoint.
+# Positions are in meters, headings in degrees the same as GPS.get_angle, and speeds in meters a second.
+class PathFollower:
+    def __init__(self, wheel_base=.117, max_speed=.3, threshold=.06):
+        self.wheel_base = wheel_base
+        self.max_speed = max_speed
+        self.threshold = threshold  # how close counts as having reached the last waypoint
+        self.__points = []
+        self.__segment = 0  # the segment of the path the rover is on, it only ever moves forward
+        self.__speed = 0.0
+
+    # start following waypoints from position
+    def start(self, position, waypoints):
+        self.__points = [Vector(position)] + [Vector(point) for point in waypoints]
+        self.__segment = 0
+        self.__speed = 0.0
+
+    def get_waypoints(self):
+        return self.__points[1:]
+
+    # the last waypoint, None if there is no path
+    def get_destination(self):
+        return self.__points[-1] if len(self.__points) > 1 else None
+
+    # how far is left to drive along the path from position
+    def remaining(self, position):
+        if len(self.__points) < 2:
+            return 0.0
+        closest, _ = self.__closest_point(position)
+        distance = self.__distance(closest, self.__points[self.__segment + 1])
+        for i in range(self.__segment + 1, len(self.__points) - 1):
+            distance += self.__distance(self.__points[i], self.__points[i + 1])
+        return distance
+
+    # the angle (degrees, -180 to 180) the rover has to turn to face the lookahead point.  Past TURN_IN_PLACE_ANGLE
+    # it is better to turn on the spot first.
+    def heading_error(self, position, heading):
+        if len(self.__points) < 2:
+            return 0.0
+        target = self.__lookahead_point(position, self.__lookahead())
+        return self.__wrap_degrees(self.__angle(target, position) - heading)
+
+    # drive towards the path from the pose, elapsed seconds after the last update.
+    # It returns the left and right wheel speeds and whether the last waypoint has been reached.
+    def update(self, position, heading, elapsed):
+        if len(self.__points) < 2:
+            return 0.0, 0.0, True
+
+        self.__advance(position)
+        remaining = self.remaining(position)
+        end = self.__points[-1]
+        if self.__distance(position, end) <= self.threshold or \
+                (self.__segment == len(self.__points) - 2 and self.__passed_end(position)):
+            self.__speed = 0.0
+            return 0.0, 0.0, True
+
+        # the arc through the lookahead point
+        lookahead = self.__lookahead()
+        target = self.__lookahead_point(position, lookahead)
+        error = math.radians(self.__wrap_degrees(self.__angle(target, position) - heading))
+        reach = max(self.__distance(position, target), 1e-6)
+        curvature = 2 * math.sin(error) / reach
+
+        # ramp up from the last speed, but never faster than the corners and the end of the path allow
+        speed = min(self.max_speed, self.__speed + ACCELERATION * elapsed, self.__profile_speed(position, remaining))
+        if curvature != 0:
+            speed = min(speed, math.sqrt(MAX_LATERAL_ACCELERATION / abs(curvature)))
+        speed = max(speed, MIN_SPEED)
+        self.__speed = speed
+
+        # a turn to the left (positive curvature) needs the right wheel faster
+        left = speed * (1 - curvature * self.wheel_base / 2)
+        right = speed * (1 + curvature * self.wheel_base / 2)
+        return left, right, False
+
+    # the fastest the rover can go here and still slow down in time for every corner ahead and the last waypoint
+    def __profile_speed(self, position, remaining):
+        speed = math.sqrt(MIN_SPEED ** 2 + 2 * DECELERATION * remaining)
+
+        closest, _ = self.__closest_point(position)
+        distance = self.__distance(closest, self.__points[self.__segment + 1])
+        for i in range(self.__segment + 1, len(self.__points) - 1):
+            corner_speed = self.max_speed * self.__corner_share(i)
+            speed = min(speed, math.sqrt(corner_speed ** 2 + 2 * DECELERATION * distance))
+
+            # corners further than the longest stopping distance can not matter
+            if distance > self.max_speed ** 2 / (2 * DECELERATION):
+                break
+            distance += self.__distance(self.__points[i], self.__points[i + 1])
+        return speed
+
+    # how much of full speed the corner at waypoint i can be taken at
+    def __corner_share(self, i):
+        before = self.__angle(self.__points[i], self.__points[i - 1])
+        after = self.__angle(self.__points[i + 1], self.__points[i])
+        turn = abs(self.__wrap_degrees(after - before))
+        return max(MIN_CORNER_SHARE, 1 - turn / 180.0)
+
+    def __lookahead(self):
+        return max(MIN_LOOKAHEAD, self.__speed * LOOKAHEAD_TIME)
+
+    # move on to the next segment once the rover is closer to it than to the one it is on
+    def __advance(self, position):
+        while self.__segment < len(self.__points) - 2:
+            _, share = self.__project(position, self.__segment)
+            if share < 1:
+                next_point, _ = self.__project(position, self.__segment + 1)
+                current_point, _ = self.__project(position, self.__segment)
+                if self.__distance(position, next_point) >= self.__distance(position, current_point):
+                    break
+            self.__segment += 1
+
+    # has the rover gone past the last waypoint along the last segment
+    def __passed_end(self, position):
+        _, share = self.__project(position, len(self.__points) - 2)
+        return share >= 1
+
+    # the closest point on the current segment and how far along it that is
+    def __closest_point(self, position):
+        point, share = self.__project(position, self.__segment)
+        return point, min(max(share, 0.0), 1.0)
+
+    # project a position onto segment i, it returns the point (kept on the segment) and how far along it is (0 to 1,
+    # or beyond that if the position is past either end)
+    def __project(self, position, i):
+        a = self.__points[i]
+        b = self.__points[i + 1]
+        dx = b.x - a.x
+        dy = b.y - a.y
+        length = dx * dx + dy * dy
+        if length == 0:
+            return Vector(b), 1.0
+        share = ((position.x - a.x) * dx + (position.y - a.y) * dy) / length
+        clamped = min(max(share, 0.0), 1.0)
+        return Vector(a.x + dx * clamped, a.y + dy * clamped), share
+
+    # the point distance further along the path from the closest point to the rover, or the last waypoint
+    def __lookahead_point(self, position, distance):
+        point, _ = self.__closest_point(position)
+        for i in range(self.__segment + 1, len(self.__points)):
+            step = self.__distance(point, self.__points[i])
+            if step >= distance:
+                share = distance / step
+                end = self.__points[i]
+                return Vector(point.x + (end.x - point.x) * share, point.y + (end.y - point.y) * share)
+            distance -= step
+            point = self.__points[i]
+        return Vector(self.__points[-1])
+
+    # the angle from b to a in degrees, the same as GPS.get_angle
+    @staticmethod
+    def __angle(a, b):
+        return math.degrees(math.atan2(a.y - b.y, a.x - b.x)) % 360
+
+    @staticmethod
+    def __wrap_degrees(angle):
+        return (angle + 180) % 360 - 180
+
+    @staticmethod
+    def __distance(a, b):
+        return math.hypot(a.x - b.x, a.y - b.y)
@@ -0,0 +1,46 @@
+from incremental import IncrementalSearch
+from grid import OPEN_SPACE
+
+
+# This class is an incremental path planner (D* Lite) for a single destination on a grid.
+# It searches backwards from the destination and keeps its search tree between calls, so when the grid changes only
+# the costs around the changed cells are repaired instead of searching from scratch.  The rover's position may move
+# between calls, the key modifier km keeps the old queue entries valid when it does.
+class IncrementalPlanner(IncrementalSearch):
+    def __init__(self, grid, goal):
+        IncrementalSearch.__init__(self, grid, goal)
+        self.goal = goal
+        self.__last_start = None
+
+    # get the path from start to the destination, in the same form as Grid.find_path
+    def plan(self, start):
+        # if the pathfinding solution is not worth calculating.
+        if start is None or start == self.goal or self.goal.node_type != OPEN_SPACE:
+            return [], []
+
+        with self._lock:
+            start_cell = start.index
+
+            # the rover moved, keys that are already queued are now off by at most this much
+            if self.__last_start is None:
+                self.__last_start = start_cell
+            elif self.__last_start != start_cell:
+                self._km += self._heuristic(self.__last_start, start_cell)
+                self.__last_start = start_cell
+
+            self._repair(start_cell)
+            self._compute(start_cell)
+            cells = self._extract_path(start_cell)
+        return self._make_path(start, cells)
+
+    # octile distance between two cells, the same measure the grid uses for a*
+    def _heuristic(self, a, b):
+        if a is None:
+            return 0.0
+        size_y = self.grid.nodes_in_y
+        dst_x = abs(a // size_y - b // size_y)
+        dst_y = abs(a % size_y - b % size_y)
+        if dst_x > dst_y:
+            return self.grid.diagonal_weight * dst_y + self.grid.non_diagonal_weight * (dst_x - dst_y)
+        else:
+            return self.grid.diagonal_weight * dst_x + self.grid.non_diagonal_weight * (dst_y - dst_x)
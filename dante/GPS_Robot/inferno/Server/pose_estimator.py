@@ -0,0 +1,187 @@
+import numpy as np
+import threading
+from threading import Thread
+import time
+import math
+
+# how far off each kind of measurement usually is
+HEDGE_STD = .05  # meters
+IMU_HEADING_STD = math.radians(3)
+
+# odometry error grows with every step: a base amount plus a share of the distance (or angle) travelled
+ODOMETRY_DISTANCE_STD = (.002, .05)  # meters, fraction of the distance
+ODOMETRY_ROTATION_STD = (math.radians(.2), .05)  # radians, fraction of the rotation
+DRIFT_STD = .02  # meters a second the rover could move without the encoders noticing
+
+# how often the pose is predicted from the encoders and published
+DEFAULT_RATE = 50
+
+
+# This class estimates the pose of the rover (x, y and heading) with an extended kalman filter.
+# The wheel encoders move the estimate forward between fixes, the hedges correct its position, and the IMU corrects
+# its heading.  Each hedge sits at a known distance in front of (or behind) the middle of the wheels, so every single
+# hedge fix also says something about the heading.  The front and rear hedges no longer have to come from the same
+# moment.
+# Run as a thread it publishes the pose to a callback at a fixed rate.
+class PoseEstimator(Thread):
+    def __init__(self, read_encoders=None, wheel_circumference=.2089, wheel_base=.117, rate=DEFAULT_RATE,
+                 pose_callback=None):
+        Thread.__init__(self)
+        self.read_encoders = read_encoders  # returns the left and right wheel positions in degrees
+        self.wheel_circumference = wheel_circumference  # meters
+        self.wheel_base = wheel_base  # meters between the wheels
+        self.rate = rate
+        self.pose_callback = pose_callback  # gets (x, y, heading in degrees, covariance)
+
+        # nothing is known until the first fixes come in
+        self.state = np.zeros(3)  # x, y, heading in radians
+        self.covariance = np.diag([1e4, 1e4, math.pi ** 2])
+        self.__lock = threading.Lock()
+        self.__has_position = False
+        self.__has_heading = False
+        self.__imu_offset = None  # the IMU measures heading from its own zero
+        self.__last_encoders = None
+        self.__last_time = None
+        self.__thread_done = False
+
+    # predict and publish at the set rate until stopped
+    def run(self):
+        period = 1.0 / self.rate
+        next_tick = time.time()
+        while not self.__thread_done:
+            self.step()
+
+            next_tick += period
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.time()
+
+    def stop(self):
+        self.__thread_done = True
+
+    # one tick of run: predict from the encoders and publish the pose
+    def step(self):
+        self.update_encoders()
+        if self.pose_callback is not None and self.__has_position:
+            self.pose_callback(*self.pose())
+
+    # the current estimate: x, y, heading in degrees (0-360, the same as GPS.get_angle) and a copy of the covariance
+    def pose(self):
+        with self.__lock:
+            heading = math.degrees(self.state[2]) % 360
+            return self.state[0], self.state[1], heading, self.covariance.copy()
+
+    # where a point distance meters ahead of the middle of the wheels is right now
+    def point_ahead(self, distance):
+        with self.__lock:
+            x, y, heading = self.state
+        return x + distance * math.cos(heading), y + distance * math.sin(heading)
+
+    # read the encoders and move the estimate by however far the wheels turned since last time
+    def update_encoders(self):
+        now = time.time()
+        elapsed = 0.0 if self.__last_time is None else now - self.__last_time
+        self.__last_time = now
+
+        distance = 0.0
+        rotation = 0.0
+        if self.read_encoders is not None:
+            left, right = self.read_encoders()
+            if self.__last_encoders is not None:
+                left_distance = (left - self.__last_encoders[0]) / 360.0 * self.wheel_circumference
+                right_distance = (right - self.__last_encoders[1]) / 360.0 * self.wheel_circumference
+                distance = (left_distance + right_distance) / 2
+                rotation = (right_distance - left_distance) / self.wheel_base
+            self.__last_encoders = (left, right)
+        self.predict(distance, rotation, elapsed)
+
+    # move the estimate forward by distance along the heading while turning by rotation (radians, counter clockwise)
+    def predict(self, distance, rotation, elapsed=0.0):
+        with self.__lock:
+            x, y, heading = self.state
+            middle = heading + rotation / 2  # the heading half way through the step
+            self.state = np.array([x + distance * math.cos(middle), y + distance * math.sin(middle),
+                                   heading + rotation])
+
+            jacobian = np.array([[1.0, 0.0, -distance * math.sin(middle)],
+                                 [0.0, 1.0, distance * math.cos(middle)],
+                                 [0.0, 0.0, 1.0]])
+            distance_std = ODOMETRY_DISTANCE_STD[0] * (distance != 0) + ODOMETRY_DISTANCE_STD[1] * abs(distance)
+            rotation_std = ODOMETRY_ROTATION_STD[0] * (rotation != 0) + ODOMETRY_ROTATION_STD[1] * abs(rotation)
+            drift = DRIFT_STD * elapsed
+            noise = np.diag([distance_std ** 2 + drift ** 2, distance_std ** 2 + drift ** 2, rotation_std ** 2])
+            self.covariance = jacobian.dot(self.covariance).dot(jacobian.T) + noise
+
+    # correct the estimate with a hedge position.  offset is how far the hedge sits in front of the middle of the
+    # wheels, negative if it is behind.
+    def update_hedge(self, x, y, offset, std=HEDGE_STD):
+        with self.__lock:
+            # until the heading is known the offset could point anywhere, the hedge is treated as being in the
+            # middle of the wheels and trusted less for it
+            if not self.__has_heading:
+                std += abs(offset)
+                offset = 0.0
+
+            # the very first fix is taken as it is, there is nothing to weigh it against
+            if not self.__has_position:
+                self.state[0] = x
+                self.state[1] = y
+                self.covariance[0:2, 0:2] = np.eye(2) * std ** 2
+                self.__has_position = True
+                return
+
+            heading = self.state[2]
+            cos_heading = math.cos(heading)
+            sin_heading = math.sin(heading)
+            predicted = np.array([self.state[0] + offset * cos_heading, self.state[1] + offset * sin_heading])
+            jacobian = np.array([[1.0, 0.0, -offset * sin_heading],
+                                 [0.0, 1.0, offset * cos_heading]])
+            self.__correct(np.array([x, y]) - predicted, jacobian, np.eye(2) * std ** 2)
+
+    # set the heading outright from two hedges seen close together, used until the filter has a heading of its own
+    def initialize_heading(self, front, rear):
+        with self.__lock:
+            if self.__has_heading:
+                return
+            self.state[2] = math.atan2(front.y - rear.y, front.x - rear.x)
+            self.covariance[2, 2] = math.radians(20) ** 2
+            self.covariance[0:2, 2] = 0.0
+            self.covariance[2, 0:2] = 0.0
+            self.__has_heading = True
+
+    # correct the heading with an IMU yaw in radians.  The IMU's zero is lined up with the filter the first time.
+    def update_heading(self, yaw, std=IMU_HEADING_STD):
+        with self.__lock:
+            if not self.__has_heading:
+                return
+            if self.__imu_offset is None:
+                self.__imu_offset = self.state[2] - yaw
+                return
+
+            innovation = self.__wrap_angle(yaw + self.__imu_offset - self.state[2])
+            self.__correct(np.array([innovation]), np.array([[0.0, 0.0, 1.0]]), np.array([[std ** 2]]))
+
+    def has_heading(self):
+        return self.__has_heading
+
+    # the kalman update shared by every measurement, it expects the lock to be held
+    def __correct(self, innovation, jacobian, noise):
+        innovation_covariance = jacobian.dot(self.covariance).dot(jacobian.T) + noise
+        gain = self.covariance.dot(jacobian.T).dot(np.linalg.inv(innovation_covariance))
+        self.state = self.state + gain.dot(innovation)
+        self.state[2] = self.__wrap_angle(self.state[2])
+
+        # joseph form, it keeps the covariance symmetric and positive
+        identity_minus = np.eye(3) - gain.dot(jacobian)
+        self.covariance = identity_minus.dot(self.covariance).dot(identity_minus.T) + gain.dot(noise).dot(gain.T)
+
+    @staticmethod
+    def __wrap_angle(angle):
+        return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+# the yaw (radians, counter clockwise) of a w, x, y, z quaternion
+def quaternion_yaw(w, x, y, z):
+    return math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
@@ -0,0 +1,194 @@
+from array import array
+import threading
+
+# the largest generation an unsigned 32 bit stamp can hold before it has to wrap around
+MAX_GENERATION = 0xFFFFFFFF
+
+
+# This class is a binary min heap of cell ids that also tracks where every id sits inside the heap.
+# Knowing the position makes membership checks O(1) and lets a key be lowered in place instead of re-heapifying.
+class IndexedHeap:
+    def __init__(self, size):
+        self.__ids = []  # heap ordered cell ids
+        self.__keys = []  # sort keys (usually tuples) kept in the same order as the ids
+        self.__positions = array('l', [-1]) * size  # heap position of every cell id, -1 if it is not in the heap
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def __contains__(self, cell):
+        return self.__positions[cell] >= 0
+
+    # add a cell, or lower its key if it is already in the heap
+    def push(self, cell, key):
+        position = self.__positions[cell]
+        if position < 0:
+            self.__ids.append(cell)
+            self.__keys.append(key)
+            self.__sift_up(len(self.__ids) - 1)
+        elif key < self.__keys[position]:
+            self.__keys[position] = key
+            self.__sift_up(position)
+
+    # change the key of a cell already in the heap, in either direction
+    def update(self, cell, key):
+        position = self.__positions[cell]
+        old_key = self.__keys[position]
+        self.__keys[position] = key
+        if key < old_key:
+            self.__sift_up(position)
+        else:
+            self.__sift_down(position)
+
+    # take a cell out of the heap wherever it is
+    def remove(self, cell):
+        position = self.__positions[cell]
+        self.__positions[cell] = -1
+        last_id = self.__ids.pop()
+        last_key = self.__keys.pop()
+
+        # fill the hole with the last entry and move it whichever way it needs to go
+        if position < len(self.__ids):
+            old_key = self.__keys[position]
+            self.__ids[position] = last_id
+            self.__keys[position] = last_key
+            self.__positions[last_id] = position
+            if last_key < old_key:
+                self.__sift_up(position)
+            else:
+                self.__sift_down(position)
+
+    # the cell with the lowest key, without removing it
+    def top(self):
+        return self.__ids[0]
+
+    # the lowest key in the heap
+    def top_key(self):
+        return self.__keys[0]
+
+    # remove and return the cell with the lowest key
+    def pop(self):
+        ids = self.__ids
+        keys = self.__keys
+        top = ids[0]
+        self.__positions[top] = -1
+
+        # move the last entry to the top and let it sink back down
+        last_id = ids.pop()
+        last_key = keys.pop()
+        if len(ids) > 0:
+            ids[0] = last_id
+            keys[0] = last_key
+            self.__positions[last_id] = 0
+            self.__sift_down(0)
+        return top
+
+    # empty the heap, only the cells still inside it need resetting
+    def clear(self):
+        for cell in self.__ids:
+            self.__positions[cell] = -1
+        self.__ids = []
+        self.__keys = []
+
+    def __sift_up(self, position):
+        ids = self.__ids
+        keys = self.__keys
+        positions = self.__positions
+        cell = ids[position]
+        key = keys[position]
+
+        while position > 0:
+            parent = (position - 1) >> 1
+            if key < keys[parent]:
+                ids[position] = ids[parent]
+                keys[position] = keys[parent]
+                positions[ids[position]] = position
+                position = parent
+            else:
+                break
+
+        ids[position] = cell
+        keys[position] = key
+        positions[cell] = position
+
+    def __sift_down(self, position):
+        ids = self.__ids
+        keys = self.__keys
+        positions = self.__positions
+        size = len(ids)
+        cell = ids[position]
+        key = keys[position]
+
+        while True:
+            child = 2 * position + 1
+            if child >= size:
+                break
+            if child + 1 < size and keys[child + 1] < keys[child]:
+                child += 1
+            if keys[child] < key:
+                ids[position] = ids[child]
+                keys[position] = keys[child]
+                positions[ids[position]] = position
+                position = child
+            else:
+                break
+
+        ids[position] = cell
+        keys[position] = key
+        positions[cell] = position
+
+
+# This class holds all of the per search information for a grid: costs, parents, the open heap and the closed set.
+# Instead of clearing every cell before a search, each cell is stamped with the generation it was last written in.
+# A cell whose stamp is not the current generation simply has not been reached yet by this search.
+class SearchScratch:
+    def __init__(self, size):
+        self.size = size
+        self.generation = 0
+        self.lock = threading.Lock()  # searches may come from the gps thread and the command thread at once
+
+        self.stamps = array('L', [0]) * size  # generation each cell was last touched in
+        self.g_costs = array('d', [0.0]) * size  # cost to get to each cell
+        self.parents = array('l', [-1]) * size  # cell id each cell was reached from
+        self.closed = bytearray((size + 7) >> 3)  # bitmap of cells that are finished
+        self.open_set = IndexedHeap(size)
+
+    # start a new search, invalidating everything written by the previous one
+    def begin(self):
+        self.open_set.clear()
+        self.closed[:] = bytes(len(self.closed))
+        self.generation += 1
+
+        # once the stamps would overflow the only safe option is a real reset
+        if self.generation > MAX_GENERATION:
+            self.stamps = array('L', [0]) * self.size
+            self.generation = 1
+        return self.generation
+
+    # has this cell been reached in the current search
+    def is_seen(self, cell):
+        return self.stamps[cell] == self.generation
+
+    # record a new cost and parent for a cell
+    def visit(self, cell, g_cost, parent):
+        self.stamps[cell] = self.generation
+        self.g_costs[cell] = g_cost
+        self.parents[cell] = parent
+
+    def is_closed(self, cell):
+        return self.closed[cell >> 3] & (1 << (cell & 7))
+
+    def close(self, cell):
+        self.closed[cell >> 3] |= 1 << (cell & 7)
+
+    # walk the parents back from end to start, the start itself is not included
+    def trace(self, start, end):
+        path = []
+        cell = end
+        while cell != start:
+            path.append(cell)
+            cell = self.parents[cell]
+
+        # this creates the path backwards.
+        path.reverse()
+        return path
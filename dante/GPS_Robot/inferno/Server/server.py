@@ -9,9 +9,16 @@ All incoming data will be checked for correctness
 
 import socket
 import queue
+import sys
 from gps import GPS
 from advancedgopigo3 import *
 from grid import Grid
+from planner import IncrementalPlanner
+from path_cache import PathCache
+from hierarchical import HierarchicalGrid
+from occupancy import OccupancyLayer
+from distance_field import DistanceField
+from async_core import AsyncCore
 import select
 import traceback
 from camera_server import *
@@ -54,7 +61,8 @@ MAX_LOG_SIZE = 1000
 
 # noinspection PyUnresolvedReferences
 class Server:
-    def __init__(self):
+    # with use_async the gps starts no threads, AsyncCore runs everything on one event loop instead
+    def __init__(self, use_async=False):
 
         # create the grid
         self.grid_width = 2.5
@@ -67,6 +75,10 @@ class Server:
         self.use_diagonals = True
         self.grid = Grid(self.grid_width, self.grid_height, self.grid_x, self.grid_y, self.offset_x, self.offset_y,
                          self.border_thickness, self.use_diagonals)
+        self.path_cache = PathCache(self.grid)  # full path segments are reused until the grid around them changes
+        self.use_hierarchical = False  # plan over clusters of cells instead, for grids too large for the planner
+        self.hierarchy = HierarchicalGrid(self.grid) if self.use_hierarchical else None
+        self.occupancy = OccupancyLayer(self.grid)  # sensor readings only change the grid once they agree enough
         
         # initialize default variables
         self.can_run = True
@@ -81,6 +93,8 @@ class Server:
         self.position_log.append(self.home)
         self.sim_type = 0
         self.sim_destinations = [] # where destinations are held during certain simulations
+        self.planner = None  # incremental planner for the current destination
+        self.home_field = DistanceField(self.grid, self.home)  # the way home from every cell, kept up to date
 
         # initialize the gpg
         self.gpg = AdvancedGoPiGo3(25, use_mutex=True) # was true
@@ -94,6 +108,7 @@ class Server:
         
         # initialize send queue
         self.send_queue = queue.Queue()
+        self.send_listener = None  # told about every queued message, the asyncio core sends them straight away
 
         # initialize the socket
         print("Awaiting connection")
@@ -112,7 +127,7 @@ class Server:
 
         # initialize gps
         self.gps_queue = queue.Queue()
-        self.gps = GPS(10, 1, self.gpg, q=self.gps_queue, debug_mode=False)
+        self.gps = GPS(10, 1, self.gpg, q=self.gps_queue, debug_mode=False, start_threads=not use_async)
         self.gps.set_min_distance(50)
         self.gps_can_run = False
         self.gps.set_obstacle_callback(self.obstacle_found)
@@ -127,7 +142,8 @@ class Server:
         # start the video server
         self.video = VideoServer()
         self.video.start()
-        self.gps.start()
+        if not use_async:
+            self.gps.start()
 
     # this method manages incoming and outgoing commands
     def manage_commands(self):
@@ -184,7 +200,7 @@ class Server:
                         self.simple_path = []
                         self.gps.cancel_movement()
                     else:
-                        node = self.grid.nodes[x][y]
+                        node = self.grid.get_node(x, y)
                         if node.node_type == OPEN_SPACE and node != self.rover_position:
                             self.destinations.append(node)
                             self.find_path()
@@ -193,9 +209,9 @@ class Server:
                 elif command == 'H':
                     x = int(data.pop(0))
                     y = int(data.pop(0))
-                    node = self.grid.nodes[x][y]
+                    node = self.grid.get_node(x, y)
                     if node.node_type == OPEN_SPACE:
-                        self.home = node
+                        self.set_home(node)
                 # go
                 elif command == 'GO':
                     self.start_navigation()
@@ -336,7 +352,7 @@ class Server:
     def node_changed(self, x, y, node_type):
         self.grid.set_node(x, y, node_type)
         if node_type == OBSTACLE:
-            self.add_obstacle(self.grid.nodes[x][y])
+            self.add_obstacle(self.grid.get_node(x, y))
         self.find_path()
 
     def node_changed_to_open(self, node, node_type):
@@ -347,13 +363,26 @@ class Server:
     def on_no_obstacles(self,position):
         if position.x > 0 and position.y > 0 and position.x <= self.grid_width and position.y <= self.grid_height:
             node = self.grid.node_from_global_coord(position)
-            path, _ = self.grid.find_path(self.rover_position, node, False)
-
-            for p in path:
-                if p.node_type != 0:
-                    if p.gridPos.x > 0 and p.gridPos.y > 0 and p.gridPos.x < self.grid.nodes_in_x and\
-                            p.gridPos.y < self.grid.nodes_in_y:
-                        self.node_changed_to_open(p, 0)
+            self.apply_sensor_ray(node, False)
+
+    # add a sensor reading from the rover to node to the occupancy layer, hit is set if the sensor saw something there.
+    # Only the cells the layer is now sure about are changed, the cleared ones are sent to the client and covered by
+    # one new path.
+    def apply_sensor_ray(self, node, hit):
+        # the far edges of the field have no node
+        if node is None:
+            return
+        occupied, free = self.occupancy.update_ray(self.rover_position, node, hit)
+        for cell in occupied:
+            print("callback-obstacle found")
+            self.add_obstacle(self.grid.get_node_from_index(cell))
+
+        if len(free) > 0:
+            cleared = self.grid.mark_cells(free, [])
+            for p in cleared:
+                self.send_message("N " + str(p.gridPos.x) + " " + str(p.gridPos.y) + " 0")
+            if len(cleared) > 0:
+                self.find_path()
 
     def rover_position_change(self, position):
         self.send_message("RT " + str(position.x) + " " + str(position.y))
@@ -379,7 +408,8 @@ class Server:
 
     def destination_reached(self, pos):
         print("callback-point reached", pos)
-        # send the next point to the gps
+        # the gps drove the whole path, whatever is left is only there if it stopped short of the end
+        self.find_path(False)
         self.next_gps_point()
 
         # if we are at our final destination, we are done.
@@ -400,22 +430,7 @@ class Server:
         # We only care about it if it is in the grid.
         if position.x > 0 and position.y > 0 and position.x <= self.grid_width and position.y <= self.grid_height:
             node = self.grid.node_from_global_coord(position)
-
-            # We still only care if this changes anything
-            if node.node_type != 1:
-                print("callback-obstacle found")
-
-                # we have an obstacle!
-                self.add_obstacle(node)
-
-                path, _ = self.grid.find_path(self.rover_position, node, False)
-                if len(path) > 0:
-                    path.pop(-1)
-                    for p in path:
-                        if p.node_type != 0:
-                            if p.gridPos.x > 0 and p.gridPos.y > 0 and p.gridPos.x < self.grid.nodes_in_x and \
-                                    p.gridPos.y < self.grid.nodes_in_y:
-                                self.node_changed_to_open(p, 0)
+            self.apply_sensor_ray(node, True)
 
     def add_obstacle(self, node):
         # if we have a valid node to work with.
@@ -440,15 +455,20 @@ class Server:
                 
                 # if we are currently in motion.  let's go!
                 if self.gps_can_run and len(self.simple_path) > 0:
-                    destination = self.grid.get_global_coord_from_node(self.simple_path[0])
                     #self.gpg.stop()
                     self.gps_queue.queue.clear()
                     self.gps.cancel_movement()
-                    self.gps_queue.put(destination)
+                    self.gps_queue.put(self.get_gps_waypoints())
 
     def find_path(self, send_message=True):
         if len(self.destinations) > 0:
-            _, self.simple_path = self.grid.find_path(self.rover_position, self.destinations[0])
+            # going home only needs a walk down the distance field
+            if self.destinations[0] == self.home:
+                _, self.simple_path = self.home_field.plan(self.rover_position)
+            elif self.hierarchy is not None:
+                _, self.simple_path = self.hierarchy.find_path(self.rover_position, self.destinations[0])
+            else:
+                _, self.simple_path = self.get_planner(self.destinations[0]).plan(self.rover_position)
 
         # send paths
         if send_message:
@@ -456,33 +476,57 @@ class Server:
             self.send_path()
             self.send_simple_path()
 
+    # move home, the distance field is rebuilt around the new home straight away so going home never has to wait
+    def set_home(self, node):
+        if node != self.home:
+            self.home_field.close()
+            self.home = node
+            self.home_field = DistanceField(self.grid, node)
+
+    # the planner keeps its search between calls, so it is only replaced when the destination changes
+    def get_planner(self, destination):
+        if self.planner is None or self.planner.goal != destination:
+            if self.planner is not None:
+                self.planner.close()
+            self.planner = IncrementalPlanner(self.grid, destination)
+        return self.planner
+
     def next_gps_point(self):
         # if we actually have somewhere to go
         if len(self.simple_path) > 0:
             print("navigating to next point!")
             node = self.simple_path[0]
             if node == self.rover_position and len(self.simple_path) > 0:
-                node = self.simple_path.pop(0)
-            destination = self.grid.get_global_coord_from_node(node)
-            self.gps_queue.put(destination)
+                self.simple_path.pop(0)
+            if len(self.simple_path) > 0:
+                self.gps_queue.put(self.get_gps_waypoints())
             self.send_simple_path()
         #else:
             #print("no more points!")
             #self.stop_navigation()
 
 
+    # the rest of the simple path in world coordinates, the gps follows all of it without stopping
+    def get_gps_waypoints(self):
+        return [self.grid.get_global_coord_from_node(node) for node in self.simple_path]
+
     def send_message(self, message):
         # puts a message in the send queue
         self.send_queue.put((" " + message))
+        if self.send_listener is not None:
+            self.send_listener()
+
+    def is_simulating(self):
+        return self.mode == SIM
 
     def send_status(self):
         self.send_message("ST " + str(self.status))
 
     def send_path(self):
         if len(self.simple_path) > 0:
-            self.current_path, _ = self.grid.find_path(self.rover_position, self.simple_path[0])
+            self.current_path, _ = self.path_cache.find_path(self.rover_position, self.simple_path[0])
             for i in range(1, len(self.simple_path)):
-                temp, _ = self.grid.find_path(self.simple_path[i-1], self.simple_path[i])
+                temp, _ = self.path_cache.find_path(self.simple_path[i-1], self.simple_path[i])
                 self.current_path += temp
 
             # sends the full path to the client
@@ -573,8 +617,13 @@ class Server:
 
 if __name__ == "__main__":
     try:
-        server = Server()
-        server.manage_commands()
+        # python server.py --async runs the rover on the asyncio core
+        use_async = "--async" in sys.argv
+        server = Server(use_async)
+        if use_async:
+            AsyncCore(server).run()
+        else:
+            server.manage_commands()
     except Exception as e:
         print(e)
         print(traceback.format_exc())
@@ -588,5 +637,6 @@ if __name__ == "__main__":
         server.gps.stop_thread()
         server.gps.stop()
         server.gps.cancel_movement()
-        server.gps.join()
+        if server.gps.is_alive():
+            server.gps.join()
         server.gpg.close_all_leds()
@@ -0,0 +1,72 @@
+import importlib.util
+import random
+import struct
+import unittest
+
+import numpy as np
+
+# the decoders live next to the marvelmind driver, which needs pyserial
+if importlib.util.find_spec("serial") is not None:
+    import capture_decoder
+    import hedge_benchmark
+    from marvelmind import MarvelmindHedge, PACKET_HEADER, PACKET_US_POSITION_MM, PACKET_FORMATS, crc16_modbus
+
+
+# a packet of a type the decoders do not know, with a good CRC
+def make_unknown_packet(payload):
+    body = PACKET_HEADER + struct.pack('<HB', 0x0999, len(payload)) + payload
+    return body + struct.pack('<H', crc16_modbus(body))
+
+
+@unittest.skipUnless(importlib.util.find_spec("serial") is not None, "pyserial is not installed")
+class CaptureDecoderTest(unittest.TestCase):
+    # every packet the live decoder hands to its handlers, in order, as (type, values)
+    def live_packets(self, data, chunk):
+        hedge = MarvelmindHedge()
+        seen = []
+        hedge._packetHandlers = {packet_type: lambda values, packet_type=packet_type: seen.append((packet_type, values))
+                                 for packet_type in PACKET_FORMATS}
+        for offset in range(0, len(data), chunk):
+            hedge.decode(data[offset:offset + chunk])
+        return seen
+
+    # every packet the bulk decoder finds, in capture order, as (type, values)
+    def bulk_packets(self, data):
+        decoded = capture_decoder.decode_bytes(np.frombuffer(data, dtype=np.uint8))
+        rows = []
+        for packet_type, name in capture_decoder.PACKET_NAMES.items():
+            fields = capture_decoder.PACKET_DTYPES[packet_type].names
+            for packet in decoded[name]:
+                rows.append((int(packet['offset']), packet_type, tuple(packet[field].item() for field in fields)))
+        return [(packet_type, values) for _, packet_type, values in sorted(rows)]
+
+    def make_capture(self, seed):
+        rng = random.Random(seed)
+        stream = hedge_benchmark.make_stream(3000, 0.05, 0.05, 0.1, rng)
+        data = bytearray(stream.data)
+
+        # a good packet hidden inside a packet the decoders skip, it must not be decoded on its own
+        inner = hedge_benchmark.make_packet(PACKET_US_POSITION_MM, 123456, rng)
+        position = len(data) // 2
+        data[position:position] = make_unknown_packet(inner)
+
+        # the live decoder waits for the rest of a packet cut off at the very end, padding lets it give up on it
+        data += bytes(capture_decoder._LONGEST_PACKET)
+        return bytes(data)
+
+    def test_damaged_capture_matches_live_decoder(self):
+        old_chunk_size = capture_decoder.CHUNK_SIZE
+        capture_decoder.CHUNK_SIZE = 4096  # many chunks, so packets run over chunk ends
+        try:
+            for seed in range(3):
+                data = self.make_capture(seed)
+                live = self.live_packets(data, 64)
+                bulk = self.bulk_packets(data)
+                self.assertGreater(len(live), 0)
+                self.assertEqual(live, bulk)
+        finally:
+            capture_decoder.CHUNK_SIZE = old_chunk_size
+
+
+if __name__ == "__main__":
+    unittest.main()
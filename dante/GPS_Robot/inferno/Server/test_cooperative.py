@@ -0,0 +1,50 @@
+import unittest
+
+from grid import Grid, OBSTACLE, OPEN_SPACE
+from cooperative import CooperativePlanner
+
+
+# a map of walls across its whole height with a gap at alternating ends, so the only route winds back and forth
+def make_serpentine(size_x, size_y):
+    grid = Grid(size_x / 10.0, size_y / 10.0, size_x, size_y, border_thickness=0)
+    for x in range(1, size_x, 2):
+        gap = size_y - 1 if (x // 2) % 2 == 0 else 0
+        for y in range(size_y):
+            if y != gap:
+                grid.set_node(x, y, OBSTACLE)
+    return grid
+
+
+class CooperativePlannerTest(unittest.TestCase):
+    # a route much longer than the grid is wide and tall must still be found
+    def test_long_winding_route(self):
+        grid = make_serpentine(21, 20)
+        start = grid.get_node(0, 0)
+        end = grid.get_node(20, 0)
+        flat_path, _ = grid.find_path(start, end)
+        self.assertGreater(len(flat_path), 2 * (21 + 20))
+
+        (path, simple_path), = CooperativePlanner(grid).find_paths([(start, end)])
+        self.assertEqual(len(path), len(flat_path))
+        self.assertEqual(path[-1], end)
+        self.assertTrue(all(node.node_type == OPEN_SPACE for node in path))
+
+    # a second rover on the same winding route has to wait for the first, which takes even longer
+    def test_long_winding_route_behind_another_rover(self):
+        grid = make_serpentine(21, 20)
+        agents = [(grid.get_node(0, 1), grid.get_node(20, 0)), (grid.get_node(0, 0), grid.get_node(20, 1))]
+        results = CooperativePlanner(grid).find_paths(agents)
+        for (start, end), (path, _) in zip(agents, results):
+            self.assertGreater(len(path), 0)
+            self.assertEqual(path[-1], end)
+
+        # never on the same cell at the same time
+        first, second = results[0][0], results[1][0]
+        for time in range(max(len(first), len(second))):
+            a = first[min(time, len(first) - 1)]
+            b = second[min(time, len(second) - 1)]
+            self.assertNotEqual(a, b)
+
+
+if __name__ == "__main__":
+    unittest.main()